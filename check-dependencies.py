@@ -141,6 +141,14 @@ except ImportError:
   optional += 1
 
 
+# Test for numpy
+try:
+  import numpy
+except ImportError:
+  sys.stderr.write("[OPTIONAL] Unable to import the 'numpy' module, do you have numpy installed for python %s? This feature is not required but greatly speeds up consolidation and aggregation of large series.\n" % py_version)
+  optional += 1
+
+
 # Test for whitenoise
 try:
     import whitenoise
@@ -0,0 +1,43 @@
+"""Microbenchmark for ConsistentHashRing lookups.
+
+Usage: python contrib/benchmark_hashing.py [hosts] [metrics] [rounds]
+
+Times get_nodes for a ring of carbon instances, first with every metric seen
+for the first time and then with the same metrics looked up again, the way
+CarbonLink routes the series of a wide wildcard render.
+"""
+import sys
+import timeit
+from os.path import dirname, join, abspath
+
+# Make sure the webapp is importable when running from source
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'webapp'))
+
+from graphite.render.hashing import ConsistentHashRing
+
+hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+metrics = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+nodes = [('127.0.0.1', 'cache%d' % i) for i in range(hosts)]
+keys = ['servers.host%04d.cpu.total.user' % i for i in range(metrics)]
+
+
+def cold():
+    ring = ConsistentHashRing(nodes)
+    for key in keys:
+        ring.get_nodes(key)
+
+
+warm_ring = ConsistentHashRing(nodes)
+
+
+def warm():
+    for key in keys:
+        warm_ring.get_nodes(key)
+
+
+for name, func in (('cold', cold), ('warm', warm)):
+    best = min(timeit.repeat(func, number=1, repeat=rounds))
+    print "%s: %d hosts, %d metrics, %.2f usec per get_nodes" % (name, hosts, metrics, best * 1e6 / metrics)
@@ -0,0 +1,57 @@
+"""Microbenchmark for choosing the nodes that serve a metric in Store.find.
+
+Usage: python contrib/benchmark_minimal_node_set.py [hosts] [intervals] [metrics] [rounds]
+
+Builds a synthetic cluster where every metric was found on each of the
+remote hosts, each holding the metric for a few random stretches of the last
+year (as after replication and migrations), and times get_minimal_node_set
+over all of the metrics for a year-long query.
+"""
+import os
+import random
+import sys
+import time
+import timeit
+from os.path import dirname, join, abspath
+
+# Make sure the webapp is importable when running from source
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'webapp'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+
+from graphite.intervals import Interval, IntervalSet
+from graphite.storage import FindQuery, get_minimal_node_set
+
+hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+intervals = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+metrics = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+rounds = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+
+class Node(object):
+    def __init__(self, intervals):
+        self.local = False
+        self.intervals = intervals
+
+
+now = int(time.time())
+year_ago = now - 365 * 86400
+random.seed(0)
+
+
+def random_intervals():
+    starts = sorted(random.randint(year_ago, now) for i in range(intervals))
+    return IntervalSet([Interval(start, min(start + random.randint(86400, 120 * 86400), now)) for start in starts])
+
+
+node_sets = [[Node(random_intervals()) for i in range(hosts)] for j in range(metrics)]
+query = FindQuery('servers.*.cpu.total.user', year_ago, now)
+
+
+def find():
+    for nodes in node_sets:
+        get_minimal_node_set(nodes, query)
+
+
+best = min(timeit.repeat(find, number=1, repeat=rounds))
+print "%d hosts, %d intervals per host, %.1f usec per metric" % (hosts, intervals, best * 1e6 / metrics)
@@ -14,6 +14,9 @@ try:
 except ImportError:
     import pickle
 
+# Bytes read from carbon at a time, unless the response being read is larger
+RECV_BUFFER_SIZE = 65536
+
 
 def load_keyfunc():
     if settings.CARBONLINK_HASHING_KEYFUNC:
@@ -37,6 +40,7 @@ class CarbonLinkPool:
         self.keyfunc = load_keyfunc()
         self.connections = {}
         self.last_failure = {}
+        self.bulk_unsupported = {} # host -> when it last failed a cache-query-bulk
         # Create a connection pool for each host
         for host in self.hosts:
             self.connections[host] = set()
@@ -103,11 +107,57 @@ class CarbonLinkPool:
         log.cache("CarbonLink set-metadata request received for %s:%s" % (metric, key))
         return results
 
+    def query_bulk(self, metrics):
+        """Returns a dict of the cached datapoints for each of the given metrics,
+        sending one cache-query-bulk request to each carbon instance involved."""
+        metrics_by_host = {}
+        for metric in metrics:
+            if metric.startswith(settings.CARBON_METRIC_PREFIX):
+                metric_hosts = self.hosts
+            else:
+                metric_hosts = [self.select_host(metric)]
+            for host in metric_hosts:
+                metrics_by_host.setdefault(host, []).append(metric)
+
+        results = {}
+        unsupported = set()
+        requests = []
+        now = time.time()
+        for host, host_metrics in metrics_by_host.items():
+            # Hosts that failed a cache-query-bulk are asked again after a while, they may have been upgraded
+            if now - self.bulk_unsupported.get(host, 0) < settings.CARBONLINK_RETRY_DELAY:
+                unsupported.update(host_metrics)
+            else:
+                requests.append((host, dict(type='cache-query-bulk', metrics=host_metrics)))
+
+        for (host, request), result in zip(requests, self.send_requests(requests)):
+            host_metrics = request['metrics']
+            if isinstance(result, Exception):
+                log.cache("Exception getting data from cache %s: %s" % (str(host), result))
+                continue
+
+            if 'error' in result:
+                # Carbon releases without cache-query-bulk answer with an error
+                log.cache("CarbonLink cache-query-bulk failed on %s, using cache-query: %s" % (str(host), result['error']))
+                self.bulk_unsupported[host] = time.time()
+                unsupported.update(host_metrics)
+                continue
+
+            for metric, datapoints in result['datapointsByMetric'].items():
+                if metric.startswith(settings.CARBON_METRIC_PREFIX):
+                    results.setdefault(metric, {}).update(datapoints)
+                else:
+                    results[metric] = datapoints
+            log.cache("CarbonLink cache-query-bulk request for %d metrics to %s finished" % (len(host_metrics), str(host)))
+
+        for metric in unsupported:
+            results[metric] = self.query(metric)
+        for metric in metrics:
+            results.setdefault(metric, [])
+        return results
+
     def send_request(self, request):
         metric = request['metric']
-        serialized_request = pickle.dumps(request, protocol=-1)
-        len_prefix = struct.pack("!L", len(serialized_request))
-        request_packet = len_prefix + serialized_request
         result = {}
         result.setdefault('datapoints', [])
 
@@ -115,16 +165,12 @@ class CarbonLinkPool:
             return self.send_request_to_all(request)
 
         host = self.select_host(metric)
-        conn = self.get_connection(host)
         log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
         try:
-            conn.sendall(request_packet)
-            result = self.recv_response(conn)
+            result = self.send_request_to_host(host, request)
         except Exception, e:
-            self.last_failure[host] = time.time()
             log.cache("Exception getting data from cache %s: %s" % (str(host), e))
         else:
-            self.connections[host].add(conn)
             if 'error' in result:
                 log.cache("Error getting data from cache: %s" % result['error'])
                 raise CarbonLinkRequestError(result['error'])
@@ -133,34 +179,116 @@ class CarbonLinkPool:
 
     def send_request_to_all(self, request):
         metric = request['metric']
-        serialized_request = pickle.dumps(request, protocol=-1)
-        len_prefix = struct.pack("!L", len(serialized_request))
-        request_packet = len_prefix + serialized_request
         results = {}
         results.setdefault('datapoints', {})
 
-        for host in self.hosts:
-            conn = self.get_connection(host)
-            log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
-            try:
-                conn.sendall(request_packet)
-                result = self.recv_response(conn)
-            except Exception, e:
-                self.last_failure[host] = time.time()
-                log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+        log.cache("CarbonLink sending request for %s to all hosts" % metric)
+        requests = [(host, request) for host in self.hosts]
+        for host, result in zip(self.hosts, self.send_requests(requests)):
+            if isinstance(result, Exception):
+                log.cache("Exception getting data from cache %s: %s" % (str(host), result))
+            elif 'error' in result:
+                log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
             else:
-                self.connections[host].add(conn)
-                if 'error' in result:
-                    log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
-                else:
-                    if len(result['datapoints']) > 1:
-                        results['datapoints'].update(result['datapoints'])
+                if len(result['datapoints']) > 1:
+                    results['datapoints'].update(result['datapoints'])
             log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
         return results
 
+    def send_request_to_host(self, host, request):
+        result = self.send_requests([(host, request)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def send_requests(self, requests):
+        """Sends a list of (host, request) pairs and returns their results in order.
+
+        All hosts are talked to at once from a single select loop. Requests for
+        the same host are pipelined on one connection, with at most
+        CARBONLINK_PIPELINE_DEPTH of them awaiting a response. Hosts that fail or
+        haven't answered before the timeout expires get an exception as the
+        result of each of their unanswered requests.
+        """
+        deadline = time.time() + self.timeout
+        results = [None] * len(requests)
+        requests_by_host = {}
+        for i, (host, request) in enumerate(requests):
+            requests_by_host.setdefault(host, []).append(i)
+
+        pipelines = {}
+        for host, indexes in requests_by_host.items():
+            try:
+                conn = self.get_connection(host)
+            except Exception, e:
+                for i in indexes:
+                    results[i] = e
+                continue
+            conn.setblocking(0)
+            packets = [serialize_request(requests[i][1]) for i in indexes]
+            pipelines[conn] = RequestPipeline(host, indexes, packets)
+
+        def fail(conn, error):
+            pipeline = pipelines.pop(conn)
+            self.last_failure[pipeline.host] = time.time()
+            conn.close()
+            for i in pipeline.sent + pipeline.queued:
+                results[i] = error
+
+        while pipelines:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            depth = settings.CARBONLINK_PIPELINE_DEPTH
+            for pipeline in pipelines.values():
+                pipeline.fill(depth)
+            writers = [conn for conn, pipeline in pipelines.items() if pipeline.outbox]
+            readable, writable, _ = select(pipelines.keys(), writers, [], remaining)
+
+            for conn in writable:
+                try:
+                    sent = conn.send(pipelines[conn].outbox)
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        fail(conn, e)
+                    continue
+                pipelines[conn].outbox = pipelines[conn].outbox[sent:]
+
+            for conn in readable:
+                if conn not in pipelines:
+                    continue
+                pipeline = pipelines[conn]
+                try:
+                    received = pipeline.recv(conn)
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        fail(conn, e)
+                    continue
+                if not received:
+                    fail(conn, Exception("Connection lost"))
+                    continue
+
+                try:
+                    for body in pipeline.responses():
+                        results[pipeline.sent.pop(0)] = unpickle.loads(body)
+                except Exception, e:
+                    fail(conn, e)
+                    continue
+
+                if not pipeline.sent and not pipeline.queued:
+                    del pipelines[conn]
+                    conn.settimeout(self.timeout)
+                    self.connections[pipeline.host].add(conn)
+
+        for conn in pipelines.keys():
+            fail(conn, socket.timeout("timed out after %.1fs" % self.timeout))
+
+        return results
+
     def recv_response(self, conn):
         len_prefix = recv_exactly(conn, 4)
-        body_size = struct.unpack("!L", len_prefix)[0]
+        body_size = struct.unpack_from("!L", len_prefix)[0]
         body = recv_exactly(conn, body_size)
         return unpickle.loads(body)
 
@@ -169,7 +297,71 @@ class CarbonLinkRequestError(Exception):
     pass
 
 
+class RequestPipeline(object):
+    """The requests sent or waiting to be sent to a host on one connection.
+
+    Responses are received straight into a reusable bytearray, which grows to
+    hold the largest response seen, and are unpickled from views of it.
+    """
+    __slots__ = ('host', 'queued', 'packets', 'sent', 'outbox', 'inbox', 'inbox_start', 'inbox_end')
+
+    def __init__(self, host, indexes, packets):
+        self.host = host
+        self.queued = list(indexes)
+        self.packets = list(packets)
+        self.sent = []
+        self.outbox = ''
+        self.inbox = bytearray(RECV_BUFFER_SIZE)
+        self.inbox_start = 0
+        self.inbox_end = 0
+
+    def fill(self, depth):
+        "Moves queued requests to the outbox until depth of them await a response"
+        while self.queued and len(self.sent) < depth:
+            self.sent.append(self.queued.pop(0))
+            self.outbox += self.packets.pop(0)
+
+    def recv(self, conn):
+        "Receives what conn has to read into the inbox and returns the number of bytes"
+        unread = self.inbox_end - self.inbox_start
+        wanted = RECV_BUFFER_SIZE
+        if unread >= 4:
+            # Make room for the rest of the response being received in one go
+            body_size = struct.unpack_from("!L", self.inbox, self.inbox_start)[0]
+            wanted = max(wanted, 4 + body_size - unread)
+
+        if len(self.inbox) - self.inbox_end < wanted:
+            if self.inbox_start:
+                self.inbox[:unread] = self.inbox[self.inbox_start:self.inbox_end]
+                self.inbox_start, self.inbox_end = 0, unread
+            if len(self.inbox) - self.inbox_end < wanted:
+                self.inbox.extend(bytearray(wanted - (len(self.inbox) - self.inbox_end)))
+
+        received = conn.recv_into(memoryview(self.inbox)[self.inbox_end:])
+        self.inbox_end += received
+        return received
+
+    def responses(self):
+        "Yields a read-only view of the body of each complete response in the inbox"
+        while self.inbox_end - self.inbox_start >= 4:
+            body_size = struct.unpack_from("!L", self.inbox, self.inbox_start)[0]
+            body_start = self.inbox_start + 4
+            if self.inbox_end < body_start + body_size:
+                return
+            self.inbox_start = body_start + body_size
+            yield buffer(self.inbox, body_start, body_size)
+
+        if self.inbox_start == self.inbox_end:
+            self.inbox_start = self.inbox_end = 0
+
+
 # Socket helper functions
+def serialize_request(request):
+    serialized_request = pickle.dumps(request, protocol=-1)
+    len_prefix = struct.pack("!L", len(serialized_request))
+    return len_prefix + serialized_request
+
+
 def still_connected(sock):
     is_readable = select([sock], [], [], 0)[0]
     if is_readable:
@@ -190,12 +382,14 @@ def still_connected(sock):
 
 
 def recv_exactly(conn, num_bytes):
-    buf = ''
-    while len(buf) < num_bytes:
-        data = conn.recv(num_bytes - len(buf))
-        if not data:
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    received = 0
+    while received < num_bytes:
+        received_now = conn.recv_into(view[received:], num_bytes - received)
+        if not received_now:
             raise Exception("Connection lost")
-        buf += data
+        received += received_now
 
     return buf
 
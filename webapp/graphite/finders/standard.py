@@ -1,10 +1,11 @@
 import os
 from os.path import isdir, isfile, join, basename
+from stat import S_ISDIR, S_ISREG
 from django.conf import settings
 
 from graphite.logger import log
 from graphite.node import BranchNode, LeafNode
-from graphite.readers import WhisperReader, GzippedWhisperReader, RRDReader
+from graphite.readers import WhisperReader, MmapWhisperReader, GzippedWhisperReader, RRDReader
 from graphite.util import find_escaped_pattern_fields
 
 from . import fs_to_metric, get_real_metric_path, match_entries
@@ -40,17 +41,24 @@ class StandardFinder:
                     metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
                 metric_path = '.'.join(metric_path_parts)
 
+                # Stat once, the whisper readers reuse it to look up cached headers
+                try:
+                    stat_result = os.stat(absolute_path)
+                except OSError:
+                    continue
+
                 # Now we construct and yield an appropriate Node object
-                if isdir(absolute_path):
+                if S_ISDIR(stat_result.st_mode):
                     yield BranchNode(metric_path)
 
-                elif isfile(absolute_path):
+                elif S_ISREG(stat_result.st_mode):
                     if absolute_path.endswith('.wsp') and WhisperReader.supported:
-                        reader = WhisperReader(absolute_path, real_metric_path)
+                        reader_class = MmapWhisperReader if settings.WHISPER_MMAP and MmapWhisperReader.supported else WhisperReader
+                        reader = reader_class(absolute_path, real_metric_path, stat_result)
                         yield LeafNode(metric_path, reader)
 
                     elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
-                        reader = GzippedWhisperReader(absolute_path, real_metric_path)
+                        reader = GzippedWhisperReader(absolute_path, real_metric_path, stat_result)
                         yield LeafNode(metric_path, reader)
 
                     elif absolute_path.endswith('.rrd') and RRDReader.supported:
@@ -58,9 +66,11 @@ class StandardFinder:
                             yield BranchNode(metric_path)
 
                         else:
-                            for datasource_name in RRDReader.get_datasources(absolute_path):
+                            # Read the file's info once for all of its datasources
+                            info = RRDReader.get_info(absolute_path)
+                            for datasource_name in RRDReader.get_datasources(absolute_path, info):
                                 if match_entries([datasource_name], datasource_pattern):
-                                    reader = RRDReader(absolute_path, datasource_name)
+                                    reader = RRDReader(absolute_path, datasource_name, info, stat_result)
                                     yield LeafNode(metric_path + "." + datasource_name, reader)
 
     def _find_paths(self, current_dir, patterns):
@@ -17,7 +17,7 @@ from django.conf import settings
 from graphite.compat import HttpResponse, HttpResponseBadRequest
 from graphite.util import getProfile, json
 from graphite.logger import log
-from graphite.storage import STORE, OPENTSDB_STORE
+from graphite.storage import STORE
 from graphite.carbonlink import CarbonLink
 import fnmatch, os
 
@@ -106,7 +106,7 @@ def find_view(request):
             query = '.'.join(query_parts)
 
     try:
-        matches = list(OPENTSDB_STORE.find(query, fromTime, untilTime, local=local_only))
+        matches = list(STORE.find(query, fromTime, untilTime, local=local_only))
         log.info("MATCHES: " + str(matches))
     except:
         log.exception()
@@ -161,7 +161,7 @@ def expand_view(request):
     results = {}
     for query in request.REQUEST.getlist('query'):
         results[query] = set()
-        for node in OPENTSDB_STORE.find(query, local=local_only):
+        for node in STORE.find(query, local=local_only):
             if node.is_leaf or not leaves_only:
                 results[query].add(node.path)
 
@@ -7,16 +7,73 @@ Contains adhoc wrappers and tools for working with OpenTSDB server.
 import httplib
 import httplib2
 import json
+import threading
+from urllib import urlencode
 
 from graphite.logger import log
 
+ROOT_BRANCH_ID = '0001'
+
+# Data points are averaged over at least this many seconds
+MIN_DOWNSAMPLE_INTERVAL = 60
+
+AGGREGATORS = {
+    'average': 'avg',
+    'sum': 'sum',
+    'min': 'min',
+    'max': 'max',
+}
+
+
+def get_downsample_interval(interval=None):
+    "Returns the seconds between the points of a query downsampled at least interval seconds apart"
+    return max(int(interval or 0), MIN_DOWNSAMPLE_INTERVAL)
+
+
+def get_downsampler(interval=None, consolidation_func='average'):
+    """Returns the downsampler giving points interval seconds apart, aggregated
+    like graphite's consolidation_func over the points stored in OpenTSDB."""
+    return "%ds-%s" % (get_downsample_interval(interval), AGGREGATORS.get(consolidation_func, 'avg'))
+
+
+def decode_data_points(dps, start_time, end_time, step):
+    """Places the data points of a series, the 'dps' dict of values by
+    timestamp string of a query response, on the grid of step seconds
+    covering start_time to end_time. Returns its time info and values, None
+    where points are missing.
+
+    Downsampled points are timestamped at the start of their interval, which
+    OpenTSDB aligns on multiples of it.
+    """
+    start = int(start_time) - int(start_time) % step
+    end = int(end_time) - int(end_time) % step + step
+    values = [None] * ((end - start) // step)
+    count = len(values)
+    for timestamp, value in dps.iteritems():
+        i = (int(timestamp) - start) // step
+        if 0 <= i < count:
+            values[i] = value
+    return ((start, end, step), values)
+
 
 class API(object):
-    def __init__(self, host_with_port):
+    """Client of one OpenTSDB server. It can be shared by threads, each of
+    them getting its own connection. Requests time out after ``timeout``
+    seconds without an answer."""
+    def __init__(self, host_with_port, timeout=None):
+        self.host = host_with_port
+        self.timeout = timeout
         self.headers = {'Content-Type': 'application/json'}
-        self.http = httplib2.Http()
+        self.local = threading.local()
         self.branch_url_template = "http://%s/api/tree/branch?branch={branch_id}" % host_with_port
         self.query_url = "http://%s/api/query" % host_with_port
+        self.suggest_url = "http://%s/api/suggest" % host_with_port
+
+    @property
+    def http(self):
+        if not hasattr(self.local, 'http'):
+            self.local.http = httplib2.Http(timeout=self.timeout)
+        return self.local.http
 
     def branch(self, branch_id=None):
         """Requests branch meta data.
@@ -24,16 +81,33 @@ class API(object):
         http://opentsdb.net/docs/build/html/api_http/tree/branch.html
 
         """
-        branch_id = branch_id or '0001'  # root branch id
+        branch_id = branch_id or ROOT_BRANCH_ID
         url = self.branch_url_template.format(branch_id=branch_id)
         response, content = self.http.request(url, 'GET', headers=self.headers)
         if int(response['status']) != httplib.OK:
             raise Exception("Could not read data points: %s" % repr(response))
         return json.loads(content)
 
+    def suggest_metrics(self, prefix='', max_results=25):
+        """Requests the names of the metrics starting with prefix, sorted.
+
+        http://opentsdb.net/docs/build/html/api_http/suggest.html
+
+        """
+        url = "%s?%s" % (self.suggest_url, urlencode([('type', 'metrics'), ('q', prefix), ('max', max_results)]))
+        response, content = self.http.request(url, 'GET', headers=self.headers)
+        if int(response['status']) != httplib.OK:
+            raise Exception("Could not read metric names: %s" % repr(response))
+        return json.loads(content)
+
     # TODO add tags and aggregators
-    def query(self, metric, start_time, end_time):
-        """Fetches time series data."""
+    def query(self, metrics, start_time, end_time, downsampler=None):
+        """Fetches time series data of one or more metrics, with one sub-query
+        each. Series come back in no particular order, tell them apart by
+        their 'metric'."""
+        if isinstance(metrics, basestring):
+            metrics = [metrics]
+        downsampler = downsampler or get_downsampler()
         body = {
             "start": start_time,
             "end": end_time,
@@ -43,14 +117,14 @@ class API(object):
                     "metric": metric,
                     "rate": "false",
                     "tags": None,
-                    "downsample": "1m-avg"
+                    "downsample": downsampler
                 }
+                for metric in metrics
             ]
         }
         response, content = self.http.request(
             self.query_url, 'POST', headers=self.headers, body=json.dumps(body))
         if int(response['status']) != httplib.OK:
             raise Exception("Could not read data points: %s" % repr(response))
-        log.info("BODY: " + json.dumps(body))
-        log.info("QUERY OPENTSDB: " + str(content)[:100])
+        log.info("QUERY OPENTSDB: %d metrics, %d bytes" % (len(metrics), len(content)))
         return json.loads(content)
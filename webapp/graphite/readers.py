@@ -1,5 +1,11 @@
+import mmap
 import os
+import struct
 import time
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import izip
+from threading import Lock, RLock
 from graphite.intervals import Interval, IntervalSet
 from graphite.carbonlink import CarbonLink
 from graphite.logger import log
@@ -17,9 +23,19 @@ except ImportError:
 
 try:
     import gzip
+    import zlib
 except ImportError:
     gzip = False
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
+
+# A whisper point: a big-endian 32-bit timestamp followed by a big-endian double
+POINT_DTYPE = numpy and numpy.dtype([('interval', '>u4'), ('value', '>f8')])
+
 
 class FetchInProgress(object):
     def __init__(self, wait_callback):
@@ -29,6 +45,74 @@ class FetchInProgress(object):
         return self.wait_callback()
 
 
+def query_carbonlink(reader):
+    "Returns the carbon cache datapoints prefetched for reader, querying CarbonLink if there are none"
+    cached_datapoints, reader.cached_datapoints = reader.cached_datapoints, None
+    if cached_datapoints is None:
+        cached_datapoints = CarbonLink.query(reader.real_metric_path)
+    return cached_datapoints
+
+
+def prefetch_carbonlink(nodes, startTime):
+    """Queries carbon's cache for every whisper and ceres reader behind nodes at
+    once, so that their fetches don't each make a CarbonLink round trip.
+    Readers whose fetch from startTime won't merge carbon's cache are left out."""
+    readers = []
+    for node in nodes:
+        if isinstance(node.reader, MultiReader):
+            readers.extend(n.reader for n in node.reader.nodes)
+        else:
+            readers.append(node.reader)
+    readers = [r for r in readers if isinstance(r, (WhisperReader, CeresReader)) and r.supported and
+               not isinstance(r, GzippedWhisperReader) and r.cached_datapoints is None and
+               merges_carbonlink(r, startTime)]
+    if not readers:
+        return
+
+    try:
+        results = CarbonLink.query_bulk(set(r.real_metric_path for r in readers))
+    except:
+        log.exception("Failed CarbonLink bulk query for %d metrics" % len(readers))
+        return
+
+    for reader in readers:
+        reader.cached_datapoints = results[reader.real_metric_path]
+
+
+def merges_carbonlink(reader, startTime):
+    try:
+        return reader.merges_carbonlink(startTime)
+    except Exception:
+        return False # the fetch will fail on its own
+
+
+def fetch_many(nodes, startTime, endTime, downsample=None):
+    """Fetches leaf nodes whose readers share a class as one batch.
+
+    Reader classes can serve a batch with fewer round trips or I/O passes by
+    implementing a ``fetch_many(nodes, startTime, endTime)`` classmethod that
+    returns one result per node, in node order. Nodes of other readers are
+    fetched one by one. Results may be FetchInProgress objects.
+
+    Readers whose ``fetch_many`` fetches nodes in bulk set ``batch_key``, and
+    FetchExecutor hands it every node whose reader has the same class and
+    ``batch_key`` at once. It fetches the nodes of other readers one by one.
+
+    ``downsample`` is an ``(interval, consolidationFunc)`` tuple telling that
+    points ``interval`` seconds apart, consolidated with ``consolidationFunc``,
+    are enough for the request. It is passed on to the ``fetch_many`` of
+    reader classes that set ``supports_downsample``, the others ignore it.
+    """
+    if not nodes:
+        return []
+    reader_fetch_many = getattr(nodes[0].reader, 'fetch_many', None)
+    if reader_fetch_many is None:
+        return [node.fetch(startTime, endTime) for node in nodes]
+    if downsample and getattr(nodes[0].reader, 'supports_downsample', False):
+        return reader_fetch_many(nodes, startTime, endTime, downsample=downsample)
+    return reader_fetch_many(nodes, startTime, endTime)
+
+
 class MultiReader(object):
     __slots__ = ('nodes',)
 
@@ -58,58 +142,64 @@ class MultiReader(object):
         if not results:
             raise Exception("All sub-fetches failed")
 
-        return reduce(self.merge, results)
+        return self.merge(*results)
 
-    def merge(self, results1, results2):
-        # Ensure results1 is finer than results2
-        if results1[0][2] > results2[0][2]:
-            results1, results2 = results2, results1
+    def merge(self, *results):
+        """Merges fetch results onto the timestamps of the finest step among them.
 
-        time_info1, values1 = results1
-        time_info2, values2 = results2
-        start1, end1, step1 = time_info1
-        start2, end2, step2 = time_info2
+        Every point takes its value from the finest result that has a value
+        there, falling back to coarser ones in turn. Results with the same
+        step take precedence in the order they are given.
+        """
+        if len(results) == 1:
+            return results[0]
 
-        step = step1                # finest step
-        start = min(start1, start2)  # earliest start
-        end = max(end1, end2)      # latest end
+        results = sorted(results, key=lambda r: r[0][2])
+        step = results[0][0][2]                 # finest step
+        start = min(r[0][0] for r in results)   # earliest start
+        end = max(r[0][1] for r in results)     # latest end
         time_info = (start, end, step)
-        values = []
-
-        t = start
-        while t < end:
-            # Look for the finer precision value first if available
-            i1 = (t - start1) / step1
-
-            if len(values1) > i1:
-                v1 = values1[i1]
+        points = len(xrange(start, end, step))
+
+        values = [None] * points
+        gaps = xrange(points)
+        for n, ((sub_start, sub_end, sub_step), sub_values) in enumerate(results):
+            if n:
+                # Only the points no finer result had a value for are left to fill
+                gaps = [i for i in gaps if values[i] is None]
+                if not gaps:
+                    break
+
+            sub_values = list(sub_values)
+            sub_len = len(sub_values)
+            offset, misaligned = divmod(sub_start - start, step)
+            if sub_step == step and not misaligned:
+                # Same timestamps, so sub_values[k] belongs at values[offset + k]
+                if not n:
+                    sub_values = sub_values[:max(points - offset, 0)]
+                    values[offset:offset + len(sub_values)] = sub_values
+                    continue
+                for i in gaps:
+                    k = i - offset
+                    if 0 <= k < sub_len:
+                        values[i] = sub_values[k]
             else:
-                v1 = None
-
-            if v1 is None:
-                i2 = (t - start2) / step2
-
-                if len(values2) > i2:
-                    v2 = values2[i2]
-                else:
-                    v2 = None
-
-                values.append(v2)
-            else:
-                values.append(v1)
-
-            t += step
+                for i in gaps:
+                    k = (start + i * step - sub_start) // sub_step
+                    if 0 <= k < sub_len:
+                        values[i] = sub_values[k]
 
         return (time_info, values)
 
 
 class CeresReader(object):
-    __slots__ = ('ceres_node', 'real_metric_path')
+    __slots__ = ('ceres_node', 'real_metric_path', 'cached_datapoints')
     supported = True
 
     def __init__(self, ceres_node, real_metric_path):
         self.ceres_node = ceres_node
         self.real_metric_path = real_metric_path
+        self.cached_datapoints = None
 
     def get_intervals(self):
         intervals = []
@@ -119,6 +209,9 @@ class CeresReader(object):
 
         return IntervalSet(intervals)
 
+    def merges_carbonlink(self, startTime):
+        return True
+
     def fetch(self, startTime, endTime):
         data = self.ceres_node.read(startTime, endTime)
         time_info = (data.startTime, data.endTime, data.timeStep)
@@ -126,7 +219,7 @@ class CeresReader(object):
 
         # Merge in data from carbon's cache
         try:
-            cached_datapoints = CarbonLink.query(self.real_metric_path)
+            cached_datapoints = query_carbonlink(self)
         except:
             log.exception("Failed CarbonLink query '%s'" % self.real_metric_path)
             cached_datapoints = []
@@ -143,34 +236,276 @@ class CeresReader(object):
         return (time_info, values)
 
 
+class WhisperHeaderCache(object):
+    """Process-wide LRU cache of whisper headers.
+
+    Entries are keyed on the file's path, inode and mtime, so a file that was
+    replaced or written to since its header was read is read again. At most
+    max_size headers are kept.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.headers = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, fs_path, read_header, stat_result=None):
+        """Returns (header, stat_result) for fs_path, calling read_header(fs_path)
+        if the header isn't cached. A recent stat_result saves statting the file."""
+        if stat_result is None:
+            stat_result = os.stat(fs_path)
+        key = (fs_path, stat_result.st_ino, stat_result.st_mtime)
+
+        with self.lock:
+            header = self.headers.pop(key, None)
+            if header is not None:
+                self.headers[key] = header
+                return (header, stat_result)
+
+        header = read_header(fs_path)
+        with self.lock:
+            self.headers[key] = header
+            while len(self.headers) > self.max_size:
+                self.headers.popitem(last=False)
+        return (header, stat_result)
+
+
+whisper_header_cache = WhisperHeaderCache(settings.WHISPER_HEADER_CACHE_SIZE)
+
+
+def read_gzipped_whisper_header(fs_path):
+    fh = gzip.GzipFile(fs_path, 'rb')
+    try:
+        return getattr(whisper, '__readHeader')(fh) # evil, but necessary.
+    finally:
+        fh.close()
+
+
+def inflate(decompressor, data):
+    """Feeds data to a gzip decompressor, moving on to a fresh decompressor for
+    each further gzip member. Returns the decompressor to use next and the output."""
+    output = decompressor.decompress(data)
+    while decompressor.unused_data:
+        data = decompressor.unused_data
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output += decompressor.decompress(data)
+    return (decompressor, output)
+
+
+class GzipSeekIndex(object):
+    """Random access into a gzip file.
+
+    The file is inflated lazily, only as far as reads reach, keeping the
+    decompressor after every ``spacing`` bytes or so of output. Each span
+    between two of them is a block that can be inflated again on its own, so
+    reading near the end of the file doesn't start over from its beginning.
+    """
+    spacing = 256 * 1024
+    chunk_size = 16 * 1024
+
+    def __init__(self, fs_path):
+        self.fs_path = fs_path
+        # Uncompressed offset of each block, and the compressed offset and decompressor it starts from
+        self.offsets = [0]
+        self.checkpoints = [(0, zlib.decompressobj(16 + zlib.MAX_WBITS))]
+        self.complete = False
+        self.lock = Lock()
+
+    def find_block(self, offset):
+        "Returns the block holding offset, or the last block found so far if offset is further in"
+        return bisect_right(self.offsets, offset) - 1
+
+    def inflate(self, block, end=None):
+        """Inflates from the start of block up to the compressed offset end, or
+        until spacing bytes came out. Chunks are read from the same offsets
+        every time, so a block always inflates to the same data."""
+        compressed_offset, decompressor = self.checkpoints[block]
+        decompressor = decompressor.copy()
+        output = []
+        size = 0
+        eof = False
+        with open(self.fs_path, 'rb') as fh:
+            fh.seek(compressed_offset)
+            while True:
+                if end is not None:
+                    if compressed_offset >= end:
+                        break
+                elif size >= self.spacing:
+                    break
+                chunk = fh.read(self.chunk_size)
+                if not chunk:
+                    eof = True
+                    break
+                compressed_offset += len(chunk)
+                decompressor, data = inflate(decompressor, chunk)
+                output.append(data)
+                size += len(data)
+        return (''.join(output), compressed_offset, decompressor, eof)
+
+    def read_block(self, block):
+        "Returns the data of block, which is '' past the end of the file"
+        with self.lock:
+            if block + 1 == len(self.checkpoints):
+                if self.complete:
+                    return ''
+                data, compressed_offset, decompressor, eof = self.inflate(block)
+                # Add the checkpoint before the offset, so that find_block never returns a block without one
+                self.checkpoints.append((compressed_offset, decompressor))
+                self.offsets.append(self.offsets[block] + len(data))
+                self.complete = eof
+                return data
+        return self.inflate(block, self.checkpoints[block + 1][0])[0]
+
+
+class GzipBlockCache(object):
+    """Process-wide LRU cache of gzip seek indexes and the blocks read through
+    them, bounded by their approximate size in bytes.
+
+    Entries are keyed on the file's path, inode and mtime, like those of the
+    whisper header cache.
+    """
+    # A decompressor keeps a 32KB window plus its own state
+    checkpoint_size = 40 * 1024
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted_value, evicted_size = self.entries.popitem(last=False)[1]
+                self.size -= evicted_size
+
+    def get_index(self, file_key):
+        "Returns the seek index of a file, the same one for every reader of the file"
+        with self.lock:
+            index = self.get(file_key)
+            if index is None:
+                index = GzipSeekIndex(file_key[0])
+                self.put(file_key, index, self.checkpoint_size)
+            return index
+
+    def read_block(self, file_key, offset):
+        "Returns the uncompressed offset and data of the block holding offset, or '' past the end of the file"
+        index = self.get_index(file_key)
+
+        while True:
+            block = index.find_block(offset)
+            block_key = file_key + (block,)
+            # Blocks this index hasn't inflated yet itself, as after it was evicted and
+            # created again, must go through it so that it finds the blocks after them
+            data = self.get(block_key) if block + 1 < len(index.offsets) else None
+            if data is None:
+                data = index.read_block(block)
+                self.put(block_key, data, len(data))
+            # Reading the last block found so far moves on to the next, until the one holding offset
+            if not data or offset < index.offsets[block] + len(data):
+                break
+
+        self.put(file_key, index, len(index.checkpoints) * self.checkpoint_size)
+        return (index.offsets[block], data)
+
+
+gzip_block_cache = GzipBlockCache(settings.WHISPER_GZIP_CACHE_SIZE)
+
+
+class GzippedWhisperFile(object):
+    "Read-only file object for a gzipped whisper file, read through the gzip block cache"
+    def __init__(self, fs_path, stat_result):
+        self.name = fs_path
+        self.file_key = (fs_path, stat_result.st_ino, stat_result.st_mtime)
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence != 0:
+            raise IOError("Unsupported seek whence %d" % whence)
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        output = []
+        while size > 0:
+            block_offset, data = gzip_block_cache.read_block(self.file_key, self.position)
+            start = self.position - block_offset
+            data = data[start:start + size]
+            if not data:
+                break
+            output.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return ''.join(output)
+
+    def close(self):
+        pass
+
+
 class WhisperReader(object):
-    __slots__ = ('fs_path', 'real_metric_path')
+    __slots__ = ('fs_path', 'real_metric_path', 'cached_datapoints', 'stat_result', 'inode')
     supported = bool(whisper)
 
-    def __init__(self, fs_path, real_metric_path):
+    def __init__(self, fs_path, real_metric_path, stat_result=None):
         self.fs_path = fs_path
         self.real_metric_path = real_metric_path
+        self.cached_datapoints = None
+        self.stat_result = stat_result
+        self.inode = stat_result.st_ino if stat_result else 0
+
+    def get_header(self):
+        # A stat_result handed over by the finder is only fresh enough once
+        stat_result, self.stat_result = self.stat_result, None
+        return whisper_header_cache.get(self.fs_path, whisper.info, stat_result)
+
+    def merges_carbonlink(self, startTime):
+        "Returns True if a fetch from startTime reads the finest archive, which carbon's cache is merged into"
+        header, stat_result = self.get_header()
+        archives = header['archives']
+        diff = time.time() - startTime
+        archive = next((a for a in archives if a['retention'] >= diff), archives[-1])
+        return archive['secondsPerPoint'] == min(a['secondsPerPoint'] for a in archives)
 
     def get_intervals(self):
-        start = time.time() - whisper.info(self.fs_path)['maxRetention']
-        end = max(os.stat(self.fs_path).st_mtime, start)
+        info, stat_result = self.get_header()
+        start = time.time() - info['maxRetention']
+        end = max(stat_result.st_mtime, start)
         return IntervalSet([Interval(start, end)])
 
+    def read(self, startTime, endTime):
+        return whisper.fetch(self.fs_path, startTime, endTime)
+
     def fetch(self, startTime, endTime):
-        data = whisper.fetch(self.fs_path, startTime, endTime)
+        data = self.read(startTime, endTime)
         if not data:
             return None
 
         time_info, values = data
         (start, end, step) = time_info
 
-        meta_info = whisper.info(self.fs_path)
+        meta_info, stat_result = self.get_header()
         lowest_step = min([i['secondsPerPoint'] for i in meta_info['archives']])
         # Merge in data from carbon's cache
         cached_datapoints = []
         try:
             if step == lowest_step:
-                cached_datapoints = CarbonLink.query(self.real_metric_path)
+                cached_datapoints = query_carbonlink(self)
         except:
             log.exception("Failed CarbonLink query '%s'" % self.real_metric_path)
             cached_datapoints = []
@@ -190,57 +525,179 @@ class WhisperReader(object):
         return (time_info, values)
 
 
-class GzippedWhisperReader(WhisperReader):
-    supported = bool(whisper and gzip)
+class MmapWhisperReader(WhisperReader):
+    """Reads whisper files through a read-only memory map.
 
-    def get_intervals(self):
-        fh = gzip.GzipFile(self.fs_path, 'rb')
+    Points are decoded straight from the mapping with numpy instead of
+    through whisper's seek/read and struct loops, and the header comes from
+    the whisper header cache. Archive selection and the returned time_info
+    are the same as whisper.fetch's.
+    """
+    supported = bool(whisper and numpy)
+
+    def read(self, startTime, endTime):
+        header, stat_result = self.get_header()
+        now = int(time.time())
+        fromTime = int(startTime)
+        untilTime = int(endTime)
+        if fromTime > untilTime:
+            raise whisper.InvalidTimeInterval("Invalid time interval: from time '%s' is after until time '%s'" %
+                                              (fromTime, untilTime))
+
+        oldestTime = now - header['maxRetention']
+        if fromTime > now or untilTime < oldestTime:
+            return None
+        fromTime = max(fromTime, oldestTime)
+        untilTime = min(untilTime, now)
+
+        diff = now - fromTime
+        for archive in header['archives']:
+            if archive['retention'] >= diff:
+                break
+
+        step = archive['secondsPerPoint']
+        fromInterval = int(fromTime - (fromTime % step)) + step
+        untilInterval = int(untilTime - (untilTime % step)) + step
+        if fromInterval == untilInterval:
+            # Zero-length time range: always include the next point
+            untilInterval += step
+        time_info = (fromInterval, untilInterval, step)
+
+        fh = open(self.fs_path, 'rb')
         try:
-            info = whisper.__readHeader(fh) # evil, but necessary.
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError), e:
+            raise whisper.CorruptWhisperFile("Unable to map file: %s" % e, self.fs_path)
         finally:
             fh.close()
 
-        start = time.time() - info['maxRetention']
-        end = max(os.stat(self.fs_path).st_mtime, start)
-        return IntervalSet([Interval(start, end)])
+        try:
+            return (time_info, self.read_archive(mapping, archive, fromInterval, untilInterval))
+        except (struct.error, ValueError), e:
+            raise whisper.CorruptWhisperFile("Unable to read datapoints: %s" % e, self.fs_path)
+        finally:
+            mapping.close()
+
+    def read_archive(self, mapping, archive, fromInterval, untilInterval):
+        step = archive['secondsPerPoint']
+        points = (untilInterval - fromInterval) // step
+        (baseInterval, baseValue) = struct.unpack_from(whisper.pointFormat, mapping, archive['offset'])
+        if baseInterval == 0:
+            return [None] * points
+
+        # The archive is a ring buffer, so the slice may wrap around its end
+        archive_points = archive['points']
+        first = ((fromInterval - baseInterval) // step) % archive_points
+        head = min(points, archive_points - first)
+        segments = [(archive['offset'] + first * whisper.pointSize, head)]
+        if head < points:
+            segments.append((archive['offset'], points - head))
+
+        # A slot holds a value for the requested interval only if its timestamp matches
+        values = numpy.empty(points)
+        missing = numpy.empty(points, dtype=bool)
+        expected = numpy.arange(fromInterval, untilInterval, step)
+        position = 0
+        for offset, count in segments:
+            series = numpy.frombuffer(mapping, POINT_DTYPE, count, offset)
+            window = slice(position, position + count)
+            values[window] = series['value']
+            numpy.not_equal(series['interval'], expected[window], missing[window])
+            position += count
+
+        # Leave Python to loop over whichever of the missing or present points are fewer
+        missing_indexes = numpy.flatnonzero(missing)
+        if len(missing_indexes) * 2 <= points:
+            value_list = values.tolist()
+            for i in missing_indexes.tolist():
+                value_list[i] = None
+        else:
+            present = numpy.flatnonzero(~missing)
+            value_list = [None] * points
+            for i, value in izip(present.tolist(), values[present].tolist()):
+                value_list[i] = value
+        return value_list
+
+
+class GzippedWhisperReader(WhisperReader):
+    supported = bool(whisper and gzip)
+
+    def get_header(self):
+        stat_result, self.stat_result = self.stat_result, None
+        return whisper_header_cache.get(self.fs_path, read_gzipped_whisper_header, stat_result)
 
     def fetch(self, startTime, endTime):
-        fh = gzip.GzipFile(self.fs_path, 'rb')
+        header, stat_result = self.get_header()
+        fh = GzippedWhisperFile(self.fs_path, stat_result)
         try:
             return whisper.file_fetch(fh, startTime, endTime)
-        finally:
-            fh.close()
+        except zlib.error, e:
+            raise whisper.CorruptWhisperFile("Unable to read compressed file: %s" % e, self.fs_path)
 
 
 class RRDReader:
     supported = bool(rrdtool)
 
-    def __init__(self, fs_path, datasource_name):
+    def __init__(self, fs_path, datasource_name, info=None, stat_result=None):
         self.fs_path = fs_path
         self.datasource_name = datasource_name
+        self.info = info
+        self.stat_result = stat_result
+
+    @property
+    def batch_key(self):
+        # Datasources of the same file are fetched together
+        return self.fs_path
 
     def get_intervals(self):
-        start = time.time() - self.get_retention(self.fs_path)
-        end = max(os.stat(self.fs_path).st_mtime, start)
+        start = time.time() - self.get_retention(self.fs_path, self.info)
+        stat_result, self.stat_result = self.stat_result or os.stat(self.fs_path), None
+        end = max(stat_result.st_mtime, start)
         return IntervalSet([Interval(start, end)])
 
-    def fetch(self, startTime, endTime):
+    @classmethod
+    def fetch_many(cls, nodes, startTime, endTime):
+        "Fetches every datasource wanted from an RRD file with a single flush and fetch of the file"
+        nodes_by_path = {}
+        for node in nodes:
+            nodes_by_path.setdefault(node.reader.fs_path, []).append(node)
+
+        results = {}
+        for fs_path, path_nodes in nodes_by_path.items():
+            (timeInfo, columns, rows) = cls.fetch_file(fs_path, startTime, endTime)
+            column_values = zip(*rows) if rows else [()] * len(columns)
+            for node in path_nodes:
+                values = column_values[columns.index(node.reader.datasource_name)]
+                results[node] = (timeInfo, list(values))
+        return [results[node] for node in nodes]
+
+    @staticmethod
+    def fetch_file(fs_path, startTime, endTime):
         startString = time.strftime("%H:%M_%Y%m%d+%Ss", time.localtime(startTime))
         endString = time.strftime("%H:%M_%Y%m%d+%Ss", time.localtime(endTime))
 
         if settings.FLUSHRRDCACHED:
-            rrdtool.flushcached(self.fs_path, '--daemon', settings.FLUSHRRDCACHED)
+            rrdtool.flushcached(fs_path, '--daemon', settings.FLUSHRRDCACHED)
 
-        (timeInfo, columns, rows) = rrdtool.fetch(self.fs_path, settings.RRD_CF, '-s' + startString, '-e' + endString)
-        colIndex = list(columns).index(self.datasource_name)
+        (timeInfo, columns, rows) = rrdtool.fetch(fs_path, settings.RRD_CF, '-s' + startString, '-e' + endString)
         rows.pop() #chop off the latest value because RRD returns crazy last values sometimes
+        return (timeInfo, list(columns), rows)
+
+    def fetch(self, startTime, endTime):
+        (timeInfo, columns, rows) = self.fetch_file(self.fs_path, startTime, endTime)
+        colIndex = columns.index(self.datasource_name)
         values = (row[colIndex] for row in rows)
 
         return (timeInfo, values)
 
     @staticmethod
-    def get_datasources(fs_path):
-        info = rrdtool.info(fs_path)
+    def get_info(fs_path):
+        return rrdtool.info(fs_path)
+
+    @staticmethod
+    def get_datasources(fs_path, info=None):
+        if info is None:
+            info = RRDReader.get_info(fs_path)
 
         if 'ds' in info:
             return [datasource_name for datasource_name in info['ds']]
@@ -250,8 +707,9 @@ class RRDReader:
             return list(datasources)
 
     @staticmethod
-    def get_retention(fs_path):
-        info = rrdtool.info(fs_path)
+    def get_retention(fs_path, info=None):
+        if info is None:
+            info = RRDReader.get_info(fs_path)
         if 'rra' in info:
             rras = info['rra']
         else:
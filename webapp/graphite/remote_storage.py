@@ -1,9 +1,14 @@
+import select
 import socket
+import sys
 import time
 import httplib
 import json
+from collections import OrderedDict
+from functools import partial
 from urllib import urlencode
-from threading import Lock, Event
+from threading import Condition, Lock, Event, Thread
+from Queue import Queue, Empty
 from django.conf import settings
 from django.core.cache import cache
 from graphite.node import LeafNode, BranchNode
@@ -18,6 +23,7 @@ from graphite import tree
 class RemoteStore(object):
     lastFailure = 0.0
     available = property(lambda self: time.time() - self.lastFailure > settings.REMOTE_RETRY_DELAY)
+    find_timeout = property(lambda self: settings.REMOTE_FIND_TIMEOUT)
 
     def __init__(self, host):
         self.host = host
@@ -34,6 +40,7 @@ class RemoteStore(object):
 class OpenTSDBRemoteStore(object):
     lastFailure = 0.0
     available = property(lambda self: time.time() - self.lastFailure > settings.REMOTE_RETRY_DELAY)
+    find_timeout = property(lambda self: settings.OPENTSDB_FIND_TIMEOUT)
 
     def __init__(self, host):
         self.host = host
@@ -82,9 +89,6 @@ class FindRequest(object):
             )
             return
 
-        self.connection = HTTPConnectionWithTimeout(self.store.host)
-        self.connection.timeout = settings.REMOTE_FIND_TIMEOUT
-
         query_params = [
             ('local', '1'),
             ('format', 'pickle'),
@@ -99,7 +103,8 @@ class FindRequest(object):
         query_string = urlencode(query_params)
 
         try:
-            self.connection.request('GET', '/metrics/find/?' + query_string)
+            self.connection = get_connection_pool(self.store.host).request(
+                'GET', '/metrics/find/?' + query_string, timeout=settings.REMOTE_FIND_TIMEOUT)
         except:
             log.exception(
                 "FindRequest.send(host=%s, query=%s) exception during request" % (
@@ -117,12 +122,21 @@ class FindRequest(object):
         else:
             if self.connection is None:
                 self.send()
+                if self.failed:
+                    return
 
+            pool = get_connection_pool(self.store.host)
+            connection, self.connection = self.connection, None
             try:
-                response = self.connection.getresponse()
-                assert response.status == 200, "received error response %s - %s" % (
-                    response.status, response.reason)
-                result_data = response.read()
+                connection, response = pool.getresponse(connection)
+                try:
+                    assert response.status == 200, "received error response %s - %s" % (
+                        response.status, response.reason)
+                    result_data = response.read()
+                except:
+                    pool.release(connection, False)
+                    raise
+                pool.release(connection)
                 results = unpickle.loads(result_data)
 
             except:
@@ -160,9 +174,13 @@ class OpenTSDBFindRequest(object):
         pass
 
     def get_results(self):
-        client = opentsdb.API(self.store.host)
+        client = opentsdb.API(self.store.host, settings.OPENTSDB_FIND_TIMEOUT)
         try:
-            results = tree.OpenTSDBMetricsMeta(client).find(self._query_prefix())
+            index = tree.get_metric_index(self.store.host)
+            results = index.find(self.query.pattern) if index else None
+            # The index may not know of metrics created since its last refresh
+            if not results:
+                results = tree.OpenTSDBMetricsMeta(client).find(self._query_prefix())
         except:
             log.exception(
                 "OpenTSDBFindRequest.get_results(host=%s, query=%s) exception processing response" % (
@@ -185,12 +203,99 @@ class OpenTSDBFindRequest(object):
             yield node
 
 
+class RemoteRequest(object):
+    "A render request to a remote webapp, shared by the RemoteReaders fetching its results"
+    __slots__ = ('request_lock', 'wait_lock', 'completion_event', 'results', 'size', 'timestamp')
+
+    def __init__(self):
+        self.request_lock = Lock()
+        self.wait_lock = Lock()
+        self.completion_event = Event()
+        self.results = None
+        self.size = 0
+        self.timestamp = time.time()
+
+
+class RemoteRequestCache(object):
+    """LRU cache of the remote render requests of RemoteReaders, keyed by url.
+
+    Requests expire REMOTE_READER_CACHE_DURATION seconds after they were
+    sent. At most REMOTE_READER_CACHE_SIZE_LIMIT requests, whose results take
+    at most REMOTE_READER_CACHE_MAX_BYTES pickled, are kept; the least
+    recently used ones are evicted first. Readers waiting on an evicted
+    request still get its results, as they hold the request itself.
+    """
+    max_entries = property(lambda self: settings.REMOTE_READER_CACHE_SIZE_LIMIT)
+    max_size = property(lambda self: settings.REMOTE_READER_CACHE_MAX_BYTES)
+    ttl = property(lambda self: settings.REMOTE_READER_CACHE_DURATION)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.requests = OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def get(self, url):
+        "Returns the request for url, a new one if it wasn't cached or has expired"
+        now = time.time()
+        with self.lock:
+            request = self.requests.pop(url, None)
+            if request is not None and now - request.timestamp >= self.ttl:
+                self.size -= request.size
+                self.expirations += 1
+                request = None
+
+            if request is None:
+                self.misses += 1
+                request = RemoteRequest()
+            else:
+                self.hits += 1
+            self.requests[url] = request
+            self.evict(now)
+            return request
+
+    def set_results(self, url, request, results, size):
+        with self.lock:
+            request.results = results
+            # The request may have been evicted while it was being answered
+            if self.requests.get(url) is request:
+                request.size = size
+                self.size += size
+                self.evict(time.time())
+
+    def evict(self, now):
+        "Drops expired requests from the LRU end, then requests over the size limits"
+        requests = self.requests
+        while requests:
+            url, request = next(iter(requests.iteritems()))
+            if now - request.timestamp >= self.ttl:
+                self.expirations += 1
+            elif len(requests) > self.max_entries or self.size > self.max_size:
+                self.evictions += 1
+            else:
+                break
+            del requests[url]
+            self.size -= request.size
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.requests), size=self.size, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, expirations=self.expirations)
+
+
 class RemoteReader(object):
     __slots__ = ('store', 'metric_path', 'intervals', 'query', 'connection')
-    cache_lock = Lock()
-    request_cache = {}
-    request_locks = {}
-    request_times = {}
+    request_cache = RemoteRequestCache()
 
     def __init__(self, store, node_info, bulk_query=None):
         self.store = store
@@ -202,12 +307,39 @@ class RemoteReader(object):
     def __repr__(self):
         return '<RemoteReader[%x]: %s>' % (id(self), self.store.host)
 
+    @property
+    def batch_key(self):
+        return self.store.host
+
     def get_intervals(self):
         return self.intervals
 
-    def fetch(self, start_time, end_time):
-        query_params = [
-            ('target', self.query),
+    @classmethod
+    def fetch_many(cls, nodes, start_time, end_time):
+        "Fetches nodes with a single render request to each store for all of their queries"
+        queries_by_host = {}
+        for node in nodes:
+            queries_by_host.setdefault(node.reader.store.host, set()).add(node.reader.query)
+
+        fetches = []
+        try:
+            for node in nodes:
+                fetches.append(node.reader.fetch(start_time, end_time, sorted(queries_by_host[node.reader.store.host])))
+        except Exception:
+            exc_info = sys.exc_info()
+            # Requests already sent hold a connection until their response is read
+            for fetch in fetches:
+                if isinstance(fetch, FetchInProgress):
+                    try:
+                        fetch.waitForResults()
+                    except Exception:
+                        pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return fetches
+
+    def fetch(self, start_time, end_time, queries=None):
+        query_params = [('target', query) for query in queries or [self.query]]
+        query_params += [
             ('format', 'pickle'),
             ('local', '1'),
             ('noCache', '1'),
@@ -218,60 +350,61 @@ class RemoteReader(object):
         urlpath = '/render/?' + query_string
         url = "http://%s%s" % (self.store.host, urlpath)
 
-        # Quick cache check up front
-        self.clean_cache()
-        cached_results = self.request_cache.get(url)
-        if cached_results:
-            for series in cached_results:
-                if series['name'] == self.metric_path:
-                    time_info = (series['start'], series['end'], series['step'])
-                    return (time_info, series['values'])
-
         # Synchronize with other RemoteReaders using the same bulk query.
         # Despite our use of thread synchronization primitives, the common
         # case is for synchronizing asynchronous fetch operations within
         # a single thread.
-        (request_lock, wait_lock, completion_event) = self.get_request_locks(url)
+        request = self.request_cache.get(url)
 
-        if request_lock.acquire(False): # we only send the request the first time we're called
+        # Quick cache check up front
+        if request.results is not None:
+            for series in request.results:
+                if series['name'] == self.metric_path:
+                    time_info = (series['start'], series['end'], series['step'])
+                    return (time_info, series['values'])
+
+        if request.request_lock.acquire(False): # we only send the request the first time we're called
             try:
                 log.info("RemoteReader.request_data :: requesting %s" % url)
-                self.connection = HTTPConnectionWithTimeout(self.store.host)
-                self.connection.timeout = settings.REMOTE_FETCH_TIMEOUT
-                self.connection.request('GET', urlpath)
+                self.connection = get_connection_pool(self.store.host).request(
+                    'GET', urlpath, timeout=settings.REMOTE_FETCH_TIMEOUT)
             except:
-                completion_event.set()
+                request.completion_event.set()
                 self.store.fail()
                 log.exception("Error requesting %s" % url)
                 raise
 
         def wait_for_results():
-            if wait_lock.acquire(False): # the FetchInProgress that gets waited on waits for the actual completion
+            if request.wait_lock.acquire(False): # the FetchInProgress that gets waited on waits for the actual completion
+                pool = get_connection_pool(self.store.host)
+                connection, self.connection = self.connection, None
                 try:
-                    response = self.connection.getresponse()
-                    if response.status != 200:
-                        raise Exception("Error response %d %s from %s" % (response.status, response.reason, url))
-
-                    pickled_response = response.read()
+                    connection, response = pool.getresponse(connection)
+                    try:
+                        if response.status != 200:
+                            raise Exception("Error response %d %s from %s" % (response.status, response.reason, url))
+
+                        pickled_response = response.read()
+                    except:
+                        pool.release(connection, False)
+                        raise
+                    pool.release(connection)
                     results = unpickle.loads(pickled_response)
-                    self.cache_lock.acquire()
-                    self.request_cache[url] = results
-                    self.cache_lock.release()
-                    completion_event.set()
+                    self.request_cache.set_results(url, request, results, len(pickled_response))
+                    request.completion_event.set()
                     return results
                 except:
-                    completion_event.set()
+                    request.completion_event.set()
                     self.store.fail()
                     log.exception("Error requesting %s" % url)
                     raise
 
             else: # otherwise we just wait on the completion_event
-                completion_event.wait(settings.REMOTE_FETCH_TIMEOUT)
-                cached_results = self.request_cache.get(url)
-                if cached_results is None:
+                request.completion_event.wait(settings.REMOTE_FETCH_TIMEOUT)
+                if request.results is None:
                     raise Exception("Passive remote fetch failed to find cached results")
                 else:
-                    return cached_results
+                    return request.results
 
         def extract_my_results():
             for series in wait_for_results():
@@ -281,36 +414,66 @@ class RemoteReader(object):
 
         return FetchInProgress(extract_my_results)
 
-    def clean_cache(self):
-        self.cache_lock.acquire()
-        try:
-            if len(self.request_locks) >= settings.REMOTE_READER_CACHE_SIZE_LIMIT:
-                log.info("RemoteReader.request_data :: clearing old from request_cache and request_locks")
-                now = time.time()
-                for url, timestamp in self.request_times.items():
-                    age = now - timestamp
-                    if age >= (2 * settings.REMOTE_FETCH_TIMEOUT):
-                        del self.request_locks[url]
-                        del self.request_times[url]
-                        if url in self.request_cache:
-                            del self.request_cache[url]
-        finally:
-            self.cache_lock.release()
 
-    def get_request_locks(self, url):
-        self.cache_lock.acquire()
+class OpenTSDBQuery(object):
+    "One query to an OpenTSDB server for the data points of several metrics"
+    __slots__ = ('api', 'metrics', 'start_time', 'end_time', 'step', 'downsampler', 'series', 'exc_info', 'done')
+
+    def __init__(self, api, metrics, start_time, end_time, interval=None, consolidation_func='average'):
+        self.api = api
+        self.metrics = metrics
+        self.start_time = start_time
+        self.end_time = end_time
+        self.step = opentsdb.get_downsample_interval(interval)
+        self.downsampler = opentsdb.get_downsampler(self.step, consolidation_func)
+        self.series = None
+        self.exc_info = None
+        self.done = Event()
+
+    def run(self):
         try:
-            if url not in self.request_locks:
-                self.request_locks[url] = (Lock(), Lock(), Event())
-                self.request_times[url] = time.time()
-            return self.request_locks[url]
+            results = self.api.query(self.metrics, self.start_time, self.end_time, self.downsampler)
+            self.series = dict((series['metric'], series) for series in results)
+        except:
+            self.exc_info = sys.exc_info()
+            log.exception("Error querying %d metrics from %s" % (len(self.metrics), self.api.host))
         finally:
-            self.cache_lock.release()
+            self.done.set()
+
+    def get_results(self, metric):
+        "Waits for the query to complete and returns the time info and values of metric, or None"
+        if not self.done.wait(settings.OPENTSDB_FETCH_TIMEOUT):
+            raise Exception("Timed out querying %d metrics from %s" % (len(self.metrics), self.api.host))
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        series = self.series.get(metric)
+        if series is not None:
+            return opentsdb.decode_data_points(series['dps'], self.start_time, self.end_time, self.step)
+
+
+def run_opentsdb_queries(queries):
+    "Runs queries in the background, on up to OPENTSDB_FETCH_CONCURRENCY threads at once"
+    pending = Queue()
+    for query in queries:
+        pending.put(query)
+
+    def run():
+        while True:
+            try:
+                query = pending.get_nowait()
+            except Empty:
+                return
+            query.run()
+
+    for i in range(min(len(queries), settings.OPENTSDB_FETCH_CONCURRENCY)):
+        thread = Thread(target=run, name="opentsdb queries %s" % queries[0].api.host)
+        thread.daemon = True
+        thread.start()
 
 
 class OpenTSDBRemoteReader(object):
     __slots__ = ('store', 'metric_path', 'intervals', 'query')
-    request_times = {}
+    supports_downsample = True
 
     def __init__(self, store, node_info, bulk_query=None):
         self.store = store
@@ -320,35 +483,46 @@ class OpenTSDBRemoteReader(object):
     def __repr__(self):
         return '<RemoteReader[%x]: %s>' % (id(self), self.store.host)
 
+    @property
+    def batch_key(self):
+        return self.store.host
+
     def get_intervals(self):
         return IntervalSet([Interval(float("-inf"), float("inf"))])
 
-    def _make_time_info(self, ts):
-        dps = ts['dps']
-        timestamps = map(int, dps.keys())
-        start_time = min(timestamps)
-        end_time = max(timestamps)
-        step = (end_time - start_time) / len(timestamps)
-        return (start_time, end_time, step)
-
-    def _make_values(self, ts):
-        return [item[1] for item in sorted(ts['dps'].items())]
+    @classmethod
+    def fetch_many(cls, nodes, start_time, end_time, downsample=None):
+        """Fetches the metrics of nodes from each OpenTSDB server with one query
+        per OPENTSDB_QUERY_BATCH_SIZE metrics, all running at once.
+
+        Points are downsampled by OpenTSDB as far as downsample allows."""
+        interval, consolidation_func = downsample or (None, 'average')
+        metrics_by_host = {}
+        for node in nodes:
+            metrics = metrics_by_host.setdefault(node.reader.store.host, [])
+            if node.reader.metric_path not in metrics:
+                metrics.append(node.reader.metric_path)
+
+        batch_size = settings.OPENTSDB_QUERY_BATCH_SIZE
+        query_by_metric = {}
+        for host, metrics in metrics_by_host.items():
+            api = opentsdb.API(host, settings.OPENTSDB_FETCH_TIMEOUT)
+            queries = [OpenTSDBQuery(api, metrics[i:i + batch_size], start_time, end_time, interval, consolidation_func)
+                       for i in range(0, len(metrics), batch_size)]
+            for query in queries:
+                for metric in query.metrics:
+                    query_by_metric[(host, metric)] = query
+            run_opentsdb_queries(queries)
+
+        return [FetchInProgress(partial(query_by_metric[(node.reader.store.host, node.reader.metric_path)].get_results,
+                                        node.reader.metric_path))
+                for node in nodes]
 
     def fetch(self, start_time, end_time):
-        log.info("FETCH: " + str(start_time) + ", " + str(end_time))
-        api = opentsdb.API(self.store.host)
-        results = api.query(self.metric_path, start_time, end_time)
-        log.info("RESULTS: %s" % str(results)[:100])
-        def _extract_my_results():
-            for series in results:
-                log.info("SERIES: %s" % series.keys())
-                if series['metric'] == self.metric_path:
-                    time_info = self._make_time_info(series)
-                    data = (time_info, self._make_values(series))
-                    log.info("DATA: " + str(data)[:400])
-                    return data
-
-        return FetchInProgress(_extract_my_results)
+        api = opentsdb.API(self.store.host, settings.OPENTSDB_FETCH_TIMEOUT)
+        query = OpenTSDBQuery(api, [self.metric_path], start_time, end_time)
+        query.run()
+        return FetchInProgress(partial(query.get_results, self.metric_path))
 
 
 # This is a hack to put a timeout in the connect() of an HTTP request.
@@ -380,3 +554,136 @@ class HTTPConnectionWithTimeout(httplib.HTTPConnection):
             break
         if not self.sock:
             raise socket.error(msg)
+
+
+class HTTPConnectionPool(object):
+    """Persistent HTTP/1.1 connections to one remote webapp, shared by finds,
+    fetches and remote rendering.
+
+    At most max_connections are in use at once, get() waits for one to be
+    released. The most recently released connection is reused first, while
+    connections idle for more than max_idle seconds or closed by the other
+    end are dropped.
+
+    request() and getresponse() send a request again, once, on a new
+    connection when a reused one fails, as it does when the other end closed
+    it while it was idle. They release the connection whenever they raise.
+    """
+    def __init__(self, host, max_connections, max_idle):
+        self.host = host
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.idle = [] # (connection, release time), oldest first
+        self.in_use = 0
+        self.condition = Condition()
+
+    def get(self, timeout, reuse=True):
+        """Returns a connection, waiting at most timeout seconds for one to be
+        free. The timeout also applies to connecting, connected sockets block."""
+        deadline = time.time() + timeout
+        expired = []
+        with self.condition:
+            while self.in_use >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("No free connection to %s after %.1f seconds" % (self.host, timeout))
+                self.condition.wait(remaining)
+            self.in_use += 1
+
+            now = time.time()
+            while self.idle and now - self.idle[0][1] > self.max_idle:
+                expired.append(self.idle.pop(0)[0])
+            connection = self.idle.pop()[0] if self.idle and reuse else None
+
+        for idle_connection in expired:
+            idle_connection.close()
+        if connection is None:
+            connection = HTTPConnectionWithTimeout(self.host)
+        elif is_connection_dropped(connection):
+            connection.close() # reconnects on the next request
+        connection.reused = connection.sock is not None
+        if not connection.reused:
+            connection.timeout = timeout
+        return connection
+
+    def request(self, method, url, body=None, timeout=30):
+        "Returns a connection the request has been sent on, for getresponse()"
+        connection = self.get(timeout)
+        try:
+            connection.request(method, url, body)
+        except (httplib.HTTPException, socket.error):
+            self.release(connection, False)
+            if not connection.reused:
+                raise
+            log.info("HTTPConnectionPool: resending %s %s to %s on a new connection" % (method, url, self.host))
+            connection = self.get(timeout, reuse=False)
+            try:
+                connection.request(method, url, body)
+            except:
+                self.release(connection, False)
+                raise
+        except:
+            self.release(connection, False)
+            raise
+        connection.last_request = (method, url, body, timeout)
+        return connection
+
+    def getresponse(self, connection):
+        """Returns (connection, response) for a connection returned by
+        request(). The connection may have been replaced, the one returned is
+        the one to release once the response has been read."""
+        try:
+            return (connection, connection.getresponse())
+        except socket.timeout:
+            self.release(connection, False)
+            raise
+        except (httplib.HTTPException, socket.error):
+            self.release(connection, False)
+            if not connection.reused:
+                raise
+        except:
+            self.release(connection, False)
+            raise
+
+        method, url, body, timeout = connection.last_request
+        log.info("HTTPConnectionPool: resending %s %s to %s on a new connection" % (method, url, self.host))
+        connection = self.get(timeout, reuse=False)
+        try:
+            connection.request(method, url, body)
+            return (connection, connection.getresponse())
+        except:
+            self.release(connection, False)
+            raise
+
+    def release(self, connection, reusable=True):
+        """Hands a connection back once its response has been read. Connections
+        left in an unknown state by an error must not be reused."""
+        if not reusable:
+            connection.close()
+        with self.condition:
+            self.in_use -= 1
+            if reusable:
+                self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+
+def is_connection_dropped(connection):
+    "An idle connection with something to read has been closed by the other end"
+    if connection.sock is None:
+        return False
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error):
+        return True
+
+
+connection_pools = {}
+connection_pools_lock = Lock()
+
+
+def get_connection_pool(host):
+    with connection_pools_lock:
+        if host not in connection_pools:
+            connection_pools[host] = HTTPConnectionPool(host, settings.REMOTE_POOL_MAX_CONNECTIONS,
+                                                        settings.REMOTE_POOL_MAX_IDLE)
+        return connection_pools[host]
@@ -12,12 +12,21 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import math
+import sys
+import threading
+from Queue import Queue, Empty
 from graphite.logger import log
-from graphite.storage import OPENTSDB_STORE
-from graphite.readers import FetchInProgress
+from graphite.storage import STORE
+from graphite.readers import FetchInProgress, fetch_many, prefetch_carbonlink
 from django.conf import settings
 from graphite.util import epoch
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
 
 class TimeSeries(list):
     def __init__(self, name, start, end, step, values, consolidate='average'):
@@ -32,6 +41,8 @@ class TimeSeries(list):
 
     def __iter__(self):
         if self.valuesPerPoint > 1:
+            if numpy:
+                return iter([v if v == v else None for v in self.toArray().tolist()])
             return self.__consolidatingGenerator(list.__iter__(self))
         else:
             return list.__iter__(self)
@@ -41,19 +52,17 @@ class TimeSeries(list):
 
     def __consolidatingGenerator(self, gen):
         buf = []
+        count = 0
         for x in gen:
-            buf.append(x)
-            if len(buf) == self.valuesPerPoint:
-                while None in buf: buf.remove(None)
-                if buf:
-                    yield self.__consolidate(buf)
-                    buf = []
-                else:
-                    yield None
-        while None in buf: buf.remove(None)
-        if buf: yield self.__consolidate(buf)
-        else: yield None
-        raise StopIteration
+            count += 1
+            if x is not None:
+                buf.append(x)
+            if count == self.valuesPerPoint:
+                yield self.__consolidate(buf)
+                buf = []
+                count = 0
+        # The final bucket is always emitted, even when it is empty
+        yield self.__consolidate(buf)
 
     def __consolidate(self, values):
         usable = [v for v in values if v is not None]
@@ -68,6 +77,34 @@ class TimeSeries(list):
             return min(usable)
         raise Exception("Invalid consolidation function!")
 
+    def toArray(self):
+        """Returns the (consolidated) values as a float64 numpy array holding
+        NaN in place of None. Only available when numpy is installed."""
+        values = numpy.array(list.__getslice__(self, 0, len(self)), dtype=numpy.float64)
+        if self.valuesPerPoint > 1:
+            values = self.__consolidateArray(values)
+        return values
+
+    def __consolidateArray(self, values):
+        # Reshape into one row per output point, padding the partial bucket
+        # and adding the final bucket that __consolidatingGenerator always emits
+        valuesPerPoint = self.valuesPerPoint
+        padding = valuesPerPoint - (len(values) % valuesPerPoint)
+        buckets = numpy.append(values, numpy.repeat(numpy.nan, padding)).reshape(-1, valuesPerPoint)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if self.consolidationFunc == 'sum':
+                result = numpy.nansum(buckets, axis=1)
+                result[numpy.isnan(buckets).all(axis=1)] = numpy.nan
+                return result
+            if self.consolidationFunc == 'average':
+                return numpy.nansum(buckets, axis=1) / (~numpy.isnan(buckets)).sum(axis=1)
+        if self.consolidationFunc == 'max':
+            return numpy.fmax.reduce(buckets, axis=1)
+        if self.consolidationFunc == 'min':
+            return numpy.fmin.reduce(buckets, axis=1)
+        raise Exception("Invalid consolidation function!")
+
     def __repr__(self):
         return 'TimeSeries(name=%s, start=%s, end=%s, step=%s)' % (self.name, self.start, self.end, self.step)
 
@@ -82,21 +119,293 @@ class TimeSeries(list):
         }
 
 
+class FetchCache(object):
+    """Per-request cache of fetched series, keyed by path expression.
+
+    Every entry remembers the (startTime, endTime] range it was fetched for.
+    Ranges inside an entry are sliced out of the cached series, and ranges
+    overlapping an entry only fetch the missing head or tail and splice it
+    onto the cached series. Sliced data keeps the resolution of the range
+    that was originally fetched.
+
+    Entries also remember the downsampling their series were fetched with,
+    None when no reader applied it. Full resolution entries serve downsampled
+    fetches too, downsampled ones only fetches downsampled the same way.
+
+    Whisper picks the archive to read by how far back a range starts, so a
+    range starting later than an entry may be stored at a finer step. Entries
+    remember the steps of their series, and a full resolution entry only
+    serves a range when a fetch starting no earlier than it got the same
+    steps, which pins the archive the range would be read from.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.fetchedSteps = {}
+
+    def fetch(self, pathExpr, startTime, endTime, fetchRange, downsample=None):
+        """fetchRange(startTime, endTime, downsample) returns the series fetched
+        and the downsampling that was actually applied to them."""
+        entries = self.entries.setdefault(pathExpr, [])
+        fetchedSteps = self.fetchedSteps.setdefault(pathExpr, [])
+
+        def fetchSteps(startTime, endTime, downsample):
+            seriesList, downsampled = fetchRange(startTime, endTime, downsample)
+            if downsampled is None:
+                fetchedSteps.append((startTime, seriesSteps(seriesList)))
+            return seriesList, downsampled
+
+        for i, (cachedStart, cachedEnd, cachedDownsample, cachedSteps, cachedSeries) in enumerate(entries):
+            if cachedDownsample not in (None, downsample):
+                continue
+
+            if cachedStart <= startTime and endTime <= cachedEnd:
+                if cachedDownsample is None and \
+                        not any(start >= startTime and steps == cachedSteps for start, steps in fetchedSteps):
+                    log.cache("FetchCache skipped %s, (%d, %d] may be stored at a finer step" % (
+                        pathExpr, startTime, endTime))
+                    continue
+                log.cache("FetchCache hit for %s (%d, %d]" % (pathExpr, startTime, endTime))
+                return [sliceSeries(s, startTime, endTime) for s in cachedSeries]
+
+            if startTime < cachedEnd and cachedStart < endTime:
+                # The pieces only splice onto the entry when fetched at its steps
+                head = fetchSteps(startTime, cachedStart, cachedDownsample)[0] if startTime < cachedStart else None
+                tail = fetchSteps(cachedEnd, endTime, cachedDownsample)[0] if cachedEnd < endTime else None
+                spliced = spliceSeriesLists(head, cachedSeries, tail)
+                if spliced is None:
+                    log.cache("FetchCache cannot splice %s, fetching (%d, %d]" % (pathExpr, startTime, endTime))
+                    break
+
+                log.cache("FetchCache extended %s to (%d, %d]" % (pathExpr, startTime, endTime))
+                entries[i] = (min(startTime, cachedStart), max(endTime, cachedEnd), cachedDownsample, cachedSteps,
+                              spliced)
+                return [sliceSeries(s, startTime, endTime) for s in spliced]
+
+        seriesList, downsampled = fetchSteps(startTime, endTime, downsample)
+        if all(isAligned(s) for s in seriesList):
+            entries.append((startTime, endTime, downsampled, seriesSteps(seriesList),
+                            [sliceSeries(s, startTime, endTime) for s in seriesList]))
+        return seriesList
+
+
+def seriesSteps(seriesList):
+    "Returns the step of every series by name, comparable between fetches"
+    return tuple(sorted((s.name, s.step) for s in seriesList))
+
+
+def isAligned(series):
+    "Returns True if the series holds one value per step from a step-aligned start to its end"
+    return series.step > 0 and series.start % series.step == 0 and \
+        len(series) * series.step == series.end - series.start
+
+
+def sliceSeries(series, startTime, endTime):
+    """Returns a copy of series covering (startTime, endTime], aligned the way
+    whisper aligns fetched intervals to the series step."""
+    step = series.step
+    start = max(startTime - (startTime % step) + step, series.start)
+    end = max(min(endTime - (endTime % step) + step, series.end), start)
+    values = list.__getslice__(series, (start - series.start) / step, (end - series.start) / step)
+
+    sliced = TimeSeries(series.name, start, end, step, values)
+    sliced.pathExpression = series.pathExpression
+    return sliced
+
+
+def spliceSeriesLists(head, seriesList, tail):
+    """Joins the series fetched before and after seriesList onto it, returning
+    None unless every piece matches the cached series by name and step and
+    lines up with it exactly."""
+    spliced = []
+    byName = lambda s: s.name
+    pieces = [sorted(p, key=byName) for p in (head, seriesList, tail) if p is not None]
+    if len(set(len(p) for p in pieces)) != 1:
+        return None
+
+    for parts in zip(*pieces):
+        name, step = parts[0].name, parts[0].step
+        for previous, part in zip(parts, parts[1:]):
+            if part.name != name or part.step != step or previous.end != part.start:
+                return None
+        if not all(isAligned(part) for part in parts):
+            return None
+
+        values = []
+        for part in parts:
+            values.extend(list.__iter__(part))
+        series = TimeSeries(name, parts[0].start, parts[-1].end, step, values)
+        series.pathExpression = parts[0].pathExpression
+        spliced.append(series)
+
+    return spliced
+
+
+def waitForResults(fetches, error=None):
+    """Returns the results of fetches, in order, once every FetchInProgress
+    among them is done. Even when one fails, the others are waited on so
+    none is left holding a remote connection, then the first error, or the
+    exc_info passed as error, is raised."""
+    results = []
+    for r in fetches:
+        if isinstance(r, FetchInProgress):
+            try:
+                r = r.waitForResults()
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+                r = None
+        results.append(r)
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results
+
+
+class FetchExecutor(object):
+    """Fetches leaf nodes on a bounded pool of worker threads.
+
+    Nodes whose readers share a class and a ``batch_key``, like the remote
+    readers of a store, are fetched in one batch with the ``fetch_many`` of
+    their class. The others are fetched one by one, in inode order for
+    whisper files, after carbon's cache has been queried for all of them at
+    once. At most ``concurrency`` batches
+    are fetched at once per call, and at most ``backendConcurrency[name]`` at
+    once across all requests for readers whose class is called ``name``.
+    Results are returned in node order.
+    """
+    backendSemaphores = {}
+    backendSemaphoresLock = threading.Lock()
+
+    def __init__(self, concurrency=None, backendConcurrency=None):
+        if concurrency is None:
+            concurrency = settings.FETCH_CONCURRENCY
+        if backendConcurrency is None:
+            backendConcurrency = settings.FETCH_BACKEND_CONCURRENCY
+        self.concurrency = concurrency
+        self.backendConcurrency = backendConcurrency
+
+    def getBackendSemaphore(self, node):
+        backend = node.reader.__class__.__name__
+        limit = self.backendConcurrency.get(backend)
+        if not limit:
+            return None
+
+        with self.backendSemaphoresLock:
+            key = (backend, limit)
+            if key not in self.backendSemaphores:
+                self.backendSemaphores[key] = threading.BoundedSemaphore(limit)
+            return self.backendSemaphores[key]
+
+    def getBatches(self, nodes):
+        "Groups the indexes of nodes into batches that are fetched together"
+        batches = []
+        batchesByKey = {}
+        singles = []
+        for i, node in enumerate(nodes):
+            batchKey = getattr(node.reader, 'batch_key', None)
+            if batchKey is None:
+                singles.append(i)
+                continue
+            key = (node.reader.__class__, batchKey)
+            if key in batchesByKey:
+                batchesByKey[key].append(i)
+            else:
+                batchesByKey[key] = [i]
+                batches.append(batchesByKey[key])
+
+        # Local files are read in inode order, which roughly follows their layout on disk
+        singles.sort(key=lambda i: (getattr(nodes[i].reader, 'inode', 0), i))
+        return batches + [[i] for i in singles]
+
+    def fetch(self, nodes, startTime, endTime, downsample=None):
+        semaphore = self.getBackendSemaphore(nodes[0])
+        if semaphore:
+            semaphore.acquire()
+        try:
+            return waitForResults(fetch_many(nodes, startTime, endTime, downsample))
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    def fetchAll(self, nodes, startTime, endTime, downsample=None):
+        if len(nodes) > 1:
+            prefetch_carbonlink(nodes, startTime)
+        batches = self.getBatches(nodes)
+        results = [None] * len(nodes)
+        workers = min(self.concurrency, len(batches))
+        if workers <= 1:
+            # Start every fetch before waiting on any so remote fetches still overlap,
+            # and wait on the ones started even if starting another one failed.
+            # Batches of a backend with a concurrency limit are fetched within it.
+            fetches = []
+            error = None
+            try:
+                for batch in batches:
+                    batchNodes = [nodes[i] for i in batch]
+                    if self.getBackendSemaphore(batchNodes[0]):
+                        batchResults = self.fetch(batchNodes, startTime, endTime, downsample)
+                    else:
+                        batchResults = fetch_many(batchNodes, startTime, endTime, downsample)
+                    fetches.extend(zip(batch, batchResults))
+            except Exception:
+                error = sys.exc_info()
+            for (i, r), result in zip(fetches, waitForResults([r for i, r in fetches], error)):
+                results[i] = result
+            return results
+
+        errors = []
+        queue = Queue()
+        for batch in batches:
+            queue.put(batch)
+
+        def work():
+            while not errors:
+                try:
+                    batch = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    batchResults = self.fetch([nodes[i] for i in batch], startTime, endTime, downsample)
+                except Exception:
+                    errors.append((batch[0], sys.exc_info()))
+                    continue
+                for i, r in zip(batch, batchResults):
+                    results[i] = r
+
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            i, (excType, excValue, traceback) = min(errors, key=lambda e: e[0])
+            raise excType, excValue, traceback
+        return results
+
+
 # Data retrieval API
 def fetchData(requestContext, pathExpr):
 
-    seriesList = []
     startTime = int(epoch(requestContext['startTime']))
     endTime = int(epoch(requestContext['endTime']))
 
-    def _fetchData(pathExpr, startTime, endTime, requestContext, seriesList):
-        matching_nodes = OPENTSDB_STORE.find(pathExpr, startTime, endTime, local=requestContext['localOnly'])
-        fetches = [(node, node.fetch(startTime, endTime)) for node in matching_nodes if node.is_leaf]
+    # Series that are only drawn or returned maxDataPoints wide don't need finer
+    # points than that, backends that can downsample are asked to
+    downsample = None
+    maxDataPoints = requestContext.get('maxDataPoints')
+    consolidationFunc = requestContext.get('consolidationFunc')
+    if maxDataPoints and consolidationFunc and endTime > startTime:
+        downsample = (int(math.ceil(float(endTime - startTime) / maxDataPoints)), consolidationFunc)
 
-        for node, results in fetches:
-            if isinstance(results, FetchInProgress):
-                results = results.waitForResults()
+    def _fetchData(pathExpr, startTime, endTime, requestContext, seriesList, downsample):
+        matching_nodes = STORE.find(pathExpr, startTime, endTime, local=requestContext['localOnly'])
+        leaf_nodes = [node for node in matching_nodes if node.is_leaf]
+        if not any(getattr(node.reader, 'supports_downsample', False) for node in leaf_nodes):
+            downsample = None
+        fetches = zip(leaf_nodes, FetchExecutor().fetchAll(leaf_nodes, startTime, endTime, downsample))
 
+        for node, results in fetches:
             if not results:
                 log.info("render.datalib.fetchData :: no results for %s.fetch(%s, %s)" % (node, startTime, endTime))
                 continue
@@ -123,21 +432,26 @@ def fetchData(requestContext, pathExpr):
             for series in empty_duplicates:
                 seriesList.remove(series)
 
-        return seriesList
+        return seriesList, downsample
 
-    retries = 1 # start counting at one to make log output and settings more readable
-    while True:
-        try:
-            seriesList = _fetchData(pathExpr, startTime, endTime, requestContext, seriesList)
-            return seriesList
-        except Exception, e:
-            if retries >= settings.MAX_FETCH_RETRIES:
-                log.exception("Failed after %i retry! See: %s" % (settings.MAX_FETCH_RETRIES, e))
-                raise Exception("Failed after %i retry! See: %s" % (settings.MAX_FETCH_RETRIES, e))
-            else:
-                log.exception("Got an exception when fetching data! See: %s Will do it again! Run: %i of %i" %
-                             (e, retries, settings.MAX_FETCH_RETRIES))
-                retries += 1
+    def fetchRange(startTime, endTime, downsample):
+        retries = 1 # start counting at one to make log output and settings more readable
+        while True:
+            try:
+                return _fetchData(pathExpr, startTime, endTime, requestContext, [], downsample)
+            except Exception, e:
+                if retries >= settings.MAX_FETCH_RETRIES:
+                    log.exception("Failed after %i retry! See: %s" % (settings.MAX_FETCH_RETRIES, e))
+                    raise Exception("Failed after %i retry! See: %s" % (settings.MAX_FETCH_RETRIES, e))
+                else:
+                    log.exception("Got an exception when fetching data! See: %s Will do it again! Run: %i of %i" %
+                                 (e, retries, settings.MAX_FETCH_RETRIES))
+                    retries += 1
+
+    fetchCache = requestContext.get('fetchCache')
+    if fetchCache is None:
+        return fetchRange(startTime, endTime, downsample)[0]
+    return fetchCache.fetch(pathExpr, startTime, endTime, fetchRange, downsample)
 
 
 def nonempty(series):
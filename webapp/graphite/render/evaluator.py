@@ -3,9 +3,58 @@ from graphite.render.grammar import grammar
 from graphite.render.datalib import fetchData, TimeSeries
 
 
-def evaluateTarget(requestContext, target):
+# Functions that leave the values of their series alone, so that series drawn
+# through them can be consolidated before they are fetched
+DISPLAY_FUNCTIONS = frozenset([
+    'alias', 'aliasByMetric', 'aliasByNode', 'aliasSub', 'color', 'dashed',
+    'lineWidth', 'secondYAxis',
+])
+
+
+def getConsolidationFunc(tokens):
+    """Returns how the series of a target will be consolidated for display,
+    when it is only fetched and passed through DISPLAY_FUNCTIONS and
+    consolidateBy. Returns None for any other target, whose series must be
+    fetched at full resolution."""
+    if tokens.expression:
+        return getConsolidationFunc(tokens.expression)
+
+    elif tokens.pathExpression:
+        return 'average'
+
+    elif tokens.call:
+        if tokens.call.kwargs or not tokens.call.args:
+            return None
+        consolidationFunc = getConsolidationFunc(tokens.call.args[0])
+        if tokens.call.funcname == 'consolidateBy':
+            if consolidationFunc and len(tokens.call.args) == 2 and tokens.call.args[1].string:
+                return tokens.call.args[1].string[1:-1]
+        elif tokens.call.funcname in DISPLAY_FUNCTIONS:
+            return consolidationFunc
+
+    return None
+
+
+def evaluateTarget(requestContext, target, consolidate=False):
+    """Evaluates target into a list of series.
+
+    With consolidate set, as for the targets of renderView, series that will
+    only be consolidated to maxDataPoints may be fetched downsampled. Targets
+    that functions evaluate again are fetched at full resolution.
+    """
     tokens = grammar.parseString(target)
-    result = evaluateTokens(requestContext, tokens)
+
+    # Set and restored on the shared context, which holds state like the
+    # running total of stacked() from one target to the next
+    consolidationFunc = requestContext.get('consolidationFunc')
+    if consolidate and requestContext.get('maxDataPoints'):
+        requestContext['consolidationFunc'] = getConsolidationFunc(tokens)
+    else:
+        requestContext['consolidationFunc'] = None
+    try:
+        result = evaluateTokens(requestContext, tokens)
+    finally:
+        requestContext['consolidationFunc'] = consolidationFunc
 
     if type(result) is TimeSeries:
         return [result] #we have to return a list of TimeSeries objects
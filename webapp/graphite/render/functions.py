@@ -12,13 +12,14 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
+import bisect
 import math
 import random
 import re
 import time
 
 from datetime import datetime, timedelta
-from itertools import izip, imap
+from itertools import izip
 from os import environ
 
 from graphite.logger import log
@@ -26,6 +27,11 @@ from graphite.render.attime import parseTimeOffset, parseATTime
 from graphite.events import models
 from graphite.util import epoch
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
 # XXX format_units() should go somewhere else
 if environ.get('READTHEDOCS'):
     format_units = lambda *args, **kwargs: (0, '')
@@ -97,6 +103,7 @@ def safeAvg(a):
 def safeStdDev(a):
     sm = safeSum(a)
     ln = safeLen(a)
+    if not ln: return None
     avg = safeDiv(sm, ln)
     sum = 0
     safeValues = [v for v in a if v is not None]
@@ -137,6 +144,201 @@ def safeIsNotEmpty(values):
     safeValues = [v for v in values if v is not None]
     return len(safeValues) > 0
 
+# Array kernels
+#
+# These reduce a 2-D array holding one series per row, with NaN standing in
+# for None, along the series axis. They mirror the safe* functions above and
+# are only used when numpy is available.
+
+
+def stackSeries(seriesList):
+    """Returns the values of seriesList as a 2-D float array, one row per
+    series, truncated to the shortest series just like izip()."""
+    rows = [series.toArray() for series in seriesList]
+    length = min(len(row) for row in rows)
+    return numpy.vstack([row[:length] for row in rows])
+
+
+def arrayToValues(values):
+    return [v if v == v else None for v in values.tolist()]
+
+
+def arrayCounts(values):
+    return (~numpy.isnan(values)).sum(axis=0)
+
+
+def arraySum(values):
+    total = numpy.nansum(values, axis=0)
+    total[arrayCounts(values) == 0] = numpy.nan
+    return total
+
+
+def arrayAvg(values):
+    counts = arrayCounts(values)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.nansum(values, axis=0) / counts
+
+
+def arrayStdDev(values):
+    counts = arrayCounts(values)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        deviations = values - numpy.nansum(values, axis=0) / counts
+        return numpy.sqrt(numpy.nansum(deviations * deviations, axis=0) / counts)
+
+
+def arrayMin(values):
+    return numpy.fmin.reduce(values, axis=0)
+
+
+def arrayMax(values):
+    return numpy.fmax.reduce(values, axis=0)
+
+
+def arrayRange(values):
+    # A single missing value makes the whole point missing, as min(row) does
+    with numpy.errstate(invalid='ignore'):
+        return values.max(axis=0) - values.min(axis=0)
+
+
+def arrayDiff(values):
+    known = ~numpy.isnan(values)
+    columns = numpy.arange(values.shape[1])
+    firstKnown = known.argmax(axis=0)
+    first = values[firstKnown, columns]
+    rest = numpy.where(known, values, 0.0)
+    rest[firstKnown, columns] = 0.0
+    return first - rest.sum(axis=0)
+
+
+def arrayMul(values):
+    return values.prod(axis=0)
+
+
+def aggregateRows(seriesList, rowFunc, arrayFunc):
+    """Aggregates seriesList point by point, using the array kernel arrayFunc
+    when numpy is available and calling rowFunc on every row otherwise."""
+    if numpy:
+        return arrayToValues(arrayFunc(stackSeries(seriesList)))
+    return (rowFunc(row) for row in izip(*seriesList))
+
+# Moving windows
+#
+# These keep a running aggregate of the non-None values in a window that
+# slides over a list of values, so that every step costs O(1) (O(log w) for
+# the median) instead of re-scanning the whole window.
+
+
+class _AverageWindow(object):
+    def __init__(self):
+        self.recompute([])
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+    def remove(self, value):
+        self.count -= 1
+        self.total -= value
+
+    def recompute(self, values):
+        self.count = safeLen(values)
+        self.total = safeSum(values) or 0
+
+    def value(self):
+        if self.count:
+            return float(self.total) / self.count
+
+
+class _MedianWindow(object):
+    def __init__(self):
+        self.recompute([])
+
+    def add(self, value):
+        bisect.insort(self.sortedValues, value)
+
+    def remove(self, value):
+        del self.sortedValues[bisect.bisect_left(self.sortedValues, value)]
+
+    def recompute(self, values):
+        self.sortedValues = sorted(v for v in values if v is not None)
+
+    def value(self):
+        if self.sortedValues:
+            return self.sortedValues[len(self.sortedValues) / 2]
+
+
+class _StdDevWindow(object):
+    """Welford's running variance, extended to let values leave the window.
+    The value is None unless at least windowTolerance * points are known."""
+    def __init__(self, points, windowTolerance):
+        self.points = points
+        self.windowTolerance = windowTolerance
+        self.recompute([])
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        self.count -= 1
+        if not self.count:
+            self.mean = self.m2 = 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 -= delta * (value - self.mean)
+
+    def recompute(self, values):
+        self.count = 0
+        self.mean = self.m2 = 0.0
+        for value in values:
+            if value is not None:
+                self.add(value)
+
+    def value(self):
+        if self.count > 0 and float(self.count) / self.points >= self.windowTolerance:
+            return math.sqrt(max(self.m2, 0.0) / self.count)
+
+
+def movingWindow(window, values, bounds):
+    """Slides window over values, yielding window.value() for the slice
+    values[lo:hi] for each (lo, hi) in bounds, or None when lo is negative.
+
+    Both lo and hi must be non-decreasing. Once the number of updates exceeds
+    the window size, the window is rebuilt from its slice so that rounding
+    errors from values leaving the window cannot pile up.
+    """
+    lo = hi = 0
+    updates = 0
+    for start, end in bounds:
+        if start < 0:
+            yield None
+            continue
+
+        if start >= hi:
+            # Nothing carries over, start from an empty window
+            window.recompute([])
+            lo = hi = start
+
+        while hi < end:
+            if values[hi] is not None:
+                window.add(values[hi])
+            hi += 1
+            updates += 1
+        while lo < start:
+            if values[lo] is not None:
+                window.remove(values[lo])
+            lo += 1
+            updates += 1
+
+        if updates > end - start:
+            window.recompute(values[lo:hi])
+            updates = 0
+
+        yield window.value()
+
 # Greatest common divisor
 
 
@@ -217,7 +419,7 @@ def sumSeries(requestContext, *seriesLists):
     except:
         return []
     name = "sumSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeSum(row) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeSum, arraySum)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -345,7 +547,7 @@ def diffSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "diffSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeDiff(row) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeDiff, arrayDiff)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -367,7 +569,7 @@ def averageSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "averageSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeDiv(safeSum(row), safeLen(row)) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeAvg, arrayAvg)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -388,7 +590,7 @@ def stddevSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "stddevSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeStdDev(row) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeStdDev, arrayStdDev)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -407,7 +609,7 @@ def minSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "minSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeMin(row) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeMin, arrayMin)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -427,7 +629,7 @@ def maxSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "maxSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeMax(row) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, safeMax, arrayMax)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -447,7 +649,7 @@ def rangeOfSeries(requestContext, *seriesLists):
     """
     (seriesList, start, end, step) = normalize(seriesLists)
     name = "rangeOfSeries(%s)" % formatPathExpressions(seriesList)
-    values = (safeSubtract(max(row), min(row)) for row in izip(*seriesList))
+    values = aggregateRows(seriesList, lambda row: safeSubtract(max(row), min(row)), arrayRange)
     series = TimeSeries(name, start, end, step, values)
     series.pathExpression = name
     return [series]
@@ -664,7 +866,7 @@ def multiplySeries(requestContext, *seriesLists):
         return seriesList
 
     name = "multiplySeries(%s)" % ','.join([s.name for s in seriesList])
-    product = imap(lambda x: safeMul(*x), izip(*seriesList))
+    product = aggregateRows(seriesList, lambda row: safeMul(*row), arrayMul)
     resultSeries = TimeSeries(name, start, end, step, product)
     resultSeries.pathExpression = name
     return [resultSeries]
@@ -774,14 +976,8 @@ def movingMedian(requestContext, seriesList, windowSize):
         newSeries.pathExpression = newName
 
         offset = len(bootstrap) - len(series)
-        for i in range(len(series)):
-            window = bootstrap[i + offset - windowPoints:i + offset]
-            nonNull = [v for v in window if v is not None]
-            if nonNull:
-                m_index = len(nonNull) / 2
-                newSeries.append(sorted(nonNull)[m_index])
-            else:
-                newSeries.append(None)
+        bounds = ((i - windowPoints, i) for i in xrange(offset, len(bootstrap)))
+        newSeries.extend(movingWindow(_MedianWindow(), list(bootstrap), bounds))
         result.append(newSeries)
 
     return result
@@ -1011,9 +1207,8 @@ def movingAverage(requestContext, seriesList, windowSize):
         newSeries.pathExpression = newName
 
         offset = len(bootstrap) - len(series)
-        for i in range(len(series)):
-            window = bootstrap[i + offset - windowPoints:i + offset]
-            newSeries.append(safeAvg(window))
+        bounds = ((i - windowPoints, i) for i in xrange(offset, len(bootstrap)))
+        newSeries.extend(movingWindow(_AverageWindow(), list(bootstrap), bounds))
 
         result.append(newSeries)
 
@@ -2155,50 +2350,15 @@ def stdev(requestContext, seriesList, points, windowTolerance=0.1):
 
     """
 
-    # For this we take the standard deviation in terms of the moving average
-    # and the moving average of series squares.
+    points = int(points)
     for (seriesIndex, series) in enumerate(seriesList):
-        stddevSeries = TimeSeries("stddev(%s,%d)" % (series.name, int(points)), series.start, series.end, series.step, [])
-        stddevSeries.pathExpression = "stddev(%s,%d)" % (series.name, int(points))
-
-        validPoints = 0
-        currentSum = 0
-        currentSumOfSquares = 0
-        for (index, newValue) in enumerate(series):
-            # Mark whether we've reached our window size - dont drop points out otherwise
-            if index < points:
-                bootstrapping = True
-                droppedValue = None
-            else:
-                bootstrapping = False
-                droppedValue = series[index - points]
-
-            # Track non-None points in window
-            if not bootstrapping and droppedValue is not None:
-                validPoints -= 1
-            if newValue is not None:
-                validPoints += 1
-
-            # Remove the value that just dropped out of the window
-            if not bootstrapping and droppedValue is not None:
-                currentSum -= droppedValue
-                currentSumOfSquares -= droppedValue**2
-
-            # Add in the value that just popped in the window
-            if newValue is not None:
-                currentSum += newValue
-                currentSumOfSquares += newValue**2
-
-            if validPoints > 0 and \
-              float(validPoints) / points >= windowTolerance:
-
-                try:
-                    deviation = math.sqrt(validPoints * currentSumOfSquares - currentSum**2) / validPoints
-                except ValueError:
-                    deviation = None
-                stddevSeries.append(deviation)
-            else:
-                stddevSeries.append(None)
+        stddevSeries = TimeSeries("stddev(%s,%d)" % (series.name, points), series.start, series.end, series.step, [])
+        stddevSeries.pathExpression = "stddev(%s,%d)" % (series.name, points)
+
+        # Windows hold the last N points, fewer while we are bootstrapping
+        values = list(series)
+        bounds = ((max(0, i + 1 - points), i + 1) for i in xrange(len(values)))
+        stddevSeries.extend(movingWindow(_StdDevWindow(points, windowTolerance), values, bounds))
 
         seriesList[seriesIndex] = stddevSeries
 
@@ -13,6 +13,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+from array import array
 from hashlib import md5
 from itertools import chain
 import bisect
@@ -28,11 +29,13 @@ def hashRequest(request):
     return compactHash(normalizedParams)
 
 
-def hashData(targets, startTime, endTime):
+def hashData(targets, startTime, endTime, maxDataPoints=None):
     targetsString = ','.join(sorted(targets))
     startTimeString = startTime.strftime("%Y%m%d_%H%M")
     endTimeString = endTime.strftime("%Y%m%d_%H%M")
     myHash = targetsString + '@' + startTimeString + ':' + endTimeString
+    if maxDataPoints:
+        myHash += '/%d' % maxDataPoints
     return compactHash(myHash)
 
 
@@ -43,12 +46,24 @@ def compactHash(string):
 
 
 class ConsistentHashRing:
-    def __init__(self, nodes, replica_count=100):
+    """Places nodes on a ring of 16-bit md5 positions, the same way carbon does.
+
+    Node positions are kept in a sorted array, the ordered list of nodes
+    reached from each position is built once, and the nodes found for up to
+    lookup_cache_size recently used keys are remembered until the ring changes.
+    """
+    def __init__(self, nodes, replica_count=100, lookup_cache_size=10000):
         self.ring = []
         self.ring_len = len(self.ring)
+        self.ring_positions = array('H')
+        self.ring_nodes = []
         self.nodes = set()
         self.nodes_len = len(self.nodes)
         self.replica_count = replica_count
+        self.lookup_cache = {}
+        self.previous_lookups = {}
+        self.lookup_cache_size = lookup_cache_size
+        self.node_sequences = {}
         for node in nodes:
             self.add_node(node)
 
@@ -65,36 +80,66 @@ class ConsistentHashRing:
             position = self.compute_ring_position(replica_key)
             entry = (position, key)
             bisect.insort(self.ring, entry)
-        self.ring_len = len(self.ring)
+        self.ring_changed()
 
     def remove_node(self, key):
         self.nodes.discard(key)
         self.nodes_len = len(self.nodes)
         self.ring = [entry for entry in self.ring if entry[1] != key]
+        self.ring_changed()
+
+    def ring_changed(self):
         self.ring_len = len(self.ring)
+        self.ring_positions = array('H', [position for (position, node) in self.ring])
+        self.ring_nodes = [node for (position, node) in self.ring]
+        self.node_sequences = {}
+        self.lookup_cache = {}
+        self.previous_lookups = {}
+
+    def get_ring_index(self, key):
+        position = self.compute_ring_position(key)
+        return bisect.bisect_left(self.ring_positions, position) % self.ring_len
 
     def get_node(self, key):
         assert self.ring
-        position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % self.ring_len
-        entry = self.ring[index]
-        return entry[1]
+        return self.ring_nodes[self.get_ring_index(key)]
 
     def get_nodes(self, key):
+        nodes = self.lookup_cache.get(key)
+        if nodes is None:
+            nodes = self.previous_lookups.get(key)
+            if nodes is None:
+                if not self.ring:
+                    return []
+                nodes = self.get_node_sequence(self.get_ring_index(key))
+            self.remember_lookup(key, nodes)
+        return list(nodes)
+
+    def remember_lookup(self, key, nodes):
+        # Two generations of plain dicts approximate an LRU at dict speed: keys
+        # not looked up again before the newer one fills up are forgotten
+        if len(self.lookup_cache) >= self.lookup_cache_size / 2:
+            self.previous_lookups = self.lookup_cache
+            self.lookup_cache = {}
+        self.lookup_cache[key] = nodes
+
+    def get_node_sequence(self, index):
+        "Returns the distinct nodes met walking the ring from index"
+        nodes = self.node_sequences.get(index)
+        if nodes is not None:
+            return nodes
+
         nodes = []
-        position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % self.ring_len
+        start_index = index
         last_index = (index - 1) % self.ring_len
         nodes_len = len(nodes)
         while nodes_len < self.nodes_len and index != last_index:
-            next_entry = self.ring[index]
-            (position, next_node) = next_entry
+            next_node = self.ring_nodes[index]
             if next_node not in nodes:
                 nodes.append(next_node)
                 nodes_len += 1
 
             index = (index + 1) % self.ring_len
 
+        nodes = self.node_sequences[start_index] = tuple(nodes)
         return nodes
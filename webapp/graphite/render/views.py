@@ -17,7 +17,6 @@ import pytz
 from datetime import datetime
 from time import time
 from random import shuffle
-from httplib import CannotSendRequest
 from urllib import urlencode
 from urlparse import urlsplit, urlunsplit
 from cgi import parse_qs
@@ -29,9 +28,10 @@ except ImportError:
 
 from graphite.compat import HttpResponse
 from graphite.util import getProfileByUsername, json, unpickle
-from graphite.remote_storage import HTTPConnectionWithTimeout
+from graphite.remote_storage import get_connection_pool
 from graphite.logger import log
 from graphite.render.evaluator import evaluateTarget
+from graphite.render.datalib import FetchCache
 from graphite.render.attime import parseATTime
 from graphite.render.functions import PieFunctions
 from graphite.render.hashing import hashRequest, hashData
@@ -55,10 +55,20 @@ def renderView(request):
       'endTime': requestOptions['endTime'],
       'localOnly': requestOptions['localOnly'],
       'template': requestOptions['template'],
-      'data': []
+      'data': [],
+      'fetchCache': FetchCache(),
     }
     data = requestContext['data']
 
+    # Line graphs are consolidated to one point per pixel and JSON to maxDataPoints,
+    # so their series can be fetched downsampled that far
+    if requestOptions['graphType'] == 'line':
+        format = requestOptions.get('format')
+        if format == 'json':
+            requestContext['maxDataPoints'] = requestOptions.get('maxDataPoints')
+        elif format not in ('csv', 'raw', 'pickle'):
+            requestContext['maxDataPoints'] = graphOptions['width']
+
     # First we check the request cache
     if useCache:
         requestKey = hashRequest(request)
@@ -81,7 +91,7 @@ def renderView(request):
                     raise ValueError("Invalid target '%s'" % target)
                 data.append((name, value))
             else:
-                seriesList = evaluateTarget(requestContext, target)
+                seriesList = evaluateTarget(requestContext, target, consolidate=True)
 
                 for series in seriesList:
                     func = PieFunctions[requestOptions['pieMode']]
@@ -93,7 +103,7 @@ def renderView(request):
             targets = requestOptions['targets']
             startTime = requestOptions['startTime']
             endTime = requestOptions['endTime']
-            dataKey = hashData(targets, startTime, endTime)
+            dataKey = hashData(targets, startTime, endTime, requestContext.get('maxDataPoints'))
             cachedData = cache.get(dataKey)
             if cachedData:
                 log.cache("Data-Cache hit [%s]" % dataKey)
@@ -109,7 +119,7 @@ def renderView(request):
                 if not target.strip():
                     continue
                 t = time()
-                seriesList = evaluateTarget(requestContext, target)
+                seriesList = evaluateTarget(requestContext, target, consolidate=True)
                 log.rendering("Retrieval of %s took %.6f" % (target, time() - t))
                 data.extend(seriesList)
 
@@ -321,9 +331,6 @@ def parseOptions(request):
     return (graphOptions, requestOptions)
 
 
-connectionPools = {}
-
-
 def delegateRendering(graphType, graphOptions):
     start = time()
     postData = graphType + '\n' + pickle.dumps(graphOptions)
@@ -332,34 +339,23 @@ def delegateRendering(graphType, graphOptions):
     for server in servers:
         start2 = time()
         try:
-            # Get a connection
-            try:
-                pool = connectionPools[server]
-            except KeyError: #happens the first time
-                pool = connectionPools[server] = set()
-            try:
-                connection = pool.pop()
-            except KeyError: #No available connections, have to make a new one
-                connection = HTTPConnectionWithTimeout(server)
-                connection.timeout = settings.REMOTE_RENDER_CONNECT_TIMEOUT
-            # Send the request
+            # Send the request and read the response
+            pool = get_connection_pool(server)
+            connection = pool.request('POST', '/render/local/', postData, timeout=settings.REMOTE_RENDER_CONNECT_TIMEOUT)
+            connection, response = pool.getresponse(connection)
             try:
-                connection.request('POST', '/render/local/', postData)
-            except CannotSendRequest:
-                connection = HTTPConnectionWithTimeout(server) #retry once
-                connection.timeout = settings.REMOTE_RENDER_CONNECT_TIMEOUT
-                connection.request('POST', '/render/local/', postData)
-            # Read the response
-            response = connection.getresponse()
-            assert response.status == 200, "Bad response code %d from %s" % (response.status, server)
-            contentType = response.getheader('Content-Type')
-            imageData = response.read()
+                assert response.status == 200, "Bad response code %d from %s" % (response.status, server)
+                contentType = response.getheader('Content-Type')
+                imageData = response.read()
+            except:
+                pool.release(connection, False)
+                raise
+            pool.release(connection)
             assert contentType == 'image/png', "Bad content type: \"%s\" from %s" % (contentType, server)
             assert imageData, "Received empty response from %s" % server
             # Wrap things up
             log.rendering('Remotely rendered image on %s in %.6f seconds' % (server, time() - start2))
             log.rendering('Spent a total of %.6f seconds doing remote rendering work' % (time() - start))
-            pool.add(connection)
             return imageData
         except:
             log.exception("Exception while attempting remote rendering request on %s" % server)
@@ -41,6 +41,7 @@ GRAPHTEMPLATES_CONF = ''
 STORAGE_DIR = ''
 WHITELIST_FILE = ''
 INDEX_FILE = ''
+OPENTSDB_INDEX_DIR = ''
 LOG_DIR = ''
 CERES_DIR = ''
 WHISPER_DIR = ''
@@ -51,15 +52,28 @@ STANDARD_DIRS = []
 CLUSTER_SERVERS = []
 OPENTSDB_CLUSTER_SERVERS = []
 REMOTE_FIND_TIMEOUT = 3.0
+OPENTSDB_FIND_TIMEOUT = 10.0
+OPENTSDB_FIND_CONCURRENCY = 8
+OPENTSDB_INDEX_REFRESH_INTERVAL = 0
+OPENTSDB_INDEX_MAX_METRICS = 1000000
+OPENTSDB_QUERY_BATCH_SIZE = 50
+OPENTSDB_FETCH_CONCURRENCY = 8
+OPENTSDB_FETCH_TIMEOUT = 30.0
+FIND_TIMEOUT = 10.0
 REMOTE_FETCH_TIMEOUT = 6.0
 REMOTE_RETRY_DELAY = 60.0
 REMOTE_EXCLUDE_LOCAL = False
 REMOTE_READER_CACHE_SIZE_LIMIT = 1000
+REMOTE_READER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+REMOTE_READER_CACHE_DURATION = 12.0
+REMOTE_POOL_MAX_CONNECTIONS = 16
+REMOTE_POOL_MAX_IDLE = 60.0
 CARBON_METRIC_PREFIX = 'carbon'
 CARBONLINK_HOSTS = ["127.0.0.1:7002"]
 CARBONLINK_TIMEOUT = 1.0
 CARBONLINK_HASHING_KEYFUNC = None
 CARBONLINK_RETRY_DELAY = 15
+CARBONLINK_PIPELINE_DEPTH = 16
 REPLICATION_FACTOR = 1
 MEMCACHE_HOSTS = []
 MEMCACHE_KEY_PREFIX = ''
@@ -72,6 +86,11 @@ LOG_CACHE_PERFORMANCE = False
 LOG_ROTATION = True
 LOG_ROTATION_COUNT = 1
 MAX_FETCH_RETRIES = 2
+FETCH_CONCURRENCY = 8
+FETCH_BACKEND_CONCURRENCY = {}
+WHISPER_HEADER_CACHE_SIZE = 10000
+WHISPER_MMAP = False
+WHISPER_GZIP_CACHE_SIZE = 64 * 1024 * 1024
 
 #Remote rendering settings
 REMOTE_RENDERING = False #if True, rendering is delegated to RENDERING_HOSTS
@@ -163,6 +182,8 @@ if not WHITELIST_FILE:
     WHITELIST_FILE = join(STORAGE_DIR, 'lists', 'whitelist')
 if not INDEX_FILE:
     INDEX_FILE = join(STORAGE_DIR, 'index')
+if not OPENTSDB_INDEX_DIR:
+    OPENTSDB_INDEX_DIR = join(STORAGE_DIR, 'opentsdb-index')
 if not LOG_DIR:
     LOG_DIR = join(STORAGE_DIR, 'log', 'webapp')
 if not WHISPER_DIR:
@@ -1,3 +1,5 @@
+import heapq
+import threading
 import time
 
 try:
@@ -15,16 +17,47 @@ from graphite.readers import MultiReader
 from graphite.logger import log
 
 
-def _get_finder(finder_path):
+def get_finder(finder_path):
     module_name, class_name = finder_path.rsplit('.', 1)
     module = import_module(module_name)
     return getattr(module, class_name)()
 
 
+class BackendFind(threading.Thread):
+    """Searches one backend on its own thread, so that every backend is searched
+    at once. Nodes are kept as they are found, so a search that runs out of
+    time still has its partial results."""
+    def __init__(self, query, deadline, finder=None, store=None):
+        self.backend = store.host if store else finder.__class__.__name__
+        threading.Thread.__init__(self, name="find %s" % self.backend)
+        self.daemon = True
+        self.query = query
+        self.finder = finder
+        self.store = store
+        self.deadline = deadline
+        self.nodes = []
+
+    def find_nodes(self):
+        if self.store:
+            return self.store.find(self.query).get_results()
+        return self.finder.find_nodes(self.query)
+
+    def run(self):
+        try:
+            for node in self.find_nodes():
+                self.nodes.append(node)
+        except:
+            log.exception("find() :: error searching %s for %s" % (self.backend, self.query))
+
+
 class Store(object):
-    def __init__(self, finders=None, hosts=None):
+    """Finds nodes in every storage backend at once: the local finders, the
+    graphite webapps in CLUSTER_SERVERS and the OpenTSDB hosts in
+    OPENTSDB_CLUSTER_SERVERS. Nodes found in several backends are merged into
+    one node per path."""
+    def __init__(self, finders=None, hosts=None, opentsdb_hosts=None):
         if finders is None:
-            finders = [_get_finder(finder_path)
+            finders = [get_finder(finder_path)
                        for finder_path in settings.STORAGE_FINDERS]
         self.finders = finders
 
@@ -36,27 +69,42 @@ class Store(object):
         ]
         self.remote_stores = [RemoteStore(host) for host in remote_hosts]
 
+        if opentsdb_hosts is None:
+            opentsdb_hosts = settings.OPENTSDB_CLUSTER_SERVERS
+        self.remote_stores += [OpenTSDBRemoteStore(host) for host in opentsdb_hosts]
+
     def find(self, pattern, start_time=None, end_time=None, local=False):
         query = FindQuery(pattern, start_time, end_time)
 
-        # Start remote searches
+        # Search every backend at once, giving up on those that don't answer in time
+        started = time.time()
+        deadline = started + settings.FIND_TIMEOUT
+        finds = [BackendFind(query, deadline, finder=finder) for finder in self.finders]
         if not local:
-            remote_requests = [r.find(query) for r in self.remote_stores if r.available]
+            finds += [BackendFind(query, min(started + r.find_timeout, deadline), store=r)
+                      for r in self.remote_stores if r.available]
+        for backend_find in finds:
+            backend_find.start()
 
         matching_nodes = set()
-
-        # Search locally
-        for finder in self.finders:
-            for node in finder.find_nodes(query):
-                log.info("find() :: local :: %s" % node)
+        timed_out = []
+        for backend_find in finds:
+            backend_find.join(max(backend_find.deadline - time.time(), 0))
+            if backend_find.is_alive():
+                timed_out.append(backend_find.backend)
+                if backend_find.store and backend_find.deadline < deadline:
+                    backend_find.store.fail()
+
+            for node in list(backend_find.nodes):
+                if backend_find.store:
+                    log.info("find() :: remote :: %s from %s" % (node, backend_find.store.host))
+                else:
+                    log.info("find() :: local :: %s" % node)
                 matching_nodes.add(node)
 
-        # Gather remote search results
-        if not local:
-            for request in remote_requests:
-                for node in request.get_results():
-                    log.info("find() :: remote :: %s from %s" % (node, request.store.host))
-                    matching_nodes.add(node)
+        if timed_out:
+            log.info("find() :: returning partial results for %s after %.3fs, %s did not finish in time" % (
+                query, time.time() - started, ', '.join(timed_out)))
 
         # Group matching nodes by their path
         nodes_by_path = {}
@@ -84,165 +132,98 @@ class Store(object):
             if not leaf_nodes:
                 continue
 
-            # Calculate best minimal node set
-            minimal_node_set = set()
-            covered_intervals = IntervalSet([])
-
-            # If the query doesn't fall entirely within the FIND_TOLERANCE window
-            # we disregard the window. This prevents unnecessary remote fetches
-            # caused when carbon's cache skews node.intervals, giving the appearance
-            # remote systems have data we don't have locally, which we probably do.
-            now = int(time.time())
-            tolerance_window = now - settings.FIND_TOLERANCE
-            disregard_tolerance_window = query.interval.start < tolerance_window
-            prior_to_window = Interval(float('-inf'), tolerance_window)
-
-            def measure_of_added_coverage(node, drop_window=disregard_tolerance_window):
-                relevant_intervals = node.intervals.intersect_interval(query.interval)
-                if drop_window:
-                    relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
-                return covered_intervals.union(relevant_intervals).size - covered_intervals.size
-
-            nodes_remaining = list(leaf_nodes)
-
-            # Prefer local nodes first (and do *not* drop the tolerance window)
-            for node in leaf_nodes:
-                if node.local and measure_of_added_coverage(node, False) > 0:
-                    nodes_remaining.remove(node)
-                    minimal_node_set.add(node)
-                    covered_intervals = covered_intervals.union(node.intervals)
-
-            while nodes_remaining:
-                node_coverages = [(measure_of_added_coverage(n), n) for n in nodes_remaining]
-                best_coverage, best_node = max(node_coverages)
-
-                if best_coverage == 0:
-                    break
-
-                nodes_remaining.remove(best_node)
-                minimal_node_set.add(best_node)
-                covered_intervals = covered_intervals.union(best_node.intervals)
-
-            # Sometimes the requested interval falls within the caching window.
-            # We include the most likely node if the gap is within tolerance.
-            if not minimal_node_set:
-                def distance_to_requested_interval(node):
-                    latest = sorted(node.intervals, key=lambda i: i.end)[-1]
-                    distance = query.interval.start - latest.end
-                    return distance if distance >= 0 else float('inf')
-
-                best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
-                if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
-                    minimal_node_set.add(best_candidate)
-
+            minimal_node_set = get_minimal_node_set(leaf_nodes, query)
             if len(minimal_node_set) == 1:
-                yield minimal_node_set.pop()
+                yield minimal_node_set[0]
             elif len(minimal_node_set) > 1:
                 reader = MultiReader(minimal_node_set)
                 yield LeafNode(path, reader)
 
 
-class OpenTSDBStore(object):
-    def __init__(self, hosts=None, local=False):
-        if hosts is None:
-            hosts = settings.OPENTSDB_CLUSTER_SERVERS
-        self.remote_stores = [OpenTSDBRemoteStore(host) for host in hosts]
-
-    def find(self, pattern, start_time=None, end_time=None, local=False):
-        query = FindQuery(pattern, start_time, end_time)
-
-        remote_requests = [r.find(query) for r in self.remote_stores if r.available]
-
-        matching_nodes = set()
-
-        # Gather remote search results
-        for request in remote_requests:
-            for node in request.get_results():
-                log.info("find() :: remote :: %s from %s" % (node, request.store.host))
-                matching_nodes.add(node)
-
-        # Group matching nodes by their path
-        nodes_by_path = {}
-        for node in matching_nodes:
-            if node.path not in nodes_by_path:
-                nodes_by_path[node.path] = []
-
-            nodes_by_path[node.path].append(node)
+def get_minimal_node_set(leaf_nodes, query):
+    """Returns the leaf nodes of one path that cover query.interval with as few
+    nodes as possible.
+
+    Local nodes that add any coverage are always used. The rest of the
+    interval is swept from start to end, and wherever it isn't covered yet the
+    node whose interval reaches furthest from there is added, so k intervals
+    take O(k log k).
+    """
+    # If the query doesn't fall entirely within the FIND_TOLERANCE window
+    # we disregard the window. This prevents unnecessary remote fetches
+    # caused when carbon's cache skews node.intervals, giving the appearance
+    # remote systems have data we don't have locally, which we probably do.
+    now = int(time.time())
+    tolerance_window = now - settings.FIND_TOLERANCE
+    disregard_tolerance_window = query.interval.start < tolerance_window
+    prior_to_window = Interval(float('-inf'), tolerance_window)
+
+    minimal_node_set = []
+    covered_intervals = IntervalSet([])
+
+    # Prefer local nodes first (and do *not* drop the tolerance window)
+    for node in leaf_nodes:
+        if node.local:
+            relevant_intervals = node.intervals.intersect_interval(query.interval)
+            if covered_intervals.union(relevant_intervals).size > covered_intervals.size:
+                minimal_node_set.append(node)
+                covered_intervals = covered_intervals.union(node.intervals)
+
+    # Intervals of the nodes already chosen cover for free, the others each cost a node
+    chosen = set(minimal_node_set)
+    segments = [(interval.start, interval.end, None) for interval in covered_intervals.intersect_interval(query.interval)]
+    for node in leaf_nodes:
+        if node in chosen:
+            continue
+        relevant_intervals = node.intervals.intersect_interval(query.interval)
+        if disregard_tolerance_window:
+            relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
+        segments.extend((interval.start, interval.end, node) for interval in relevant_intervals)
+    segments.sort(key=lambda segment: segment[0])
+
+    # Max-heaps by end of the segments that contain the cursor
+    free, paid = [], []
+    cursor = float('-inf')
+    i = 0
+    while True:
+        while i < len(segments) and segments[i][0] <= cursor:
+            start, end, node = segments[i]
+            heapq.heappush(free if node is None or node in chosen else paid, (-end, i, node))
+            i += 1
+
+        # Every segment ending at or before the cursor is behind it
+        if free and -free[0][0] <= cursor:
+            free = []
+        if paid and -paid[0][0] <= cursor:
+            paid = []
+
+        if free:
+            cursor = -free[0][0]
+        elif paid:
+            entry = heapq.heappop(paid)
+            node = entry[2]
+            if node not in chosen:
+                chosen.add(node)
+                minimal_node_set.append(node)
+            heapq.heappush(free, entry)
+        elif i < len(segments):
+            cursor = segments[i][0]
+        else:
+            break
 
-        # Reduce matching nodes for each path to a minimal set
-        found_branch_nodes = set()
+    # Sometimes the requested interval falls within the caching window.
+    # We include the most likely node if the gap is within tolerance.
+    if not minimal_node_set:
+        def distance_to_requested_interval(node):
+            latest = max(node.intervals, key=lambda i: i.end)
+            distance = query.interval.start - latest.end
+            return distance if distance >= 0 else float('inf')
 
-        for path, nodes in nodes_by_path.iteritems():
-            leaf_nodes = []
-            log.info("OpenTSDBStore:find path %s, leaf_nodes %s" % (path, nodes))
-            # First we dispense with the BranchNodes
-            for node in nodes:
-                if node.is_leaf:
-                    leaf_nodes.append(node)
-                # TODO need to filter branch nodes based on requested interval... how?!?!?
-                elif node.path not in found_branch_nodes:
-                    yield node
-                    found_branch_nodes.add(node.path)
-
-            if not leaf_nodes:
-                continue
+        best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
+        if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
+            minimal_node_set.append(best_candidate)
 
-            # Calculate best minimal node set
-            minimal_node_set = set()
-            covered_intervals = IntervalSet([])
-
-            # If the query doesn't fall entirely within the FIND_TOLERANCE window
-            # we disregard the window. This prevents unnecessary remote fetches
-            # caused when carbon's cache skews node.intervals, giving the appearance
-            # remote systems have data we don't have locally, which we probably do.
-            now = int(time.time())
-            tolerance_window = now - settings.FIND_TOLERANCE
-            disregard_tolerance_window = query.interval.start < tolerance_window
-            prior_to_window = Interval(float('-inf'), tolerance_window)
-
-            def measure_of_added_coverage(node, drop_window=disregard_tolerance_window):
-                relevant_intervals = node.intervals.intersect_interval(query.interval)
-                if drop_window:
-                    relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
-                return covered_intervals.union(relevant_intervals).size - covered_intervals.size
-
-            nodes_remaining = list(leaf_nodes)
-
-            # Prefer local nodes first (and do *not* drop the tolerance window)
-            for node in leaf_nodes:
-                if node.local and measure_of_added_coverage(node, False) > 0:
-                    nodes_remaining.remove(node)
-                    minimal_node_set.add(node)
-                    covered_intervals = covered_intervals.union(node.intervals)
-
-            while nodes_remaining:
-                node_coverages = [(measure_of_added_coverage(n), n) for n in nodes_remaining]
-                best_coverage, best_node = max(node_coverages)
-
-                if best_coverage == 0:
-                    break
-
-                nodes_remaining.remove(best_node)
-                minimal_node_set.add(best_node)
-                covered_intervals = covered_intervals.union(best_node.intervals)
-
-            # Sometimes the requested interval falls within the caching window.
-            # We include the most likely node if the gap is within tolerance.
-            if not minimal_node_set:
-                def distance_to_requested_interval(node):
-                    latest = sorted(node.intervals, key=lambda i: i.end)[-1]
-                    distance = query.interval.start - latest.end
-                    return distance if distance >= 0 else float('inf')
-
-                best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
-                if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
-                    minimal_node_set.add(best_candidate)
-            log.info("OpenTSDBStore:find " + str(minimal_node_set))
-            if len(minimal_node_set) == 1:
-                yield minimal_node_set.pop()
-            elif len(minimal_node_set) > 1:
-                reader = MultiReader(minimal_node_set)
-                yield LeafNode(path, reader)
+    return minimal_node_set
 
 
 class FindQuery(object):
@@ -269,4 +250,3 @@ class FindQuery(object):
         return '<FindQuery: %s from %s until %s>' % (self.pattern, start_string, end_string)
 
 STORE = Store()
-OPENTSDB_STORE = OpenTSDBStore()
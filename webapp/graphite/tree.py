@@ -1,18 +1,43 @@
 __doc__ = """
 
-Contains implementation of OpenTSDB tree which helps browse metrics space.
+Contains implementation of OpenTSDB tree which helps browse metrics space,
+and of a local index of OpenTSDB metric names that answers finds without it.
 
 """
 
+import fnmatch
+import os
 import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from os.path import dirname, exists, join
+from tempfile import mkstemp
+from Queue import Queue, Empty
+
+from django.conf import settings
+from django.core.cache import cache
 
 from graphite.logger import log
+from graphite import opentsdb
+from graphite.opentsdb import ROOT_BRANCH_ID
 
 ANY_PATTERN = '.*'
 
 
+def is_literal(part):
+    return not re.search(r'[*?\[\]{}]', part)
+
+
 class OpenTSDBMetricsMeta(object):
-    """Metrics tree."""
+    """Metrics tree.
+
+    Branches are cached by id for FIND_CACHE_DURATION seconds, and the ones
+    of a level that aren't cached are requested concurrently. The id of the
+    branch at the end of the literal prefix of a path is cached too, so that
+    finds under it start from there rather than from the root.
+    """
     def __init__(self, api):
         self.api = api
 
@@ -24,15 +49,69 @@ class OpenTSDBMetricsMeta(object):
     def _branch_current_node_name(self, branch):
         return branch['path'][str(branch['depth'])]
 
+    def _branch_cache_key(self, branch_id):
+        return 'opentsdb-branch:%s:%s' % (self.api.host, branch_id)
+
+    def _branch_id_cache_key(self, path):
+        return 'opentsdb-branch-id:%s:%s' % (self.api.host, path)
+
+    def get_branches(self, branch_ids):
+        "Returns the branches with the given ids, in order"
+        keys = [self._branch_cache_key(branch_id) for branch_id in branch_ids]
+        branches = cache.get_many(keys)
+        missing = [(key, branch_id) for key, branch_id in zip(keys, branch_ids) if key not in branches]
+        if missing:
+            fetched = self._fetch_branches(missing)
+            cache.set_many(fetched, settings.FIND_CACHE_DURATION)
+            branches.update(fetched)
+        return [branches[key] for key in keys]
+
+    def _fetch_branches(self, missing):
+        "Requests branches on up to OPENTSDB_FIND_CONCURRENCY threads at once"
+        if len(missing) == 1:
+            key, branch_id = missing[0]
+            return {key: self.api.branch(branch_id=branch_id)}
+
+        queue = Queue()
+        for item in missing:
+            queue.put(item)
+        fetched = {}
+        errors = []
+
+        def fetch():
+            while not errors:
+                try:
+                    key, branch_id = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    fetched[key] = self.api.branch(branch_id=branch_id)
+                except:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=fetch, name="opentsdb branches %s" % self.api.host)
+                   for i in range(min(len(missing), settings.OPENTSDB_FIND_CONCURRENCY))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return fetched
+
     def find(self, path):
-        """path is a dot separated metric prefix.
+        """path is a dot separated graphite pattern.
 
-        Returns children of a node with given path.
+        Returns the nodes matching it, like the other finders and
+        OpenTSDBMetricIndex.find.
 
         """
         log.info("OpenTSDBMetricsMeta.find(%s)" % path)
+        parts = path.split('.')
         node_names = []
-        for part in path.split('.'):
+        for part in parts:
             part = part.replace('*', ANY_PATTERN)
             part = re.sub(
                 r'{([^{]*)}',
@@ -41,60 +120,227 @@ class OpenTSDBMetricsMeta(object):
             )
             node_names.append(part)
 
-        if node_names[-1] == ANY_PATTERN:
-            node_names.pop()
-
-        query_part_regexps = []
-        for part in node_names:
-            query_part_regexps.append(re.compile(part))
-        log.info("PATH: " + str(node_names))
-        current_branches = [self.api.branch()]
-        depth = 0
-        leaves = []
-        for node_regexp in query_part_regexps:
-            log.info("Node: " + str(node_regexp))
-            log.info("Cur branch: " + str(current_branches))
-            next_branch_ids = []
+        # Literal parts are matched by name, the others with anchored regexps
+        node_matchers = []
+        for part, node_name in zip(parts, node_names):
+            if is_literal(part):
+                node_matchers.append(part.__eq__)
+            else:
+                node_matchers.append(re.compile(node_name + '$').match)
+
+        # Skip the levels of the literal prefix when the id of its branch is
+        # known, down to the parent of the last level at most
+        prefix_depth = 0
+        while prefix_depth < len(node_matchers) - 1 and is_literal(parts[prefix_depth]):
+            prefix_depth += 1
+        prefix_id_key = self._branch_id_cache_key('.'.join(parts[:prefix_depth]))
+        prefix_id = cache.get(prefix_id_key) if prefix_depth else None
+
+        if prefix_id:
+            current_branches = self.get_branches([prefix_id])
+            depth = prefix_depth
+        else:
+            current_branches = self.get_branches([ROOT_BRANCH_ID])
+            depth = 0
+        log.info("PATH: %s, starting at depth %d" % (node_names, depth))
+
+        for node_matcher in node_matchers[depth:-1]:
             depth += 1
-            # leaves should be at the end of the path
-            leaves = []
+            next_branch_ids = []
             for current_branch in current_branches:
                 for branch in current_branch['branches'] or []:
-                    if node_regexp.match(self._branch_current_node_name(branch)):
+                    if node_matcher(self._branch_current_node_name(branch)):
                         next_branch_ids.append(branch['branchId'])
-                for leaf in current_branch['leaves'] or []:
-                    if node_regexp.match(leaf['displayName']):
-                        leaves.append(leaf)
-            log.info("next_branch_ids: " + str(next_branch_ids))
+            log.info("depth %d, next_branch_ids: %s" % (depth, next_branch_ids))
 
-            current_branches = []
+            if depth == prefix_depth and len(next_branch_ids) == 1:
+                cache.set(prefix_id_key, next_branch_ids[0], settings.FIND_CACHE_DURATION)
+            current_branches = self.get_branches(next_branch_ids)
 
-            for next_branch_id in next_branch_ids:
-                current_branches.append(self.api.branch(branch_id=next_branch_id))
-
-        log.info("CURRENT BRANCHES: %s" % current_branches)
+        # The last level matches both the branches and the leaves of its parents
+        node_matcher = node_matchers[-1]
         result = []
         for current_branch in current_branches:
             for branch in current_branch['branches'] or []:
-                result.append(
-                    {
-                        "metric_path": self._branch_current_path(branch),
-                        "isLeaf": False
-                    }
-                )
+                if node_matcher(self._branch_current_node_name(branch)):
+                    result.append(
+                        {
+                            "metric_path": self._branch_current_path(branch),
+                            "isLeaf": False
+                        }
+                    )
             for leaf in current_branch['leaves'] or []:
-                result.append(
-                    {
-                        "metric_path": leaf['metric'],
-                        "isLeaf": True
-                    }
-                )
-        for leaf in leaves:
-            log.info("LEAF: " + str(leaf))
-            result.append(
-                {
-                    "metric_path": leaf["metric"],
-                    "isLeaf": True
-                }
-            )
+                if node_matcher(leaf['displayName']):
+                    result.append(
+                        {
+                            "metric_path": leaf['metric'],
+                            "isLeaf": True
+                        }
+                    )
+        return result
+
+
+class OpenTSDBMetricIndex(object):
+    """Sorted list of the names of every metric of an OpenTSDB server.
+
+    The list is requested from the suggest API by a background thread every
+    OPENTSDB_INDEX_REFRESH_INTERVAL seconds, and saved as a sorted text file,
+    one name per line, which is loaded again on startup. Finds are answered
+    from the list alone: the literal prefix of the pattern is located by
+    bisection, and every node matched skips the names under it in one more.
+    """
+    def __init__(self, api, path):
+        self.api = api
+        self.path = path
+        self.names = None
+        self.thread = None
+
+    def load(self):
+        if not exists(self.path):
+            return
+        with open(self.path) as index_file:
+            names = [line.rstrip('\n') for line in index_file]
+        names.sort()
+        self.names = names
+        log.info("OpenTSDBMetricIndex: loaded %d metric names of %s from %s" % (len(names), self.api.host, self.path))
+
+    def save(self, names):
+        index_dir = dirname(self.path)
+        if not exists(index_dir):
+            os.makedirs(index_dir)
+        fd, tmp = mkstemp(dir=index_dir)
+        try:
+            with os.fdopen(fd, 'w') as tmp_index:
+                for name in names:
+                    tmp_index.write(name + '\n')
+            os.rename(tmp, self.path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def refresh(self):
+        t = time.time()
+        max_results = settings.OPENTSDB_INDEX_MAX_METRICS
+        names = self.api.suggest_metrics(max_results=max_results)
+        if len(names) >= max_results:
+            log.warning("OpenTSDBMetricIndex: %s has more than OPENTSDB_INDEX_MAX_METRICS metrics, the index is incomplete" % self.api.host)
+        names = sorted(set(name.encode('utf-8') for name in names))
+
+        old_names = self.names
+        if names == old_names:
+            return
+        self.names = names
+        if old_names is not None:
+            old_names = set(old_names)
+            added = sum(1 for name in names if name not in old_names)
+            removed = len(old_names) - (len(names) - added)
+        else:
+            added, removed = len(names), 0
+
+        try:
+            self.save(names)
+        except:
+            log.exception("OpenTSDBMetricIndex: could not save the index of %s to %s" % (self.api.host, self.path))
+        log.info("OpenTSDBMetricIndex: refreshed the index of %s in %.6f seconds (%d names, %d added, %d removed)" % (
+            self.api.host, time.time() - t, len(names), added, removed))
+
+    def run(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except:
+                log.exception("OpenTSDBMetricIndex: could not refresh the index of %s" % self.api.host)
+            time.sleep(interval)
+
+    def start(self, interval):
+        self.thread = threading.Thread(target=self.run, args=(interval,), name="opentsdb index %s" % self.api.host)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def find(self, pattern):
+        """Returns the nodes matching a graphite pattern, like
+        OpenTSDBMetricsMeta.find, or None if the index isn't loaded yet."""
+        names = self.names
+        if names is None:
+            return None
+
+        parts = pattern.split('.')
+        depth = len(parts)
+        prefix_depth = 0
+        while prefix_depth < depth and is_literal(parts[prefix_depth]):
+            prefix_depth += 1
+        matchers = [compile_glob(part) for part in parts[prefix_depth:]]
+
+        result = []
+        if prefix_depth == depth:
+            i = bisect_left(names, pattern)
+            if i < len(names) and names[i] == pattern:
+                result.append({"metric_path": pattern, "isLeaf": True})
+            i = bisect_left(names, pattern + '.', i)
+            if i < len(names) and names[i].startswith(pattern + '.'):
+                result.append({"metric_path": pattern, "isLeaf": False})
+            return result
+
+        # Matching names all start with the literal parts and the literal start of the next one
+        prefix = '.'.join(parts[:prefix_depth] + [re.match(r'[^*?\[{]*', parts[prefix_depth]).group()])
+        i = bisect_left(names, prefix)
+        while i < len(names):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            name_parts = name.split('.')
+            if len(name_parts) < depth:
+                i += 1
+                continue
+
+            for level, matcher in enumerate(matchers, prefix_depth):
+                if not matcher(name_parts[level]):
+                    break
+            else:
+                level = depth
+
+            node = '.'.join(name_parts[:level + 1 if level < depth else depth])
+            if name == node:
+                if level == depth:
+                    result.append({"metric_path": node, "isLeaf": True})
+                i += 1
+            else:
+                if level == depth:
+                    result.append({"metric_path": node, "isLeaf": False})
+                # Names under the same node are all next to each other, skip them
+                i = bisect_left(names, node + '/', i)
         return result
+
+
+def compile_glob(pattern):
+    "Returns a function matching one node name against a graphite glob, as in match_entries"
+    if is_literal(pattern):
+        return pattern.__eq__
+    v1, v2 = pattern.find('{'), pattern.find('}')
+    if v1 > -1 and v2 > v1:
+        variants = [pattern[:v1] + v + pattern[v2 + 1:] for v in pattern[v1 + 1:v2].split(',')]
+    else:
+        variants = [pattern]
+    regex = re.compile('(?:%s)$' % '|'.join(fnmatch.translate(variant)[:-len('\\Z(?ms)')] for variant in variants))
+    return regex.match
+
+
+metric_indexes = {}
+metric_indexes_lock = threading.Lock()
+
+
+def get_metric_index(host):
+    "Returns the local index of the metric names of an OpenTSDB server, or None if they aren't indexed"
+    if settings.OPENTSDB_INDEX_REFRESH_INTERVAL <= 0:
+        return None
+    with metric_indexes_lock:
+        index = metric_indexes.get(host)
+        if index is None:
+            path = join(settings.OPENTSDB_INDEX_DIR, host.replace(':', '_'))
+            index = metric_indexes[host] = OpenTSDBMetricIndex(opentsdb.API(host, settings.OPENTSDB_FIND_TIMEOUT), path)
+            try:
+                index.load()
+            except:
+                log.exception("OpenTSDBMetricIndex: could not load the index of %s from %s" % (host, path))
+            index.start(settings.OPENTSDB_INDEX_REFRESH_INTERVAL)
+        return index
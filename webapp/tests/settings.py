@@ -48,5 +48,6 @@ os.mkdir(WHISPER_DIR)
 STANDARD_DIRS = [WHISPER_DIR]
 
 INDEX_FILE = os.path.join(TEMP_GRAPHITE_DIR, 'index')
+OPENTSDB_INDEX_DIR = os.path.join(TEMP_GRAPHITE_DIR, 'opentsdb-index')
 
 URL_PREFIX = '/graphite'
@@ -0,0 +1,233 @@
+import os
+import shutil
+import socket
+import SocketServer
+import struct
+import tempfile
+import threading
+import time
+
+import whisper
+from django.conf import settings
+from django.test import TestCase
+from mock import patch
+
+from graphite.carbonlink import CarbonLinkPool, RequestPipeline, recv_exactly, serialize_request
+from graphite.readers import WhisperReader, prefetch_carbonlink
+from graphite.util import unpickle
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class FakeNode(object):
+    def __init__(self, reader):
+        self.reader = reader
+
+
+class CarbonCacheHandler(SocketServer.BaseRequestHandler):
+    "Answers cache-query requests like carbon-cache, holding back the answer if the metric asks it to"
+    def handle(self):
+        while True:
+            try:
+                len_prefix = recv_exactly(self.request, 4)
+            except Exception:
+                return
+            request = unpickle.loads(recv_exactly(self.request, struct.unpack("!L", len_prefix)[0]))
+            self.server.requests.append(request)
+            if request['metric'].startswith('slow.'):
+                self.server.unblocked.wait(5)
+            datapoints = [(60, self.server.server_address[1])]
+            if request['metric'].startswith('big.'):
+                datapoints *= 100000
+            response = pickle.dumps(dict(datapoints=datapoints), protocol=-1)
+            self.request.sendall(struct.pack("!L", len(response)) + response)
+
+
+class CarbonCacheServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), CarbonCacheHandler)
+        self.requests = []
+        self.unblocked = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class CarbonLinkPipelineTest(TestCase):
+    def setUp(self):
+        self.servers = [CarbonCacheServer(), CarbonCacheServer()]
+        hosts = [('127.0.0.1', server.server_address[1], str(i)) for i, server in enumerate(self.servers)]
+        self.pool = CarbonLinkPool(hosts, 0.2)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.unblocked.set()
+            server.shutdown()
+            server.server_close()
+
+    def test_send_requests(self):
+        requests = [(host, dict(type='cache-query', metric='test.%d' % i))
+                    for i in range(40) for host in self.pool.hosts]
+        with self.settings(CARBONLINK_PIPELINE_DEPTH=4):
+            results = self.pool.send_requests(requests)
+
+        self.assertEqual(results, [dict(datapoints=[(60, self.pool.ports[host])]) for host, request in requests])
+        for server in self.servers:
+            self.assertEqual([r['metric'] for r in server.requests], ['test.%d' % i for i in range(40)])
+        self.assertEqual([len(self.pool.connections[host]) for host in self.pool.hosts], [1, 1])
+
+    def test_send_requests_timeout(self):
+        fast, slow = self.pool.hosts
+        requests = [(fast, dict(type='cache-query', metric='test')),
+                    (slow, dict(type='cache-query', metric='slow.test'))]
+        results = self.pool.send_requests(requests)
+
+        self.assertEqual(results[0], dict(datapoints=[(60, self.pool.ports[fast])]))
+        self.assertTrue(isinstance(results[1], socket.timeout))
+        self.assertTrue(slow in self.pool.last_failure)
+        self.assertFalse(self.pool.connections[slow])
+
+    def test_send_requests_large_responses(self):
+        host = self.pool.hosts[0]
+        requests = [(host, dict(type='cache-query', metric=metric)) for metric in ('big.0', 'test', 'big.1')]
+        results = self.pool.send_requests(requests)
+
+        datapoints = [(60, self.pool.ports[host])]
+        self.assertEqual(results, [dict(datapoints=datapoints * 100000), dict(datapoints=datapoints),
+                                   dict(datapoints=datapoints * 100000)])
+
+    def test_serialize_request(self):
+        packet = serialize_request(dict(type='cache-query', metric='test'))
+        self.assertEqual(struct.unpack("!L", packet[:4])[0], len(packet) - 4)
+        self.assertEqual(unpickle.loads(packet[4:]), dict(type='cache-query', metric='test'))
+
+
+class TrickleSocket(object):
+    "Hands out data a few bytes per recv_into call"
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.offset = 0
+        self.chunk_size = chunk_size
+
+    def recv_into(self, buf, nbytes=0):
+        size = min(self.chunk_size, nbytes or len(buf), len(self.data) - self.offset)
+        buf[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+class ReceiveBufferTest(TestCase):
+    requests = [dict(type='cache-query', metric='test.%d' % i, padding='x' * (i * 5000)) for i in range(30)]
+
+    def test_recv_exactly(self):
+        conn = TrickleSocket(serialize_request(self.requests[1]), 7)
+        body_size = struct.unpack_from("!L", recv_exactly(conn, 4))[0]
+        self.assertEqual(unpickle.loads(recv_exactly(conn, body_size)), self.requests[1])
+        self.assertRaises(Exception, recv_exactly, conn, 1)
+
+    def test_pipeline_responses(self):
+        for chunk_size in (1000, 65537, 200000):
+            conn = TrickleSocket(''.join(serialize_request(r) for r in self.requests), chunk_size)
+            pipeline = RequestPipeline(None, [], [])
+            responses = []
+            while pipeline.recv(conn):
+                responses.extend(unpickle.loads(body) for body in pipeline.responses())
+            self.assertEqual(responses, self.requests)
+            self.assertEqual(pipeline.inbox_start, pipeline.inbox_end)
+
+
+class CarbonLinkBulkQueryTest(TestCase):
+    hosts = [('127.0.0.1', 7002, 'a'), ('127.0.0.1', 7102, 'b')]
+    timestamps = {'a': 60, 'b': 120}
+
+    def setUp(self):
+        self.pool = CarbonLinkPool(self.hosts, 1)
+        self.requests = []
+
+    def datapoints(self, host):
+        return [(self.timestamps[host[1]], 1.0)]
+
+    def send_requests(self, requests):
+        self.requests.extend(requests)
+        return [dict(datapointsByMetric=dict((metric, self.datapoints(host)) for metric in request['metrics']))
+                for host, request in requests]
+
+    def test_query_bulk(self):
+        metrics = ['collectd.test-db%d.load.value' % i for i in range(20)]
+        with patch.object(self.pool, 'send_requests', self.send_requests):
+            results = self.pool.query_bulk(metrics)
+
+        self.assertTrue(1 <= len(self.requests) <= 2)
+        self.assertTrue(all(request['type'] == 'cache-query-bulk' for host, request in self.requests))
+        for metric in metrics:
+            host = self.pool.select_host(metric)
+            self.assertEqual(results[metric], self.datapoints(host))
+
+    def test_query_bulk_carbon_metrics(self):
+        metric = 'carbon.agents.a.cache.size'
+        with patch.object(self.pool, 'send_requests', self.send_requests):
+            results = self.pool.query_bulk([metric])
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(results[metric], {60: 1.0, 120: 1.0})
+
+    def test_query_bulk_unsupported(self):
+        def send_requests(requests):
+            self.requests.extend(r for r in requests if r[1]['type'] == 'cache-query-bulk')
+            return [dict(error='Invalid request type "cache-query-bulk"') if request['type'] == 'cache-query-bulk'
+                    else dict(datapoints=[(60, 1.0)]) for host, request in requests]
+
+        metric = 'collectd.test-db.load.value'
+        with patch.object(self.pool, 'send_requests', send_requests):
+            self.assertEqual(self.pool.query_bulk([metric]), {metric: [(60, 1.0)]})
+            self.assertEqual(self.pool.query_bulk([metric]), {metric: [(60, 1.0)]})
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.pool.bulk_unsupported.keys(), [self.requests[0][0]])
+
+        # The host is asked with cache-query-bulk again after CARBONLINK_RETRY_DELAY
+        with patch.object(self.pool, 'send_requests', send_requests):
+            with patch('time.time', return_value=time.time() + settings.CARBONLINK_RETRY_DELAY):
+                self.assertEqual(self.pool.query_bulk([metric]), {metric: [(60, 1.0)]})
+        self.assertEqual(len(self.requests), 2)
+
+    def test_query_bulk_failed_host(self):
+        def send_requests(requests):
+            return [Exception("Connection refused") for request in requests]
+
+        metric = 'collectd.test-db.load.value'
+        with patch.object(self.pool, 'send_requests', send_requests):
+            self.assertEqual(self.pool.query_bulk([metric]), {metric: []})
+
+    def test_prefetch_carbonlink(self):
+        whisper_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, whisper_dir)
+        readers = []
+        for i in range(3):
+            fs_path = os.path.join(whisper_dir, '%d.wsp' % i)
+            whisper.create(fs_path, [(60, 1440), (3600, 168)])
+            readers.append(WhisperReader(fs_path, 'collectd.test-db%d.load.value' % i))
+        results = dict((reader.real_metric_path, [(60, i)]) for i, reader in enumerate(readers))
+        now = time.time()
+
+        # Fetches past the first archive don't merge carbon's cache
+        with patch('graphite.readers.CarbonLink.query_bulk', return_value=results) as query_bulk:
+            prefetch_carbonlink([FakeNode(reader) for reader in readers], now - 2 * 86400)
+        self.assertEqual(query_bulk.call_count, 0)
+
+        with patch('graphite.readers.CarbonLink.query_bulk', return_value=results) as query_bulk:
+            prefetch_carbonlink([FakeNode(reader) for reader in readers], now - 3600)
+
+        self.assertEqual(query_bulk.call_count, 1)
+        self.assertEqual([reader.cached_datapoints for reader in readers], [[(60, i)] for i in range(3)])
+
+        # Readers still holding prefetched points aren't queried again
+        with patch('graphite.readers.CarbonLink.query_bulk', return_value=results) as query_bulk:
+            prefetch_carbonlink([FakeNode(reader) for reader in readers], now - 3600)
+        self.assertEqual(query_bulk.call_count, 0)
@@ -0,0 +1,299 @@
+import threading
+from datetime import datetime
+
+import pytz
+
+from django.test import TestCase
+from mock import Mock, patch
+
+from graphite.readers import FetchInProgress
+from graphite.render.datalib import FetchCache, FetchExecutor, TimeSeries, fetchData
+
+
+class TimeSeriesTest(TestCase):
+    values = [1, None, 3, None, None, None, 4, 5, 6, 2]
+
+    def consolidated(self, func, valuesPerPoint):
+        series = TimeSeries('collectd.test-db.load.value', 0, 10, 1, self.values, consolidate=func)
+        series.consolidate(valuesPerPoint)
+        return list(series)
+
+    def assertConsolidation(self, func, valuesPerPoint, expected):
+        self.assertEqual(self.consolidated(func, valuesPerPoint), expected)
+        with patch('graphite.render.datalib.numpy', False):
+            self.assertEqual(self.consolidated(func, valuesPerPoint), expected)
+
+    def test_no_consolidation(self):
+        self.assertConsolidation('average', 1, self.values)
+
+    def test_consolidate_average(self):
+        self.assertConsolidation('average', 3, [2.0, None, 5.0, 2.0])
+
+    def test_consolidate_sum(self):
+        self.assertConsolidation('sum', 3, [4, None, 15, 2])
+
+    def test_consolidate_min(self):
+        self.assertConsolidation('min', 3, [1, None, 4, 2])
+
+    def test_consolidate_max(self):
+        self.assertConsolidation('max', 4, [3, 5, 6])
+
+    def test_consolidate_complete_buckets(self):
+        self.assertConsolidation('sum', 5, [4, 17, None])
+
+    def test_consolidate_invalid_function(self):
+        self.assertRaises(Exception, self.consolidated, 'median', 2)
+        with patch('graphite.render.datalib.numpy', False):
+            self.assertRaises(Exception, self.consolidated, 'median', 2)
+
+
+class FetchCacheTest(TestCase):
+    def setUp(self):
+        self.fetches = []
+        self.step = 10
+
+    def fetchRange(self, startTime, endTime, downsample=None):
+        # Aligns like whisper and stores each point's timestamp as its value
+        self.fetches.append((startTime, endTime))
+        step = downsample[0] if downsample else self.step
+        start = startTime - (startTime % step) + step
+        end = endTime - (endTime % step) + step
+        series = TimeSeries('collectd.test-db.load.value', start, end, step, range(start, end, step))
+        series.pathExpression = 'collectd.test-db.*.value'
+        return [series], downsample
+
+    def fetch(self, fetchCache, startTime, endTime, downsample=None):
+        return fetchCache.fetch('collectd.test-db.*.value', startTime, endTime, self.fetchRange, downsample)
+
+    def assertSeries(self, seriesList, startTime, endTime):
+        expected = self.fetchRange(startTime, endTime)[0]
+        self.fetches.pop()
+        self.assertEqual(len(seriesList), 1)
+        for attr in ('name', 'start', 'end', 'step', 'pathExpression'):
+            self.assertEqual(getattr(seriesList[0], attr), getattr(expected[0], attr))
+        self.assertEqual(list(seriesList[0]), list(expected[0]))
+
+    def test_repeated_fetch(self):
+        fetchCache = FetchCache()
+        first = self.fetch(fetchCache, 1000, 2000)
+        second = self.fetch(fetchCache, 1000, 2000)
+        self.assertEqual(self.fetches, [(1000, 2000)])
+        self.assertSeries(second, 1000, 2000)
+        self.assertFalse(first[0] is second[0])
+
+        second[0][0] = None
+        self.assertSeries(self.fetch(fetchCache, 1000, 2000), 1000, 2000)
+
+    def test_contained_fetch(self):
+        fetchCache = FetchCache()
+        self.fetch(fetchCache, 1000, 2000)
+        self.assertSeries(self.fetch(fetchCache, 1000, 1500), 1000, 1500)
+        self.assertEqual(self.fetches, [(1000, 2000)])
+
+        # A range starting later may be stored at a finer step, until a fetch shows it isn't
+        self.assertSeries(self.fetch(fetchCache, 1205, 1500), 1205, 1500)
+        self.assertSeries(self.fetch(fetchCache, 1100, 1800), 1100, 1800)
+        self.assertEqual(self.fetches, [(1000, 2000), (1205, 1500)])
+
+    def test_contained_fetch_with_finer_step(self):
+        fetchCache = FetchCache()
+        self.step = 60
+        self.fetch(fetchCache, 1000, 2000)
+        self.step = 10
+        self.assertSeries(self.fetch(fetchCache, 1500, 2000), 1500, 2000)
+        self.assertEqual(self.fetches, [(1000, 2000), (1500, 2000)])
+
+    def test_overlapping_fetch(self):
+        fetchCache = FetchCache()
+        self.fetch(fetchCache, 1000, 2000)
+        self.assertSeries(self.fetch(fetchCache, 500, 2500), 500, 2500)
+        self.assertEqual(self.fetches, [(1000, 2000), (500, 1000), (2000, 2500)])
+
+        self.assertSeries(self.fetch(fetchCache, 600, 700), 600, 700)
+        self.assertEqual(len(self.fetches), 3)
+
+    def test_overlapping_fetch_with_different_step(self):
+        fetchCache = FetchCache()
+        self.fetch(fetchCache, 1000, 2000)
+        self.step = 60
+        self.assertSeries(self.fetch(fetchCache, 500, 1500), 500, 1500)
+        self.assertEqual(self.fetches, [(1000, 2000), (500, 1000), (500, 1500)])
+
+    def test_disjoint_fetch(self):
+        fetchCache = FetchCache()
+        self.fetch(fetchCache, 1000, 2000)
+        self.assertSeries(self.fetch(fetchCache, 3000, 4000), 3000, 4000)
+        self.fetch(fetchCache, 1000, 1200)
+        self.fetch(fetchCache, 3000, 3200)
+        self.assertEqual(self.fetches, [(1000, 2000), (3000, 4000)])
+
+    def test_downsampled_fetch(self):
+        fetchCache = FetchCache()
+        self.fetch(fetchCache, 1000, 2000, (100, 'max'))
+        self.assertEqual(self.fetch(fetchCache, 1000, 2000, (100, 'max'))[0].step, 100)
+        self.assertEqual(self.fetch(fetchCache, 1000, 2000, (100, 'sum'))[0].step, 100)
+        self.assertSeries(self.fetch(fetchCache, 1000, 2000), 1000, 2000)
+        self.assertEqual(len(self.fetches), 3)
+
+        # Full resolution series serve downsampled fetches
+        self.assertSeries(self.fetch(fetchCache, 1000, 1500, (50, 'average')), 1000, 1500)
+        self.assertEqual(len(self.fetches), 3)
+
+
+class SlowReader(object):
+    def __init__(self, tracker, value):
+        self.tracker = tracker
+        self.value = value
+
+    def fetch(self, startTime, endTime):
+        with self.tracker['lock']:
+            self.tracker['running'] += 1
+            self.tracker['peak'] = max(self.tracker['peak'], self.tracker['running'])
+            if self.tracker['running'] >= self.tracker['target']:
+                self.tracker['reached'].set()
+        # Hold the fetch open until the expected number of fetches overlap
+        self.tracker['reached'].wait(5)
+        with self.tracker['lock']:
+            self.tracker['running'] -= 1
+        if self.value is None:
+            raise Exception("fetch failed")
+        return FetchInProgress(lambda: ((startTime, endTime, 1), [self.value]))
+
+
+class OtherReader(SlowReader):
+    pass
+
+
+class BatchReader(SlowReader):
+    batch_key = 'batch'
+
+    @classmethod
+    def fetch_many(cls, nodes, startTime, endTime):
+        nodes[0].reader.tracker['batches'].append([node.reader.value for node in nodes])
+        return [node.fetch(startTime, endTime) for node in nodes]
+
+
+class UnbatchedReader(BatchReader):
+    "Has a fetch_many that doesn't fetch in bulk, so its nodes are fetched one by one"
+    batch_key = None
+
+
+class DownsamplingReader(BatchReader):
+    supports_downsample = True
+
+    @classmethod
+    def fetch_many(cls, nodes, startTime, endTime, downsample=None):
+        nodes[0].reader.tracker['downsample'].append(downsample)
+        return BatchReader.fetch_many.im_func(cls, nodes, startTime, endTime)
+
+
+class FakeLeafNode(object):
+    is_leaf = True
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.path = 'hosts.worker%s.cpu' % reader.value
+
+    def fetch(self, startTime, endTime):
+        return self.reader.fetch(startTime, endTime)
+
+
+class FetchExecutorTest(TestCase):
+    def setUp(self):
+        self.tracker = {'lock': threading.Lock(), 'running': 0, 'peak': 0, 'target': 1,
+                        'reached': threading.Event(), 'batches': [], 'downsample': []}
+
+    def nodes(self, values, readerClass=SlowReader):
+        return [FakeLeafNode(readerClass(self.tracker, value)) for value in values]
+
+    def test_serial_fetch(self):
+        results = FetchExecutor(1, {}).fetchAll(self.nodes(range(5)), 0, 1)
+        self.assertEqual(results, [((0, 1, 1), [i]) for i in range(5)])
+        self.assertEqual(self.tracker['peak'], 1)
+
+    def test_concurrent_fetch(self):
+        self.tracker['target'] = 4
+        results = FetchExecutor(4, {}).fetchAll(self.nodes(range(20)), 0, 1)
+        self.assertEqual(results, [((0, 1, 1), [i]) for i in range(20)])
+        self.assertEqual(self.tracker['peak'], 4)
+
+    def test_backend_concurrency(self):
+        # Interleave the backends so the workers start fetches from both
+        nodes = [node for pair in zip(self.nodes(range(10)), self.nodes(range(10), OtherReader)) for node in pair]
+        self.tracker['target'] = 2
+        results = FetchExecutor(8, {'SlowReader': 1, 'OtherReader': 1}).fetchAll(nodes, 0, 1)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(self.tracker['peak'], 2)
+
+    def test_serial_backend_concurrency(self):
+        executor = FetchExecutor(1, {'SlowReader': 1})
+        semaphore = Mock()
+        with patch.object(executor, 'getBackendSemaphore', return_value=semaphore):
+            results = executor.fetchAll(self.nodes(range(3)), 0, 1)
+        self.assertEqual(results, [((0, 1, 1), [i]) for i in range(3)])
+        self.assertEqual(semaphore.acquire.call_count, 3)
+        self.assertEqual(semaphore.release.call_count, 3)
+
+    def test_failed_fetch(self):
+        nodes = self.nodes([1, 2, None, 4])
+        with self.assertRaisesRegexp(Exception, 'fetch failed'):
+            FetchExecutor(4, {}).fetchAll(nodes, 0, 1)
+
+    def test_batched_fetch(self):
+        for concurrency in (1, 4):
+            self.tracker['batches'] = []
+            nodes = self.nodes(range(3), BatchReader) + self.nodes(range(3, 5)) + self.nodes(range(5, 8), BatchReader)
+            results = FetchExecutor(concurrency, {}).fetchAll(nodes, 0, 1)
+            self.assertEqual(results, [((0, 1, 1), [i]) for i in range(8)])
+            self.assertEqual(self.tracker['batches'], [[0, 1, 2, 5, 6, 7]])
+
+    def test_unbatched_fetch(self):
+        nodes = self.nodes(range(20), UnbatchedReader)
+        self.tracker['target'] = 4
+        with patch('graphite.render.datalib.prefetch_carbonlink') as prefetch_carbonlink:
+            results = FetchExecutor(4, {}).fetchAll(nodes, 0, 1)
+        self.assertEqual(results, [((0, 1, 1), [i]) for i in range(20)])
+        self.assertEqual(self.tracker['peak'], 4)
+        prefetch_carbonlink.assert_called_once_with(nodes, 0)
+
+    def test_downsample(self):
+        nodes = self.nodes(range(2), DownsamplingReader) + self.nodes(range(2, 4), BatchReader)
+        results = FetchExecutor(4, {}).fetchAll(nodes, 0, 1, (60, 'max'))
+        self.assertEqual(results, [((0, 1, 1), [i]) for i in range(4)])
+        self.assertEqual(self.tracker['downsample'], [(60, 'max')])
+        self.assertEqual(sorted(self.tracker['batches']), [[0, 1], [2, 3]])
+
+    def test_fetch_data_downsample(self):
+        nodes = self.nodes(range(2), DownsamplingReader)
+        requestContext = {
+            'startTime': datetime.fromtimestamp(0, pytz.utc),
+            'endTime': datetime.fromtimestamp(86400, pytz.utc),
+            'localOnly': False,
+        }
+        with patch('graphite.render.datalib.STORE') as store:
+            store.find.return_value = nodes
+            fetchData(requestContext, 'hosts.*.cpu')
+            fetchData(dict(requestContext, maxDataPoints=100, consolidationFunc='max'), 'hosts.*.cpu')
+            fetchData(dict(requestContext, maxDataPoints=100, consolidationFunc=None), 'hosts.*.cpu')
+        self.assertEqual(self.tracker['downsample'], [None, (864, 'max'), None])
+
+    def test_fetch_data_cache_downsample(self):
+        requestContext = {
+            'startTime': datetime.fromtimestamp(0, pytz.utc),
+            'endTime': datetime.fromtimestamp(1, pytz.utc),
+            'localOnly': False,
+            'fetchCache': FetchCache(),
+            'maxDataPoints': 100,
+        }
+        with patch('graphite.render.datalib.STORE') as store:
+            # Readers that don't downsample share the series fetched at full resolution
+            store.find.return_value = self.nodes(range(2), BatchReader)
+            fetchData(dict(requestContext, consolidationFunc='average'), 'hosts.*.cpu')
+            fetchData(dict(requestContext, consolidationFunc=None), 'hosts.*.cpu')
+            self.assertEqual(store.find.call_count, 1)
+
+            store.find.return_value = self.nodes(range(2), DownsamplingReader)
+            fetchData(dict(requestContext, consolidationFunc='average'), 'hosts.*.mem')
+            fetchData(dict(requestContext, consolidationFunc=None), 'hosts.*.mem')
+            self.assertEqual(store.find.call_count, 3)
+        self.assertEqual(self.tracker['downsample'], [(1, 'average'), None])
@@ -436,3 +436,63 @@ class FunctionsTest(TestCase):
         seriesList = [TimeSeries("foo", 0, 1, 1, [-10000, -20000, -30000, -40000])]
         result = functions.legendValue({}, seriesList, "avg", "si")
         self.assertEqual(result[0].name, "foo                 avg  -25.00K   ")
+
+    def _generate_aggregate_series(self):
+        seriesList = [
+            TimeSeries('collectd.test-db1.load.value',0,1,1,[1,None,3,None,6]),
+            TimeSeries('collectd.test-db2.load.value',0,1,1,[2,None,None,4,5]),
+            TimeSeries('collectd.test-db3.load.value',0,1,1,[4,None,1,2]),
+        ]
+        for series in seriesList:
+            series.pathExpression = 'collectd.test-db*.load.value'
+        return seriesList
+
+    def test_aggregate_series(self):
+        config = [
+            (functions.sumSeries, [7,None,4,6]),
+            (functions.diffSeries, [-5,None,2,2]),
+            (functions.averageSeries, [7/3.0,None,2.0,3.0]),
+            (functions.stddevSeries, [math.sqrt(14/9.0),None,1.0,1.0]),
+            (functions.minSeries, [1,None,1,2]),
+            (functions.maxSeries, [4,None,3,4]),
+            (functions.rangeOfSeries, [3,None,None,None]),
+            (functions.multiplySeries, [8,None,None,None]),
+        ]
+        for func, expected in config:
+            result = func({}, self._generate_aggregate_series())
+            self.assertEqual(list(result[0]), expected)
+            with patch('graphite.render.functions.numpy', False):
+                result = func({}, self._generate_aggregate_series())
+                self.assertEqual(list(result[0]), expected)
+
+    def _generate_bootstrapped_series(self):
+        bootstrap = TimeSeries('collectd.test-db1.load.value',0,9,1,[3,None,1,4,1,None,9,2,6])
+        series = TimeSeries('collectd.test-db1.load.value',3,9,1,[4,1,None,9,2,6])
+        series.pathExpression = series.name
+        return bootstrap, series
+
+    def test_movingAverage(self):
+        bootstrap, series = self._generate_bootstrapped_series()
+        with patch('graphite.render.functions._fetchWithBootstrap', return_value=[bootstrap]):
+            result = functions.movingAverage({}, [series], 3)
+        self.assertEqual(result[0].name, 'movingAverage(collectd.test-db1.load.value,3)')
+        self.assertEqual(list(result[0]), [2.0,2.5,2.0,2.5,5.0,5.5])
+
+    def test_movingMedian(self):
+        bootstrap, series = self._generate_bootstrapped_series()
+        with patch('graphite.render.functions._fetchWithBootstrap', return_value=[bootstrap]):
+            result = functions.movingMedian({}, [series], 3)
+        self.assertEqual(result[0].name, 'movingMedian(collectd.test-db1.load.value,3)')
+        self.assertEqual(list(result[0]), [3,4,1,4,9,9])
+
+    def test_movingMedian_short_bootstrap(self):
+        bootstrap, series = self._generate_bootstrapped_series()
+        with patch('graphite.render.functions._fetchWithBootstrap', return_value=[bootstrap]):
+            result = functions.movingMedian({}, [series], 5)
+        self.assertEqual(list(result[0]), [None,None,3,1,4,4])
+
+    def test_stdev(self):
+        series = TimeSeries('collectd.test-db1.load.value',0,6,1,[1,None,3,5,None,None])
+        result = functions.stdev({}, [series], 2, 0.5)
+        self.assertEqual(result[0].name, 'stddev(collectd.test-db1.load.value,2)')
+        self.assertEqual(list(result[0]), [0.0,0.0,0.0,1.0,0.0,None])
@@ -0,0 +1,46 @@
+from django.test import TestCase
+
+from graphite.render.hashing import ConsistentHashRing
+
+
+class ConsistentHashRingTest(TestCase):
+    a, b, c = ('127.0.0.1', 'a'), ('127.0.0.1', 'b'), ('127.0.0.2', 'c')
+
+    # Placement computed by carbon's ring for the same nodes
+    placement = {
+        'servers.web00.cpu.user': [b, a, c],
+        'servers.web01.cpu.user': [c, a, b],
+        'servers.web02.cpu.user': [a, c, b],
+    }
+
+    def test_get_nodes(self):
+        ring = ConsistentHashRing([self.a, self.b, self.c])
+        for i in range(2):
+            for key, nodes in self.placement.items():
+                self.assertEqual(ring.get_nodes(key), nodes)
+                self.assertEqual(ring.get_node(key), nodes[0])
+
+    def test_remove_and_add_node(self):
+        ring = ConsistentHashRing([self.a, self.b, self.c])
+        for key in self.placement:
+            ring.get_nodes(key)
+
+        ring.remove_node(self.b)
+        for key, nodes in self.placement.items():
+            self.assertEqual(ring.get_nodes(key), [n for n in nodes if n != self.b])
+
+        ring.add_node(self.b)
+        for key, nodes in self.placement.items():
+            self.assertEqual(ring.get_nodes(key), nodes)
+
+    def test_lookup_cache_size(self):
+        ring = ConsistentHashRing([self.a, self.b, self.c], lookup_cache_size=4)
+        for i in range(100):
+            ring.get_nodes('servers.web%02d.cpu.user' % i)
+        self.assertTrue(len(ring.lookup_cache) + len(ring.previous_lookups) <= 4)
+        for key, nodes in self.placement.items():
+            self.assertEqual(ring.get_nodes(key), nodes)
+
+    def test_empty_ring(self):
+        ring = ConsistentHashRing([])
+        self.assertEqual(ring.get_nodes('servers.web00.cpu.user'), [])
@@ -0,0 +1,379 @@
+import gzip
+import os
+import shutil
+import threading
+import time
+
+import whisper
+from django.conf import settings
+from django.test import TestCase
+from mock import Mock, patch
+
+from graphite.finders.standard import StandardFinder
+from graphite.node import LeafNode
+from graphite.readers import (GzipBlockCache, GzipSeekIndex, GzippedWhisperFile, GzippedWhisperReader,
+                              MmapWhisperReader, MultiReader, RRDReader, WhisperHeaderCache, WhisperReader)
+from graphite.render.datalib import FetchExecutor
+from graphite.storage import FindQuery
+
+whisper_info = whisper.info
+whisper_fetch = whisper.fetch
+
+
+class MultiReaderMergeTest(TestCase):
+    def merge(self, *results):
+        return MultiReader([]).merge(*results)
+
+    def test_merge_single_result(self):
+        results = ((0, 30, 10), [1, 2, 3])
+        self.assertTrue(self.merge(results) is results)
+
+    def test_merge_same_step(self):
+        results1 = ((0, 50, 10), [1, None, 3, None, None])
+        results2 = ((20, 70, 10), [30, 40, None, 60, 70])
+        self.assertEqual(self.merge(results1, results2), ((0, 70, 10), [1, None, 3, 40, None, 60, 70]))
+        self.assertEqual(self.merge(results2, results1), ((0, 70, 10), [1, None, 30, 40, None, 60, 70]))
+
+    def test_merge_finer_takes_precedence(self):
+        fine = ((60, 180, 20), [1, None, 3, None, 5, None])
+        coarse = ((0, 240, 60), [10, 20, None, 40])
+        expected = ((0, 240, 20), [10, 10, 10, 1, 20, 3, None, 5, None, 40, 40, 40])
+        self.assertEqual(self.merge(fine, coarse), expected)
+        self.assertEqual(self.merge(coarse, fine), expected)
+
+    def test_merge_misaligned(self):
+        fine = ((5, 35, 10), [None, 2, None])
+        coarse = ((0, 60, 30), [100, 200])
+        self.assertEqual(self.merge(fine, coarse), ((0, 60, 10), [100, 100, 2, 200, 200, 200]))
+
+    def test_merge_many(self):
+        results = [
+            ((0, 60, 30), [1000, 2000]),
+            ((0, 60, 10), [1, None, None, None, None, 6]),
+            ((20, 60, 20), [300, None]),
+            ((0, 50, 10), [None, 20, None, 40, None]),
+        ]
+        expected = ((0, 60, 10), [1, 20, 300, 40, 2000, 6])
+        self.assertEqual(self.merge(*results), expected)
+
+    def test_merge_generator_values(self):
+        results1 = ((0, 30, 10), (v for v in [1, None, 3]))
+        results2 = ((0, 30, 10), [10, 20, 30])
+        self.assertEqual(self.merge(results1, results2), ((0, 30, 10), [1, 20, 3]))
+
+
+class WhisperHeaderCacheTest(TestCase):
+    db = os.path.join(settings.WHISPER_DIR, 'header_cache.wsp')
+
+    def setUp(self):
+        whisper.create(self.db, [(1, 60), (60, 60)])
+        self.headers = WhisperHeaderCache(2)
+        self.reads = []
+
+    def tearDown(self):
+        for path in (self.db, self.db + '.gz'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def read_header(self, fs_path):
+        self.reads.append(fs_path)
+        return whisper_info(fs_path)
+
+    def test_get(self):
+        header, stat_result = self.headers.get(self.db, self.read_header)
+        self.assertEqual(header['maxRetention'], 3600)
+        self.assertEqual(stat_result.st_ino, os.stat(self.db).st_ino)
+        self.assertEqual(self.headers.get(self.db, self.read_header)[0], header)
+        self.assertEqual(self.reads, [self.db])
+
+    def test_get_modified_file(self):
+        self.headers.get(self.db, self.read_header)
+        mtime = os.stat(self.db).st_mtime
+        os.utime(self.db, (mtime + 10, mtime + 10))
+        self.headers.get(self.db, self.read_header)
+        self.assertEqual(self.reads, [self.db, self.db])
+
+    def test_get_evicts_least_recently_used(self):
+        paths = [self.db.replace('header_cache', 'header_cache%d' % i) for i in range(3)]
+        for path in paths:
+            shutil.copy(self.db, path)
+        try:
+            for path in paths[:2] + paths[:1] + paths[2:] + paths[:1] + paths[1:2]:
+                self.headers.get(path, self.read_header)
+        finally:
+            for path in paths:
+                os.remove(path)
+        self.assertEqual(self.reads, paths + paths[1:2])
+
+    def test_whisper_reader(self):
+        now = int(time.time())
+        whisper.update(self.db, 1.0, now - 1)
+        with patch('graphite.readers.whisper_header_cache', self.headers):
+            with patch('graphite.readers.whisper.info', side_effect=self.read_header):
+                reader = WhisperReader(self.db, 'header_cache')
+                reader.cached_datapoints = []
+                intervals = reader.get_intervals()
+                (start, end, step), values = reader.fetch(now - 10, now)
+        self.assertEqual(self.reads, [self.db])
+        self.assertEqual(step, 1)
+        self.assertEqual(values[-2:], [1.0, None])
+        self.assertTrue(intervals.size > 3590)
+
+    def test_gzipped_whisper_reader(self):
+        with open(self.db, 'rb') as fh:
+            gzipped = gzip.GzipFile(self.db + '.gz', 'wb')
+            gzipped.write(fh.read())
+            gzipped.close()
+
+        with patch('graphite.readers.whisper_header_cache', self.headers):
+            intervals = GzippedWhisperReader(self.db + '.gz', 'header_cache').get_intervals()
+        self.assertTrue(intervals.size > 3590)
+
+    def test_standard_finder(self):
+        with patch('graphite.readers.whisper_header_cache', self.headers):
+            with patch('graphite.readers.whisper.info', side_effect=self.read_header):
+                with patch('graphite.readers.os') as readers_os:
+                    nodes = list(StandardFinder([settings.WHISPER_DIR]).find_nodes(FindQuery('header_cache', None, None)))
+        self.assertEqual([node.path for node in nodes], ['header_cache'])
+        self.assertEqual(self.reads, [self.db])
+        self.assertFalse(readers_os.stat.called)
+
+
+class MmapWhisperReaderTest(TestCase):
+    db = os.path.join(settings.WHISPER_DIR, 'mmap_reader.wsp')
+
+    def setUp(self):
+        whisper.create(self.db, [(1, 120), (10, 60)])
+        self.headers = WhisperHeaderCache(10)
+
+    def tearDown(self):
+        if os.path.exists(self.db):
+            os.remove(self.db)
+
+    def fetch(self, startTime, endTime):
+        with patch('graphite.readers.whisper_header_cache', self.headers):
+            reader = MmapWhisperReader(self.db, 'mmap_reader')
+            return reader.read(startTime, endTime)
+
+    def test_read(self):
+        now = int(time.time())
+        # Wrap the fine archive around its ring buffer and leave some gaps
+        points = [(now - i, float(i)) for i in range(200) if i % 7]
+        whisper.update_many(self.db, points)
+
+        # Both read at the same "now", even if the clock ticks over meanwhile
+        with patch('time.time', return_value=now):
+            for offset in (0, 1, 30, 119, 500):
+                for length in (0, 1, 10, 60, 119, 600):
+                    startTime, endTime = now - offset - length, now - offset
+                    self.assertEqual(self.fetch(startTime, endTime), whisper.fetch(self.db, startTime, endTime, now))
+
+    def test_read_empty_archive(self):
+        now = int(time.time())
+        (start, end, step), values = self.fetch(now - 30, now)
+        self.assertEqual(step, 1)
+        self.assertEqual(values, [None] * 30)
+
+    def test_read_out_of_range(self):
+        now = int(time.time())
+        self.assertEqual(self.fetch(now - 3000, now - 2000), None)
+        self.assertRaises(whisper.InvalidTimeInterval, self.fetch, now, now - 10)
+
+    def test_read_truncated_file(self):
+        now = int(time.time())
+        whisper.update(self.db, 1.0, now - 1)
+        with open(self.db, 'r+b') as fh:
+            fh.truncate(100)
+        self.assertRaises(whisper.CorruptWhisperFile, self.fetch, now - 30, now)
+
+    def test_standard_finder(self):
+        query = FindQuery('mmap_reader', None, None)
+        with self.settings(WHISPER_MMAP=True):
+            nodes = list(StandardFinder([settings.WHISPER_DIR]).find_nodes(query))
+        self.assertTrue(isinstance(nodes[0].reader, MmapWhisperReader))
+
+        nodes = list(StandardFinder([settings.WHISPER_DIR]).find_nodes(query))
+        self.assertFalse(isinstance(nodes[0].reader, MmapWhisperReader))
+
+
+class WhisperFetchAllTest(TestCase):
+    paths = [os.path.join(settings.WHISPER_DIR, 'fetch_many%d.wsp' % i) for i in range(3)]
+
+    def setUp(self):
+        now = int(time.time())
+        for i, path in enumerate(self.paths):
+            whisper.create(path, [(1, 60)])
+            whisper.update(path, float(i), now - 1)
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+
+    def test_fetch_all(self):
+        # Ask for the files against their inode order
+        inode_order = sorted(self.paths, key=lambda path: os.stat(path).st_ino)
+        paths = inode_order[::-1]
+        nodes = [LeafNode('fetch_many%d' % self.paths.index(path),
+                          WhisperReader(path, 'fetch_many%d' % self.paths.index(path), os.stat(path)))
+                 for path in paths]
+        cached = dict(('fetch_many%d' % i, []) for i in range(3))
+        reads = []
+
+        def fetch(path, *args):
+            reads.append(path)
+            return whisper_fetch(path, *args)
+
+        now = int(time.time())
+        with patch('graphite.readers.CarbonLink.query_bulk', return_value=cached) as query_bulk:
+            with patch('graphite.readers.whisper.fetch', side_effect=fetch):
+                results = FetchExecutor(1, {}).fetchAll(nodes, now - 10, now)
+
+        self.assertEqual(query_bulk.call_count, 1)
+        self.assertEqual(reads, inode_order)
+        self.assertEqual([values[-2] for time_info, values in results],
+                         [float(self.paths.index(path)) for path in paths])
+
+
+class GzippedWhisperFileTest(TestCase):
+    db = os.path.join(settings.WHISPER_DIR, 'gzipped.wsp')
+
+    def setUp(self):
+        whisper.create(self.db, [(1, 3600), (60, 1440)])
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, float(i)) for i in range(0, 3600, 3)])
+        with open(self.db, 'rb') as fh:
+            self.data = fh.read()
+
+        # Write the file as two gzip members, as appending to a gzip file does
+        middle = len(self.data) // 2
+        for mode, data in (('wb', self.data[:middle]), ('ab', self.data[middle:])):
+            gzipped = gzip.GzipFile(self.db + '.gz', mode)
+            gzipped.write(data)
+            gzipped.close()
+
+        self.blocks = GzipBlockCache(1024 * 1024)
+        patcher = patch('graphite.readers.gzip_block_cache', self.blocks)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for path in (self.db, self.db + '.gz'):
+            os.remove(path)
+
+    @patch.object(GzipSeekIndex, 'spacing', 4096)
+    @patch.object(GzipSeekIndex, 'chunk_size', 512)
+    def test_read(self):
+        fh = GzippedWhisperFile(self.db + '.gz', os.stat(self.db + '.gz'))
+        size = len(self.data)
+        for offset, length in ((size - 100, 50), (0, 28), (5000, 20000), (size - 10, 100), (size + 10, 10), (0, size)):
+            fh.seek(offset)
+            self.assertEqual(fh.read(length), self.data[offset:offset + length])
+            self.assertEqual(fh.tell(), min(offset + length, max(offset, size)))
+
+    @patch.object(GzipSeekIndex, 'spacing', 4096)
+    @patch.object(GzipSeekIndex, 'chunk_size', 512)
+    def test_read_cached_blocks(self):
+        fh = GzippedWhisperFile(self.db + '.gz', os.stat(self.db + '.gz'))
+        fh.seek(len(self.data) - 100)
+        fh.read(100)
+        with patch.object(GzipSeekIndex, 'inflate') as inflate:
+            fh.seek(len(self.data) - 50)
+            self.assertEqual(fh.read(50), self.data[-50:])
+        self.assertFalse(inflate.called)
+
+    def read_in_threads(self, offsets, length):
+        "Reads length bytes at each offset at once, each through its own file object"
+        stat_result = os.stat(self.db + '.gz')
+        start = threading.Event()
+        results = {}
+
+        def read(offset):
+            fh = GzippedWhisperFile(self.db + '.gz', stat_result)
+            fh.seek(offset)
+            start.wait(5)
+            results[offset] = fh.read(length)
+
+        threads = [threading.Thread(target=read, args=(offset,)) for offset in offsets]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "a read never finished")
+        for offset in offsets:
+            self.assertEqual(results[offset], self.data[offset:offset + length])
+
+    @patch.object(GzipSeekIndex, 'spacing', 4096)
+    @patch.object(GzipSeekIndex, 'chunk_size', 512)
+    def test_concurrent_reads(self):
+        offsets = [len(self.data) - 1000 - i for i in range(8)]
+        for i in range(5):
+            self.blocks.entries.clear()
+            self.read_in_threads(offsets, 100)
+        self.assertEqual(len([key for key in self.blocks.entries if len(key) == 3]), 1)
+
+    @patch.object(GzipSeekIndex, 'spacing', 4096)
+    @patch.object(GzipSeekIndex, 'chunk_size', 512)
+    def test_evicted_index(self):
+        self.read_in_threads([len(self.data) - 1000], 100)
+        # The blocks are still cached when the index has been evicted
+        file_key = [key for key in self.blocks.entries if len(key) == 3][0]
+        del self.blocks.entries[file_key]
+        self.read_in_threads([len(self.data) - 500], 100)
+
+    def test_block_cache_size(self):
+        blocks = GzipBlockCache(1000)
+        for i in range(10):
+            blocks.put(('path', i), 'x' * 300, 300)
+        self.assertEqual(blocks.get(('path', 0)), None)
+        self.assertEqual(blocks.get(('path', 9)), 'x' * 300)
+        self.assertEqual(len(blocks.entries), 3)
+        self.assertEqual(blocks.size, 900)
+
+    def test_gzipped_whisper_reader(self):
+        now = int(time.time())
+        reader = GzippedWhisperReader(self.db + '.gz', 'gzipped')
+        for fromTime, untilTime in ((now - 60, now), (now - 3600, now), (now - 86400, now)):
+            with patch('time.time', return_value=now):
+                self.assertEqual(reader.fetch(fromTime, untilTime), whisper.fetch(self.db, fromTime, untilTime, now))
+
+
+class RRDReaderTest(TestCase):
+    rrd = os.path.join(settings.WHISPER_DIR, 'collectd.rrd')
+    info = {'step': 60, 'ds': {'rx': {}, 'tx': {}, 'errors': {}}, 'rra': [{'pdp_per_row': 1, 'rows': 1440}]}
+
+    def setUp(self):
+        open(self.rrd, 'w').close()
+        self.rrdtool = Mock()
+        self.rrdtool.info.return_value = self.info
+        self.rrdtool.fetch.side_effect = lambda *args: ((0, 180, 60), ('rx', 'tx', 'errors'),
+                                                        [(1, 10, 100), (2, 20, None), (3, 30, 300), (4, 40, 400)])
+        patcher = patch('graphite.readers.rrdtool', self.rrdtool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.remove(self.rrd)
+
+    def find_nodes(self, pattern):
+        with patch.object(RRDReader, 'supported', True):
+            return list(StandardFinder([settings.WHISPER_DIR]).find_nodes(FindQuery(pattern, None, None)))
+
+    def test_standard_finder(self):
+        nodes = self.find_nodes('collectd.*x')
+        self.assertEqual(sorted(node.path for node in nodes), ['collectd.rx', 'collectd.tx'])
+        self.assertEqual(self.rrdtool.info.call_count, 1)
+
+    def test_fetch_many(self):
+        nodes = self.find_nodes('collectd.*')
+        with self.settings(FLUSHRRDCACHED='unix:/tmp/rrdcached.sock'):
+            results = RRDReader.fetch_many(nodes, 0, 180)
+
+        columns = {'rx': [1, 2, 3], 'tx': [10, 20, 30], 'errors': [100, None, 300]}
+        self.assertEqual(results, [((0, 180, 60), columns[node.reader.datasource_name]) for node in nodes])
+        self.assertEqual(self.rrdtool.flushcached.call_count, 1)
+        self.assertEqual(self.rrdtool.fetch.call_count, 1)
+
+        (time_info, values) = nodes[0].fetch(0, 180)
+        self.assertEqual(list(values), columns[nodes[0].reader.datasource_name])
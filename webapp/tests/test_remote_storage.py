@@ -0,0 +1,358 @@
+import BaseHTTPServer
+import socket
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+
+from graphite import opentsdb
+from graphite.node import LeafNode
+from graphite.readers import FetchInProgress
+from graphite.render.datalib import FetchExecutor
+from graphite.remote_storage import (HTTPConnectionPool, OpenTSDBRemoteReader, OpenTSDBRemoteStore, RemoteReader,
+                                     RemoteRequestCache, RemoteStore, connection_pools)
+from graphite.storage import FindQuery
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class FakeResponse(object):
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeConnection(object):
+    "Answers render requests with a series for every metric of the test"
+    requests = []
+    metrics = []
+    failing_requests = []
+    failing_responses = []
+
+    def __init__(self, host):
+        self.host = host
+        self.timeout = None
+        self.sock = None
+
+    def request(self, method, url, body=None):
+        if self.host in self.failing_requests:
+            raise IOError("Connection refused")
+        self.requests.append((self.host, url))
+
+    def getresponse(self):
+        if self.host in self.failing_responses:
+            raise IOError("Connection reset by peer")
+        series = [dict(name=metric, start=0, end=60, step=60, values=[i]) for i, metric in enumerate(self.metrics)]
+        return FakeResponse(pickle.dumps(series, protocol=-1))
+
+    def close(self):
+        pass
+
+
+class RemoteReaderTest(TestCase):
+    def setUp(self):
+        FakeConnection.requests = []
+        FakeConnection.metrics = ['a.b', 'a.c', 'x.y']
+        FakeConnection.failing_requests = []
+        FakeConnection.failing_responses = []
+        RemoteReader.request_cache.clear()
+        connection_pools.clear()
+
+    def node(self, store, metric_path, bulk_query):
+        reader = RemoteReader(store, dict(metric_path=metric_path, intervals=[]), bulk_query=bulk_query)
+        return LeafNode(metric_path, reader)
+
+    def test_fetch_many(self):
+        store1, store2 = RemoteStore('host1:8080'), RemoteStore('host2:8080')
+        nodes = [self.node(store1, 'a.b', 'a.*'), self.node(store1, 'a.c', 'a.*'),
+                 self.node(store1, 'x.y', 'x.y'), self.node(store2, 'x.y', 'x.*')]
+
+        with patch('graphite.remote_storage.HTTPConnectionWithTimeout', FakeConnection):
+            results = RemoteReader.fetch_many(nodes, 0, 60)
+            results = [r.waitForResults() if isinstance(r, FetchInProgress) else r for r in results]
+
+        self.assertEqual(results, [((0, 60, 60), [0]), ((0, 60, 60), [1]), ((0, 60, 60), [2]),
+                                   ((0, 60, 60), [2])])
+        self.assertEqual(sorted(host for host, url in FakeConnection.requests), ['host1:8080', 'host2:8080'])
+        targets = dict((host, parse_qs(urlparse(url).query)['target']) for host, url in FakeConnection.requests)
+        self.assertEqual(targets, {'host1:8080': ['a.*', 'x.y'], 'host2:8080': ['x.*']})
+
+
+    def test_failed_fetch_releases_connections(self):
+        stores = [RemoteStore('host%d:8080' % i) for i in range(3)]
+        nodes = [self.node(store, 'x.y', 'x.y') for store in stores]
+
+        with patch('graphite.remote_storage.HTTPConnectionWithTimeout', FakeConnection):
+            FakeConnection.failing_responses = ['host0:8080']
+            for concurrency in (1, 4):
+                RemoteReader.request_cache.clear()
+                self.assertRaises(IOError, FetchExecutor(concurrency, {}).fetchAll, nodes, 0, 60)
+                self.assertEqual([pool.in_use for pool in connection_pools.values()], [0, 0, 0])
+
+            # Requests sent before another one failed are answered too
+            FakeConnection.failing_responses = []
+            FakeConnection.failing_requests = ['host2:8080']
+            RemoteReader.request_cache.clear()
+            self.assertRaises(IOError, RemoteReader.fetch_many, nodes, 0, 60)
+            self.assertEqual([pool.in_use for pool in connection_pools.values()], [0, 0, 0])
+
+
+class FakeOpenTSDBAPI(object):
+    "Answers queries with a data point per metric, holding the value of its last character"
+    queries = []
+    downsamplers = []
+    timeouts = []
+    lock = threading.Lock()
+    unhung = threading.Event()
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.timeouts.append(timeout)
+
+    def query(self, metrics, start_time, end_time, downsampler=None):
+        with self.lock:
+            self.queries.append((self.host, metrics))
+            self.downsamplers.append(downsampler)
+        if 'hung' in metrics:
+            self.unhung.wait(5)
+        if 'broken' in metrics:
+            raise Exception("No such name for 'metrics': 'broken'")
+        return [dict(metric=metric, dps={str(start_time): int(metric[-1])}) for metric in reversed(metrics)]
+
+
+class OpenTSDBRemoteReaderTest(TestCase):
+    def setUp(self):
+        FakeOpenTSDBAPI.queries = []
+        FakeOpenTSDBAPI.downsamplers = []
+        FakeOpenTSDBAPI.timeouts = []
+
+    def node(self, store, metric_path):
+        return LeafNode(metric_path, OpenTSDBRemoteReader(store, dict(metric_path=metric_path)))
+
+    @override_settings(OPENTSDB_QUERY_BATCH_SIZE=2)
+    def test_fetch_many(self):
+        store1, store2 = OpenTSDBRemoteStore('host1:4242'), OpenTSDBRemoteStore('host2:4242')
+        nodes = [self.node(store1, 'a.%d' % i) for i in range(5)]
+        nodes += [self.node(store2, 'a.1'), self.node(store1, 'a.1')]
+
+        with patch('graphite.opentsdb.API', FakeOpenTSDBAPI):
+            results = [r.waitForResults() for r in OpenTSDBRemoteReader.fetch_many(nodes, 60, 120)]
+
+        self.assertEqual(results, [((60, 180, 60), [i, None]) for i in (0, 1, 2, 3, 4, 1, 1)])
+        self.assertEqual(sorted(FakeOpenTSDBAPI.queries), [
+            ('host1:4242', ['a.0', 'a.1']), ('host1:4242', ['a.2', 'a.3']), ('host1:4242', ['a.4']),
+            ('host2:4242', ['a.1'])])
+
+    def test_downsample(self):
+        store = OpenTSDBRemoteStore('host1:4242')
+        with patch('graphite.opentsdb.API', FakeOpenTSDBAPI):
+            for downsample in (None, (10, 'sum'), (3600, 'max')):
+                for r in OpenTSDBRemoteReader.fetch_many([self.node(store, 'a.1')], 0, 86400, downsample):
+                    r.waitForResults()
+        self.assertEqual(FakeOpenTSDBAPI.downsamplers, ['60s-avg', '60s-sum', '3600s-max'])
+        self.assertEqual(opentsdb.get_downsampler(), '60s-avg')
+
+    @override_settings(OPENTSDB_QUERY_BATCH_SIZE=2)
+    def test_query_error(self):
+        store = OpenTSDBRemoteStore('host1:4242')
+        nodes = [self.node(store, metric) for metric in ('a.0', 'broken', 'a.2')]
+
+        with patch('graphite.opentsdb.API', FakeOpenTSDBAPI):
+            results = OpenTSDBRemoteReader.fetch_many(nodes, 60, 120)
+            self.assertRaises(Exception, results[0].waitForResults)
+            self.assertEqual(results[2].waitForResults(), ((60, 180, 60), [2, None]))
+
+    @override_settings(OPENTSDB_FETCH_TIMEOUT=0.01)
+    def test_query_timeout(self):
+        store = OpenTSDBRemoteStore('host1:4242')
+        with patch('graphite.opentsdb.API', FakeOpenTSDBAPI):
+            results = OpenTSDBRemoteReader.fetch_many([self.node(store, 'hung')], 60, 120)
+            try:
+                self.assertRaisesRegexp(Exception, 'Timed out querying 1 metrics from host1:4242',
+                                        results[0].waitForResults)
+            finally:
+                FakeOpenTSDBAPI.unhung.set()
+        self.assertEqual(FakeOpenTSDBAPI.timeouts, [0.01])
+
+    def test_http_timeout(self):
+        self.assertEqual(opentsdb.API('host1:4242', 30.0).http.timeout, 30.0)
+
+    def test_decode_data_points(self):
+        dps = {'1200': 1.5, '1320': 2, '1500': 4, '1560': 5.5, '600': 0}
+        self.assertEqual(opentsdb.decode_data_points(dps, 1170, 1530, 60),
+                         ((1140, 1560, 60), [None, 1.5, None, 2, None, None, 4]))
+        self.assertEqual(opentsdb.decode_data_points({}, 0, 100, 60), ((0, 120, 60), [None, None]))
+
+
+class OpenTSDBFindRequestTest(TestCase):
+    def find(self, indexResults):
+        index = Mock()
+        index.find.return_value = indexResults
+        treeResults = [dict(metric_path='a.b', isLeaf=True)]
+        with patch('graphite.opentsdb.API', FakeOpenTSDBAPI), \
+                patch('graphite.tree.get_metric_index', return_value=index), \
+                patch('graphite.tree.OpenTSDBMetricsMeta') as OpenTSDBMetricsMeta:
+            OpenTSDBMetricsMeta.return_value.find.return_value = treeResults
+            nodes = list(OpenTSDBRemoteStore('host1:4242').find(FindQuery('a.*', None, None)).get_results())
+        return [node.path for node in nodes], OpenTSDBMetricsMeta.return_value.find.called
+
+    def test_index(self):
+        self.assertEqual(self.find([dict(metric_path='a.c', isLeaf=True)]), (['a.c'], False))
+
+    def test_index_miss(self):
+        # Metrics created since the index was refreshed are found in the tree
+        self.assertEqual(self.find([]), (['a.b'], True))
+
+
+class RemoteRequestCacheTest(TestCase):
+    def setUp(self):
+        self.cache = RemoteRequestCache()
+
+    def test_hit_and_miss(self):
+        request = self.cache.get('a')
+        self.assertTrue(self.cache.get('a') is request)
+        self.cache.set_results('a', request, ['series'], 10)
+        self.assertEqual(self.cache.get('a').results, ['series'])
+        self.assertEqual(self.cache.stats(), dict(entries=1, size=10, hits=2, misses=1, evictions=0, expirations=0))
+
+    @override_settings(REMOTE_READER_CACHE_SIZE_LIMIT=2)
+    def test_max_entries(self):
+        a = self.cache.get('a')
+        self.cache.get('b')
+        self.cache.get('a')
+        self.cache.get('c')
+        self.assertEqual(list(self.cache.requests), ['a', 'c'])
+        self.assertTrue(self.cache.get('a') is a)
+        self.assertEqual(self.cache.evictions, 1)
+
+    @override_settings(REMOTE_READER_CACHE_MAX_BYTES=100)
+    def test_max_size(self):
+        for url in 'abc':
+            self.cache.set_results(url, self.cache.get(url), [], 40)
+        self.assertEqual(list(self.cache.requests), ['b', 'c'])
+        self.assertEqual(self.cache.size, 80)
+
+        # Results of an evicted request still reach its readers, but don't count
+        self.cache.set_results('a', self.cache.get('a'), [], 40)
+        evicted = self.cache.requests['c']
+        self.cache.set_results('d', self.cache.get('d'), [], 40)
+        self.cache.set_results('c', evicted, ['late'], 40)
+        self.assertEqual(evicted.results, ['late'])
+        self.assertEqual(list(self.cache.requests), ['a', 'd'])
+        self.assertEqual(self.cache.size, 80)
+
+    @override_settings(REMOTE_READER_CACHE_DURATION=10)
+    def test_expiry(self):
+        with patch('time.time', return_value=1000):
+            a = self.cache.get('a')
+            self.cache.set_results('a', a, [], 10)
+            self.cache.get('b')
+        with patch('time.time', return_value=1009):
+            self.assertTrue(self.cache.get('a') is a)
+        with patch('time.time', return_value=1010):
+            self.assertFalse(self.cache.get('a') is a)
+        self.assertEqual(self.cache.stats(), dict(entries=1, size=0, hits=1, misses=3, evictions=0, expirations=2))
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        elif self.path == '/drop':
+            # Like a server dropping an idle keep-alive connection
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class HTTPConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.server = KeepAliveServer()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, pool, path='/'):
+        connection = pool.request('GET', path, timeout=1)
+        connection, response = pool.getresponse(connection)
+        body = response.read()
+        pool.release(connection)
+        return body
+
+    def test_reuse(self):
+        pool = HTTPConnectionPool(self.host, 4, 60)
+        for i in range(3):
+            self.assertEqual(self.get(pool), 'ok')
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(pool.idle), 1)
+
+    def test_dropped_connection(self):
+        pool = HTTPConnectionPool(self.host, 4, 60)
+        self.assertEqual(self.get(pool, '/close'), 'ok')
+        self.assertEqual(self.get(pool), 'ok')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_resend_on_reused_connection(self):
+        pool = HTTPConnectionPool(self.host, 4, 60)
+        self.assertEqual(self.get(pool, '/drop'), 'ok')
+        time.sleep(0.05)
+        # The request goes out on the dropped connection before its response fails
+        with patch('graphite.remote_storage.is_connection_dropped', return_value=False):
+            self.assertEqual(self.get(pool), 'ok')
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(pool.in_use, 0)
+
+    def test_failed_new_connection(self):
+        self.server.shutdown()
+        self.server.server_close()
+        pool = HTTPConnectionPool(self.host, 4, 60)
+        self.assertRaises(socket.error, pool.request, 'GET', '/', timeout=1)
+        self.assertEqual(pool.in_use, 0)
+        self.server = KeepAliveServer()
+
+    def test_max_idle(self):
+        pool = HTTPConnectionPool(self.host, 4, 0)
+        self.get(pool)
+        time.sleep(0.01)
+        self.get(pool)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_max_connections(self):
+        pool = HTTPConnectionPool(self.host, 1, 60)
+        connection = pool.get(1)
+        self.assertRaises(Exception, pool.get, 0.05)
+
+        threading.Timer(0.05, pool.release, [connection]).start()
+        self.assertTrue(pool.get(1) is connection)
@@ -5,6 +5,8 @@ import time
 import logging
 import shutil
 
+from graphite.render.evaluator import evaluateTarget, getConsolidationFunc
+from graphite.render.grammar import grammar
 from graphite.render.hashing import hashRequest, hashData
 import whisper
 
@@ -12,6 +14,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest, QueryDict
 from django.test import TestCase
+from mock import patch
 
 # Silence logging during tests
 LOGGER = logging.getLogger()
@@ -132,6 +135,50 @@ class RenderTest(TestCase):
         end_time = datetime.fromtimestamp(1000)
         self.assertEqual(hashData(targets, start_time, end_time),
                         hashData(reversed(targets), start_time, end_time))
+        self.assertNotEqual(hashData(targets, start_time, end_time),
+                            hashData(targets, start_time, end_time, 330))
+
+    def test_consolidation_func(self):
+        targets = {
+            'hosts.*.cpu': 'average',
+            'alias(hosts.worker1.cpu, "cpu")': 'average',
+            'consolidateBy(hosts.*.cpu, "max")': 'max',
+            'aliasByNode(consolidateBy(hosts.*.cpu, \'sum\'), 1)': 'sum',
+            'consolidateBy(sumSeries(hosts.*.cpu), "max")': None,
+            'summarize(hosts.*.cpu, "1h", "sum")': None,
+            'template(hosts.$1.cpu, "worker1")': None,
+        }
+        for target, consolidationFunc in targets.items():
+            self.assertEqual(getConsolidationFunc(grammar.parseString(target)), consolidationFunc, target)
+
+    def test_evaluate_target_consolidation(self):
+        consolidationFuncs = []
+
+        def fetchData(requestContext, pathExpr):
+            consolidationFuncs.append(requestContext['consolidationFunc'])
+            if pathExpr == 'outer':
+                # Like the targets that functions such as timeShift evaluate again
+                evaluateTarget(requestContext, 'inner')
+            return []
+
+        requestContext = {'maxDataPoints': 100}
+        with patch('graphite.render.evaluator.fetchData', fetchData):
+            evaluateTarget(requestContext, 'consolidateBy(outer, "max")', consolidate=True)
+            evaluateTarget(requestContext, 'consolidateBy(outer, "max")')
+        self.assertEqual(consolidationFuncs, ['max', None, None, None])
+        self.assertEqual(requestContext['consolidationFunc'], None)
+
+    def test_stacked_targets(self):
+        self.create_whisper_hosts()
+        self.addCleanup(self.wipe_whisper_hosts)
+
+        url = reverse('graphite.render.views.renderView')
+        for params in ({}, {'maxDataPoints': 330}):
+            response = self.client.get(url, dict(params, format='json', target=[
+                'stacked(hosts.worker1.cpu)', 'stacked(hosts.worker2.cpu)']))
+            data = json.loads(response.content)
+            # The second series is stacked onto the first
+            self.assertEqual([series['datapoints'][-1][0] for series in data], [1, 3], params)
 
     def test_correct_timezone(self):
         url = reverse('graphite.render.views.renderView')
@@ -1,6 +1,9 @@
 import logging
+import threading
 
-from graphite.storage import Store
+from graphite.intervals import Interval, IntervalSet
+from graphite.node import BranchNode, LeafNode
+from graphite.storage import FindQuery, Store, get_minimal_node_set
 
 from django.conf import settings
 from django.test import TestCase
@@ -40,3 +43,160 @@ class StorageTest(TestCase):
         # Restore original settings
         settings.CLUSTER_SERVERS = old_cluster_servers
         settings.REMOTE_EXCLUDE_LOCAL = old_remote_exclude_local
+
+
+class FakeNode(object):
+    def __init__(self, intervals, local=False):
+        self.intervals = IntervalSet([Interval(*interval) for interval in intervals])
+        self.local = local
+
+
+class MinimalNodeSetTest(TestCase):
+    query = FindQuery('servers.web01.cpu', 0, 1000)
+
+    def test_single_node(self):
+        node = FakeNode([(0, 1000)])
+        self.assertEqual(get_minimal_node_set([node], self.query), [node])
+
+    def test_replicated_nodes(self):
+        full = FakeNode([(0, 1000)])
+        nodes = [FakeNode([(0, 600)]), full, FakeNode([(400, 1000)])]
+        self.assertEqual(get_minimal_node_set(nodes, self.query), [full])
+
+    def test_migrated_nodes(self):
+        old, new = FakeNode([(0, 500)]), FakeNode([(500, 1000)])
+        nodes = [FakeNode([(100, 300)]), new, FakeNode([(600, 700)]), old]
+        self.assertEqual(set(get_minimal_node_set(nodes, self.query)), set([old, new]))
+
+    def test_local_nodes_first(self):
+        local, remote = FakeNode([(0, 800)], local=True), FakeNode([(0, 1000)])
+        self.assertEqual(get_minimal_node_set([remote, local], self.query), [local, remote])
+        self.assertEqual(get_minimal_node_set([FakeNode([(0, 500)]), local], self.query), [local])
+
+    def test_nodes_outside_query(self):
+        self.assertEqual(get_minimal_node_set([FakeNode([(2000, 3000)])], self.query), [])
+
+
+class FakeReader(object):
+    def __init__(self, intervals):
+        self.intervals = IntervalSet([Interval(*interval) for interval in intervals])
+
+    def get_intervals(self):
+        return self.intervals
+
+
+class FakeFinder(object):
+    def __init__(self, nodes, rendezvous=None, release=None):
+        self.nodes = nodes
+        self.rendezvous = rendezvous
+        self.release = release
+
+    def find_nodes(self, query):
+        if self.rendezvous:
+            self.rendezvous.wait()
+        if self.release:
+            self.release.wait(10)
+        return iter(self.nodes)
+
+
+class Rendezvous(object):
+    "Holds back the finders searching through it until all of them are searching at once"
+    def __init__(self, count):
+        self.events = [threading.Event() for i in range(count)]
+        self.arrived = 0
+        self.lock = threading.Lock()
+        self.met = True
+
+    def wait(self):
+        with self.lock:
+            if self.arrived == len(self.events):
+                return # finders searching again pass right through
+            event = self.events[self.arrived]
+            self.arrived += 1
+        event.set()
+        if not all(e.wait(5) for e in self.events):
+            self.met = False
+
+
+class TrickleFinder(object):
+    "Finds its first node right away and the rest once released"
+    def __init__(self, nodes, release):
+        self.nodes = nodes
+        self.release = release
+
+    def find_nodes(self, query):
+        yield self.nodes[0]
+        self.release.wait(10)
+        for node in self.nodes[1:]:
+            yield node
+
+
+class FakeRemoteStore(object):
+    available = True
+
+    def __init__(self, host, nodes, rendezvous=None, release=None, find_timeout=5):
+        self.host = host
+        self.finder = FakeFinder(nodes, rendezvous, release)
+        self.find_timeout = find_timeout
+        self.failed = False
+
+    def find(self, query):
+        return self
+
+    def get_results(self):
+        for node in self.finder.find_nodes(None):
+            node.local = False
+            yield node
+
+    def fail(self):
+        self.failed = True
+
+
+class StoreFindTest(TestCase):
+    def leaf(self, path, *intervals):
+        return LeafNode(path, FakeReader(intervals))
+
+    def release(self):
+        "Returns an event that holds finders back until the end of the test"
+        event = threading.Event()
+        self.addCleanup(event.set)
+        return event
+
+    def test_find_all_backends(self):
+        local = self.leaf('a.b', (0, 500))
+        peer = self.leaf('a.b', (500, 1000))
+        opentsdb = self.leaf('a.c', (0, 1000))
+        rendezvous = Rendezvous(3)
+        store = Store(finders=[FakeFinder([local, BranchNode('a.d')], rendezvous)], hosts=[], opentsdb_hosts=[])
+        store.remote_stores = [FakeRemoteStore('peer', [peer, BranchNode('a.d')], rendezvous),
+                               FakeRemoteStore('opentsdb', [opentsdb], rendezvous)]
+
+        nodes = dict((node.path, node) for node in store.find('a.*', 0, 1000))
+        self.assertTrue(rendezvous.met)
+
+        self.assertEqual(sorted(nodes), ['a.b', 'a.c', 'a.d'])
+        self.assertEqual(set(n.reader for n in nodes['a.b'].reader.nodes), set([local.reader, peer.reader]))
+        self.assertTrue(nodes['a.c'] is opentsdb)
+        self.assertEqual(sorted(node.path for node in store.find('a.*', 0, 1000, local=True)), ['a.b', 'a.d'])
+
+    def test_find_timeout(self):
+        store = Store(finders=[], hosts=[], opentsdb_hosts=[])
+        fast = FakeRemoteStore('fast', [self.leaf('a.b', (0, 1000))])
+        slow = FakeRemoteStore('slow', [self.leaf('a.c', (0, 1000))], release=self.release(), find_timeout=0.2)
+        store.remote_stores = [slow, fast]
+
+        self.assertEqual([node.path for node in store.find('a.*', 0, 1000)], ['a.b'])
+        self.assertTrue(slow.failed)
+        self.assertFalse(fast.failed)
+
+    def test_find_deadline(self):
+        release = self.release()
+        store = Store(finders=[TrickleFinder([self.leaf('a.b', (0, 1000)), self.leaf('a.c', (0, 1000))], release)],
+                      hosts=[], opentsdb_hosts=[])
+        slow = FakeRemoteStore('slow', [self.leaf('a.d', (0, 1000))], release=release)
+        store.remote_stores = [slow]
+
+        with self.settings(FIND_TIMEOUT=0.5):
+            nodes = list(store.find('a.*', 0, 1000))
+        self.assertEqual([node.path for node in nodes], ['a.b'])
+        self.assertFalse(slow.failed)
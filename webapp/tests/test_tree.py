@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from graphite.finders import match_entries
+from graphite.tree import OpenTSDBMetricIndex, OpenTSDBMetricsMeta, get_metric_index
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_branch(branch_id, names, branches=(), leaves=()):
+    path = dict((str(depth + 1), name) for depth, name in enumerate(names))
+    return {
+        'branchId': branch_id,
+        'depth': len(names),
+        'path': path,
+        'branches': list(branches) or None,
+        'leaves': list(leaves) or None,
+    }
+
+
+class FakeAPI(object):
+    "An OpenTSDB tree of servers.webNN.cpu.{user,system} that records its branch requests"
+    host = 'opentsdb:4242'
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.branches = {}
+
+        hosts = []
+        for i in range(20):
+            host = 'web%02d' % i
+            cpu = make_branch('C%02d' % i, ['servers', host, 'cpu'], leaves=[
+                {'displayName': name, 'metric': 'servers.%s.cpu.%s' % (host, name)} for name in ('user', 'system')])
+            self.branches[cpu['branchId']] = cpu
+            server = make_branch('W%02d' % i, ['servers', host], branches=[cpu])
+            self.branches[server['branchId']] = server
+            hosts.append(server)
+        servers = make_branch('S', ['servers'], branches=hosts)
+        self.branches['S'] = servers
+        self.branches['0001'] = make_branch('0001', [], branches=[servers])
+
+    def branch(self, branch_id=None):
+        with self.lock:
+            self.requests.append(branch_id)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return self.branches[branch_id]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OpenTSDBMetricsMetaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_find(self):
+        api = FakeAPI()
+        results = OpenTSDBMetricsMeta(api).find('servers.web0*')
+        self.assertEqual(sorted(r['metric_path'] for r in results), ['servers.web%02d' % i for i in range(10)])
+        self.assertFalse(any(r['isLeaf'] for r in results))
+
+        results = OpenTSDBMetricsMeta(api).find('servers.web01.cpu')
+        self.assertEqual(results, [{'metric_path': 'servers.web01.cpu', 'isLeaf': False}])
+
+        results = OpenTSDBMetricsMeta(api).find('servers.{web01,web02}.cpu.*')
+        self.assertEqual(sorted((r['metric_path'], r['isLeaf']) for r in results),
+                         [('servers.web01.cpu.system', True), ('servers.web01.cpu.user', True),
+                          ('servers.web02.cpu.system', True), ('servers.web02.cpu.user', True)])
+
+        # Literal parts match whole names only
+        self.assertEqual(OpenTSDBMetricsMeta(api).find('servers.web1.*'), [])
+
+    def test_branches_cached(self):
+        api = FakeAPI()
+        OpenTSDBMetricsMeta(api).find('servers.*.cpu.*')
+        self.assertEqual(len(api.requests), 42)
+
+        api.requests = []
+        results = OpenTSDBMetricsMeta(api).find('servers.*.cpu.*')
+        self.assertEqual(len(results), 40)
+        self.assertEqual(api.requests, [])
+
+    def test_literal_prefix_skipped(self):
+        api = FakeAPI()
+        OpenTSDBMetricsMeta(api).find('servers.web03.cpu.*')
+        self.assertEqual(api.requests, ['0001', 'S', 'W03', 'C03'])
+
+        # The next find under the prefix starts from its branch, without the root and servers branches
+        cache.delete_many(['opentsdb-branch:opentsdb:4242:0001', 'opentsdb-branch:opentsdb:4242:S'])
+        api.requests = []
+        results = OpenTSDBMetricsMeta(api).find('servers.web03.cpu.u*')
+        self.assertEqual([r['metric_path'] for r in results], ['servers.web03.cpu.user'])
+        self.assertEqual(api.requests, [])
+
+    @override_settings(OPENTSDB_FIND_CONCURRENCY=5)
+    def test_concurrent_requests(self):
+        api = FakeAPI(delay=0.01)
+        results = OpenTSDBMetricsMeta(api).find('servers.*.cpu.*')
+        self.assertEqual(len(results), 40)
+        self.assertEqual(api.max_running, 5)
+
+    def test_request_error(self):
+        api = FakeAPI()
+        del api.branches['W07']
+        self.assertRaises(KeyError, OpenTSDBMetricsMeta(api).find, 'servers.*.cpu.*')
+
+    def test_same_as_index(self):
+        api = FakeAPI()
+        names = [leaf['metric'] for branch in api.branches.values() for leaf in branch['leaves'] or []]
+        index = OpenTSDBMetricIndex(FakeSuggestAPI(names), os.path.join(settings.OPENTSDB_INDEX_DIR, 'test_tree'))
+        index.refresh()
+        self.addCleanup(os.unlink, index.path)
+
+        patterns = ['*', 'servers', 'servers.*', 'servers.web0*', 'servers.web01', 'servers.web01.cpu',
+                    'servers.web01.cpu.*', 'servers.{web01,web12}.*', 'servers.*.cpu.user', 'servers.web1[0-2].*.*',
+                    'servers.web01.cpu.user', 'servers.web1', 'servers.*.*.*.*', 'nothing.*']
+        for pattern in patterns:
+            results = OpenTSDBMetricsMeta(api).find(pattern)
+            self.assertEqual(sorted((r['metric_path'], r['isLeaf']) for r in results),
+                             sorted((r['metric_path'], r['isLeaf']) for r in index.find(pattern)), pattern)
+
+
+METRIC_NAMES = [
+    'servers.web01.cpu.user', 'servers.web01.cpu.system', 'servers.web01.load',
+    'servers.web02.cpu.user', 'servers.web02-old.cpu.user', 'servers.web10.cpu.user',
+    'servers.db01.cpu.user', 'servers.db01.disk.sda.reads', 'servers.db01.disk.sda',
+    'servers', 'stats.counts.hits', 'stats.timers.render.upper', u'stats.timers.caf\xe9',
+]
+
+
+class FakeSuggestAPI(object):
+    host = 'opentsdb:4242'
+
+    def __init__(self, names):
+        self.names = names
+        self.requests = 0
+
+    def suggest_metrics(self, prefix='', max_results=25):
+        self.requests += 1
+        return sorted(self.names)[:max_results]
+
+
+class OpenTSDBMetricIndexTest(TestCase):
+    def setUp(self):
+        self.api = FakeSuggestAPI(METRIC_NAMES)
+        self.path = os.path.join(settings.OPENTSDB_INDEX_DIR, 'test_index')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.index = OpenTSDBMetricIndex(self.api, self.path)
+
+    def expected(self, pattern):
+        "Matches every name part by part with match_entries, like the standard finder"
+        parts = pattern.split('.')
+        result = set()
+        for name in METRIC_NAMES:
+            name_parts = name.encode('utf-8').split('.')
+            if len(name_parts) >= len(parts) and all(match_entries([name_part], part)
+                                                     for name_part, part in zip(name_parts, parts)):
+                result.add(('.'.join(name_parts[:len(parts)]), len(name_parts) == len(parts)))
+        return sorted(result)
+
+    def find(self, pattern):
+        return sorted((r['metric_path'], r['isLeaf']) for r in self.index.find(pattern))
+
+    def test_find(self):
+        self.assertEqual(self.index.find('*'), None)
+        self.index.refresh()
+        patterns = ['*', 'servers', 'servers.*', 'servers.web0*', 'servers.web01', 'servers.web01.*',
+                    'servers.*.cpu.user', 'servers.{web01,db01}.*', 'servers.web0[12].cpu.*', 'servers.*.disk.*',
+                    '*.*.cpu', 'stats.*.*.upper', 'stats.timers.*', 'servers.web1', 'servers.db01.disk.sda',
+                    'nothing.*', 'servers.*.*.*.*']
+        for pattern in patterns:
+            self.assertEqual(self.find(pattern), self.expected(pattern), pattern)
+        self.assertEqual(self.find('servers.*'), [('servers.db01', False), ('servers.web01', False),
+                                                  ('servers.web02', False), ('servers.web02-old', False),
+                                                  ('servers.web10', False)])
+        self.assertEqual(self.find('servers'), [('servers', False), ('servers', True)])
+
+    def test_save_and_load(self):
+        self.index.refresh()
+        index = OpenTSDBMetricIndex(FakeSuggestAPI([]), self.path)
+        index.load()
+        self.assertEqual(index.names, self.index.names)
+        self.assertEqual(index.names, sorted(name.encode('utf-8') for name in METRIC_NAMES))
+
+        # Unchanged names aren't saved again
+        mtime = os.stat(self.path).st_mtime
+        os.utime(self.path, (0, 0))
+        self.index.refresh()
+        self.assertEqual(os.stat(self.path).st_mtime, 0)
+
+        self.api.names = METRIC_NAMES[:3]
+        self.index.refresh()
+        self.assertNotEqual(os.stat(self.path).st_mtime, mtime)
+        index.load()
+        self.assertEqual(index.names, sorted(METRIC_NAMES[:3]))
+
+    @override_settings(OPENTSDB_INDEX_REFRESH_INTERVAL=0)
+    def test_disabled(self):
+        self.assertEqual(get_metric_index('opentsdb:4242'), None)